@@ -18,7 +18,7 @@ from matplotlib.figure import Figure
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.pyplot import savefig
 
-from epics import caget, caput, camonitor
+from epics import caget, caput, camonitor, get_pv, poll
 from collections import OrderedDict
 
 import sys
@@ -29,6 +29,7 @@ else:
 
 TRIGGER_INTERVAL = 0 # msec
 DELAY_RANGE = 50
+PUT_TIMEOUT = 30.0 # sec, deadline for all the puts of one SetDelay/SetValue
 gtbtlist = "gtbtindex_her.dat"
 
 class View:
@@ -229,12 +230,23 @@ class View:
         self.root.after(1000, self.TriggerTimer)
 
     def SetDelay(self):
-        for key in self.refs.keys():
-            caput(key, (self.refs[key] + self.idelay)%5120, wait=True)
+        self.PutAll({key: (self.refs[key] + self.idelay)%5120 for key in self.refs.keys()})
             
     def SetValue(self, mydict, setval):
-        for key in mydict.keys():
-            caput(key, setval, wait=True)
+        self.PutAll({key: setval for key in mydict.keys()})
+            
+    def PutAll(self, values, timeout=PUT_TIMEOUT):
+        # send all the puts first, then wait for all the completions together,
+        # so that it takes as long as the slowest channel instead of the sum
+        pvs = [get_pv(key) for key in values.keys()]
+        for pv, val in zip(pvs, values.values()):
+            pv.put(val, use_complete=True)
+        t0 = time.time()
+        while not all(pv.put_complete for pv in pvs):
+            if time.time() - t0 > timeout:
+                print("put not completed: ", [pv.pvname for pv in pvs if not pv.put_complete])
+                break
+            poll()
             
     def CheckValue(self, mydict, setval):
         while True:
@@ -42,6 +42,7 @@ import threading
 import time, datetime
 import configparser
 import TheSummer.Hitohudebayes as Hitohudebayes
+import TheSummer.ask_pipeline as ask_pipeline
 import matplotlib.pyplot as plt
 import pandas as pd
 from matplotlib.colors import LogNorm
@@ -308,7 +309,7 @@ def getValueY_th_PV(y_name_list, y_alias_list,th_name_list, th_alias_list, funct
 #   ベイズ最適化の1step
 # -----------------------------------------------------------
 def optimizationOneStep(study,x_name_list,y_name_list,y_alias_list,x_min_max_list,x_step_list,iter_i,WaitTime,dataN,threshold_list,functionText) :
-    global Xold
+    global Xold, pipeline
     
     log_text = ''
     X = [0 for i in range(len(x_name_list))]
@@ -321,11 +322,15 @@ def optimizationOneStep(study,x_name_list,y_name_list,y_alias_list,x_min_max_lis
             Xold.append(present_x_val)
         print(Xold)
 
-    trial = study.ask()
+    trial = pipeline.ask() if pipeline is not None else study.ask()
 
     for i in range(len(x_name_list)):
         X[i] = trial.suggest_float(x_name_list[i], x_min_max_list[i][0], x_min_max_list[i][1])
     
+    #測定中に次の候補点を計算しておく(今のtrialはX_pendingとして扱われる)
+    if pipeline is not None and iter_i + 1 < iterN :
+        pipeline.prefetch()
+    
     setValueX_PV(x_name_list,x_step_list ,X , Xold, WaitTime,iter_i, iterN)
     Xold = X.copy()  # Xoldを更新
     
@@ -974,6 +979,7 @@ if __name__ == '__main__':
         sg.Radio('  Grid   ',  key='gridvalue', group_id='1'),
         sg.Radio('  Best value   ',  key='bestvalue', group_id='1'), sg.InputText("input enqueue data", size=(20 ,1), key='enqueueData')]])],
         [sg.Submit(button_text="   Start   ", key='start', font=('Arial', 16) ), sg.Checkbox("with set current and shift", default=False, key = "setCurrntShift"), 
+        sg.Checkbox("pipelined suggestion", default=False, key = "pipeline"), 
         sg.Text("", size=(2,1) ),  
         sg.Submit(button_text="  Stop  ", key='stop'),
         sg.Submit(button_text="  Restart  ", key='restart'),
@@ -1074,6 +1080,8 @@ if __name__ == '__main__':
     bestY_value = 9999
     bestXset = []
 
+    pipeline = None #測定中に次の候補点を計算するときのAskPipeline
+
     while True: #ループに入る
         event, values = window.read(timeout=t,timeout_key='-timeout-') #timeoutの単位はms
         
@@ -1185,9 +1193,14 @@ if __name__ == '__main__':
                 # sampler=optuna.integration.BoTorchSampler(),
                 study_name="{}".format(current_time),
                 storage="sqlite:///SKEKB20240301.db",
-                sampler=Hitohudebayes.HitohudebayesSampler(x_name_list,x_min_max_list,x_weight_list,UCB,logEI,beta,n_startup_trials = 4)
+                sampler=Hitohudebayes.HitohudebayesSampler(x_name_list,x_min_max_list,x_weight_list,UCB,logEI,beta,n_startup_trials = 4, consider_running_trials=values["pipeline"])
             )
             
+            #"pipelined suggestion" にチェックが入っていたら測定中に次の候補点を計算する
+            if pipeline is not None :
+                pipeline.close()
+            pipeline = ask_pipeline.AskPipeline(study) if values["pipeline"] else None
+            
             if randomvalue == True:
                 study.enqueue_trial(x_init_dict)
                 print(x_init_dict)
@@ -1267,6 +1280,10 @@ if __name__ == '__main__':
             iter_i = 0
             mode = 'stop'
 
+            if pipeline is not None :
+                pipeline.close()
+                pipeline = None
+
             if len(bestXset) > 1 :
                 setValueX_PV(x_name_list, bestXset) #最適値をセットする
 
@@ -1320,6 +1337,10 @@ if __name__ == '__main__':
                     for thread in thread_list:
                         thread.join()
                     
+                    if pipeline is not None :
+                        pipeline.close()
+                        pipeline = None
+                    
                     graph_view(X_values_list, Y_values_list, x_min_max_list)
                     setValueX_PV(x_name_list,x_step_list ,list(study.best_params.values()) , Xold, WaitTime,iter_i, iterN) #最後に最適値をセットする
                     print(f"best y = {study.best_value} at x = {list(study.best_params.values())}")
@@ -17,6 +17,7 @@ import threading
 import time, datetime
 import configparser
 import TheSummer.Hitohudebayes as Hitohudebayes
+import TheSummer.ask_pipeline as ask_pipeline
 import subprocess
 import select
 import matplotlib.pyplot as plt
@@ -129,7 +130,7 @@ def getValueY_th_PV(y_name_list, y_alias_list,th_name_list, th_alias_list, funct
 #   ベイズ最適化の1step
 # -----------------------------------------------------------
 def optimizationOneStep(study,x_name_list,y_name_list,y_alias_list,x_min_max_list,x_step_list,iter_i,WaitTime,dataN,threshold_list,functionText) :
-    global Xold
+    global Xold, pipeline
     
     log_text = ''
     X = [0 for i in range(len(x_name_list))]
@@ -142,11 +143,15 @@ def optimizationOneStep(study,x_name_list,y_name_list,y_alias_list,x_min_max_lis
             Xold.append(present_x_val)
         print(Xold)
 
-    trial = study.ask()
+    trial = pipeline.ask() if pipeline is not None else study.ask()
 
     for i in range(len(x_name_list)):
         X[i] = trial.suggest_float(x_name_list[i], x_min_max_list[i][0], x_min_max_list[i][1])
     
+    #測定中に次の候補点を計算しておく(今のtrialはX_pendingとして扱われる)
+    if pipeline is not None and iter_i + 1 < iterN :
+        pipeline.prefetch()
+    
     setValueX_PV(x_name_list,x_step_list ,X , Xold, WaitTime,iter_i, iterN)
     Xold = X.copy()  # Xoldを更新
     
@@ -322,6 +327,8 @@ def readSetting(args) :
         else : print("The acquisition function is not correctly selected.")
         
         beta = float(config_ini.get("PV", "beta"))
+        #Trueなら測定中に次の候補点を計算する
+        pipeline = config_ini.getboolean("PV", "pipeline", fallback=False)
     
         
         for i in range(nxr):
@@ -363,7 +370,7 @@ def readSetting(args) :
     x_name_list, x_min_max_list, x_init_list, x_step_list, x_weight_list,
     y_name_list, y_alias_list, th_name_list, th_alias_list, threshold_list,
     lm_name_list, lm_alias_list, lossmonitor_list, functionText,
-    UCB, logEI, beta, randomvalue,gridvalue, bestvalue, enqueueData]
+    UCB, logEI, beta, randomvalue,gridvalue, bestvalue, enqueueData, pipeline]
 
 ############################################
 # ---------------- main ----------------
@@ -385,7 +392,7 @@ if __name__ == '__main__':
     x_name_list, x_min_max_list, x_init_list, x_step_list, x_weight_list,
     y_name_list, y_alias_list, th_name_list, th_alias_list, threshold_list,
     lm_name_list, lm_alias_list, lossmonitor_list, functionText,
-    UCB, logEI, beta, randomvalue,gridvalue, bestvalue, enqueueData] = readSetting(args[1])
+    UCB, logEI, beta, randomvalue,gridvalue, bestvalue, enqueueData, pipeline] = readSetting(args[1])
     print(lm_name_list)
     
     #if repetition < 1 : repetition = 1
@@ -420,8 +427,9 @@ if __name__ == '__main__':
         #制限あり
         #sampler=Hitohudebayes.HitohudebayesSampler(x_name_list,x_min_max_list,x_weight_list,UCB,logEI,beta,n_startup_trials = 1, constraints_func=lambda trial: trial.user_attrs["constraints"]),
         #制限なし
-        sampler=Hitohudebayes.HitohudebayesSampler(x_name_list,x_min_max_list,x_weight_list,UCB,logEI,beta,n_startup_trials = 1,),
+        sampler=Hitohudebayes.HitohudebayesSampler(x_name_list,x_min_max_list,x_weight_list,UCB,logEI,beta,n_startup_trials = 1, consider_running_trials=pipeline,),
     )
+    pipeline = ask_pipeline.AskPipeline(study) if pipeline else None
     
     if randomvalue == True:
         study.enqueue_trial(x_init_dict)
@@ -542,6 +550,8 @@ if __name__ == '__main__':
         iter_i += 1
     
     keep_running.clear()  #False
+    if pipeline is not None :
+        pipeline.close()
     
     #graph_view(X_values_list, Y_values_list, x_min_max_list)
     setValueX_PV(x_name_list,x_step_list ,list(study.best_params.values()) , Xold, WaitTime,iter_i, iterN) #最後に最適値をセットする
@@ -2,8 +2,14 @@ from typing import Any
 from typing import Callable
 from typing import Dict
 from typing import Optional
+from typing import List
 from typing import Sequence
+from typing import Tuple
 from typing import Union
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
 import warnings
 
 import numpy
@@ -25,6 +31,9 @@ from optuna.study import StudyDirection
 from optuna.trial import FrozenTrial
 from optuna.trial import TrialState
 import proximal
+from ramp_cost import CostAwareAcquisitionFunction
+from ramp_cost import RampCost
+from ramp_cost import RampCostModel
 import sys
 import configparser
 from epics import PV, caget, caput
@@ -38,6 +47,9 @@ with try_import() as _imports:
     )
     from botorch.acquisition.objective import ConstrainedMCObjective
     from botorch.acquisition.objective import GenericMCObjective
+    from botorch.generation.gen import gen_candidates_scipy
+    from botorch.models import KroneckerMultiTaskGP
+    from botorch.models import ModelListGP
     from botorch.models import SingleTaskGP
     from botorch.models.transforms.outcome import Standardize
     from botorch.optim import optimize_acqf
@@ -52,16 +64,39 @@ with try_import() as _imports:
         def _get_sobol_qmc_normal_sampler(num_samples: int) -> SobolQMCNormalSampler:
             return SobolQMCNormalSampler(num_samples)
 
+        def _fit_gpytorch_mll_with_budget(
+            mll, time_budget: Optional[float], max_attempts: Optional[int] = None
+        ) -> None:
+            # `fit_gpytorch_model` cannot be stopped after a given time.
+            if max_attempts is None:
+                fit_gpytorch_mll(mll)
+            else:
+                fit_gpytorch_mll(mll, max_retries=max_attempts)
+
     else:
         from botorch.fit import fit_gpytorch_mll
 
         def _get_sobol_qmc_normal_sampler(num_samples: int) -> SobolQMCNormalSampler:
             return SobolQMCNormalSampler(torch.Size((num_samples,)))
 
+        def _fit_gpytorch_mll_with_budget(
+            mll, time_budget: Optional[float], max_attempts: Optional[int] = None
+        ) -> None:
+            kwargs: Dict[str, Any] = {}
+            if time_budget is not None:
+                kwargs["optimizer_kwargs"] = {"timeout_sec": time_budget}
+            if max_attempts is not None:
+                kwargs["max_attempts"] = max_attempts
+            fit_gpytorch_mll(mll, **kwargs)
+
+    from botorch.utils.multi_objective.box_decompositions import (
+        FastNondominatedPartitioning,
+    )
     from botorch.utils.multi_objective.box_decompositions import (
         NondominatedPartitioning,
     )
     from botorch.utils.multi_objective.scalarization import get_chebyshev_scalarization
+    from botorch.utils.sampling import draw_sobol_samples
     from botorch.utils.sampling import manual_seed
     from botorch.utils.sampling import sample_simplex
     from botorch.utils.transforms import normalize
@@ -72,10 +107,955 @@ with try_import() as _imports:
 
 _logger = logging.get_logger(__name__)
 
+_MODEL_UPDATE_KEY = "hitohudebayes:model_update"
+
+_TRUST_REGION_KEY = "hitohudebayes:trust_region"
+
+_PARETO_UPDATE_KEY = "hitohudebayes:pareto_update"
+
+_NOISE_KEY = "hitohudebayes:noise"
+
+# Trial system attribute holding the predictive standard deviation of the objective at the
+# suggested point. Also written by the SafeOpt samplers and read by the measurement loops.
+PREDICTIVE_STD_KEY = "hitohudebayes:predictive_std"
+
+# Smallest noise variance of a fixed-noise GP, in units of the standardized outcome, as
+# BoTorch's MIN_INFERRED_NOISE_LEVEL for inferred noise.
+_MIN_NOISE_LEVEL = 1e-4
+
+_ACQF_OPTIMIZERS = ("optimize_acqf", "sobol_pool")
+
+# Scrambled Sobol pools of `optimize_acqf_sobol_pool` on the unit cube, keyed by dimension,
+# size, dtype and device. Only the most recently used ones are kept, so that a long session
+# with changing configurations does not accumulate pools.
+_sobol_pools: "OrderedDict[Tuple[Any, ...], torch.Tensor]" = OrderedDict()
+_SOBOL_POOL_CACHE_SIZE = 8
+
 with try_import() as _imports_logei:
     from botorch.acquisition.analytic import LogExpectedImprovement
     from botorch.acquisition import UpperConfidenceBound
 
+with try_import() as _imports_qlogei:
+    from botorch.acquisition.logei import qLogExpectedImprovement
+
+with try_import() as _imports_variational:
+    from botorch.models import SingleTaskVariationalGP
+    from gpytorch.mlls import VariationalELBO
+
+
+class RefitPolicy:
+    """Decides when :class:`GPModelCache` re-optimizes the GP hyperparameters.
+
+    Between refits the cached model is only conditioned on the new observations. A refit is
+    triggered by whichever of the enabled criteria fires first.
+
+    Args:
+        refit_interval:
+            Re-optimize the hyperparameters after this many observations have been conditioned
+            on since the last refit. :obj:`None` disables this criterion.
+        mll_drop_threshold:
+            Re-optimize when the log marginal likelihood per observation of the new data under
+            the cached hyperparameters is lower than that of the training data at the last refit
+            by more than this many nats. :obj:`None` disables this criterion.
+        time_budget:
+            Wall-clock limit in seconds for a single hyperparameter optimization. The optimizer
+            stops when the limit is exceeded and the best hyperparameters found so far are kept.
+            Requires botorch >=0.8.0. :obj:`None` means no limit.
+    """
+
+    def __init__(
+        self,
+        refit_interval: Optional[int] = 10,
+        mll_drop_threshold: Optional[float] = 1.0,
+        time_budget: Optional[float] = None,
+    ) -> None:
+        self.refit_interval = refit_interval
+        self.mll_drop_threshold = mll_drop_threshold
+        self.time_budget = time_budget
+
+    def should_refit(self, n_conditioned: int, mll_drop: Optional[float]) -> bool:
+        if self.refit_interval is not None and n_conditioned >= self.refit_interval:
+            return True
+        if (
+            self.mll_drop_threshold is not None
+            and mll_drop is not None
+            and mll_drop > self.mll_drop_threshold
+        ):
+            return True
+        return False
+
+
+class GPModelCache:
+    """Keeps a fitted ``SingleTaskGP`` alive across trials.
+
+    Instead of building a new GP and optimizing its hyperparameters from the defaults on every
+    call, the cached model is extended with the observations that arrived since the previous
+    call through ``condition_on_observations``, which updates the Cholesky factor of the
+    training covariance with a low-rank update. The hyperparameters are re-optimized when
+    ``refit_policy`` asks for it, or when the training data is no longer an extension of the
+    cached data, and the optimization then starts from the previous optimum.
+
+    Once the training set reaches ``sparse_threshold`` observations, the exact GP is replaced
+    by a variational GP with ``num_inducing`` inducing points (``SingleTaskVariationalGP``),
+    whose fit costs O(n m^2) instead of O(n^3). The inducing points, the variational
+    parameters and the hyperparameters are kept across calls, and each new observation only
+    triggers a short ELBO optimization warm-started from them, limited by the ``time_budget``
+    of ``refit_policy``.
+
+    With ``multitask``, the outputs are modelled jointly by a ``KroneckerMultiTaskGP``. Its
+    covariance is the Kronecker product of one input kernel shared by all outputs and a
+    learned inter-output covariance (intrinsic coregionalization model), so a fit factorizes
+    one ``n x n`` kernel matrix however many outputs there are, and correlated outputs such as
+    the injection efficiency and the loss monitors inform each other. The Kronecker structure
+    does not survive ``condition_on_observations``, so between refits the model is rebuilt on
+    the new data with the cached hyperparameters instead (``"rebuild"``).
+
+    If the observation noise variances ``train_yvar`` are given, the exact GP uses them as a
+    fixed, per-observation (heteroscedastic) noise instead of inferring a single noise level,
+    and new observations are conditioned on with their own noise. The variational GP above
+    ``sparse_threshold`` ignores them and infers a homoscedastic noise level.
+
+    After each call of :meth:`get_model`, ``last_update`` holds the path that ran (``"refit"``,
+    ``"condition"``, ``"rebuild"``, ``"sparse"`` or ``"cached"``) and its duration in seconds.
+
+    Args:
+        refit_policy:
+            A :class:`RefitPolicy`. If omitted, the default policy is used.
+        sparse_threshold:
+            Number of observations from which the variational GP is used. :obj:`None` always
+            uses the exact GP.
+        num_inducing:
+            Number of inducing points of the variational GP.
+        max_fit_attempts:
+            Number of attempts of a hyperparameter optimization. The attempts after the first
+            start from hyperparameters drawn from the priors with the global torch generator.
+            If all attempts fail, the hyperparameters the optimization started from are kept.
+            :obj:`None` uses the BoTorch default.
+        multitask:
+            If True, model all outputs with one ``KroneckerMultiTaskGP``. All outputs must be
+            observed at every training point. Cannot be combined with ``sparse_threshold`` or
+            ``train_yvar``.
+    """
+
+    def __init__(
+        self,
+        refit_policy: Optional[RefitPolicy] = None,
+        sparse_threshold: Optional[int] = None,
+        num_inducing: int = 256,
+        max_fit_attempts: Optional[int] = None,
+        multitask: bool = False,
+    ) -> None:
+        if sparse_threshold is not None:
+            _imports_variational.check()
+            if multitask:
+                raise ValueError("multitask cannot be combined with sparse_threshold.")
+        self._refit_policy = refit_policy or RefitPolicy()
+        self._sparse_threshold = sparse_threshold
+        self._num_inducing = num_inducing
+        self._max_fit_attempts = max_fit_attempts
+        self._multitask = multitask
+
+        self.model: Optional["SingleTaskGP"] = None
+        self.last_update: Optional[Dict[str, Any]] = None
+        self._train_x: Optional["torch.Tensor"] = None
+        self._train_y: Optional["torch.Tensor"] = None
+        self._train_yvar: Optional["torch.Tensor"] = None
+        self._hyperparameters: Optional[Dict[str, "torch.Tensor"]] = None
+        self._reference_mll: Optional[float] = None
+        self._n_conditioned = 0
+        self._sparse_state: Optional[Dict[str, "torch.Tensor"]] = None
+
+    def reset(self) -> None:
+        self.model = None
+        self.last_update = None
+        self._train_x = None
+        self._train_y = None
+        self._train_yvar = None
+        self._hyperparameters = None
+        self._reference_mll = None
+        self._n_conditioned = 0
+        self._sparse_state = None
+
+    def get_model(
+        self,
+        train_x: "torch.Tensor",
+        train_y: "torch.Tensor",
+        train_yvar: Optional["torch.Tensor"] = None,
+    ) -> "SingleTaskGP":
+        """Return a GP fitted to ``train_x`` and ``train_y``.
+
+        Args:
+            train_x:
+                Normalized parameter configurations of shape ``(n_trials, n_params)``.
+            train_y:
+                Observations of shape ``(n_trials, n_outputs)``.
+            train_yvar:
+                Observation noise variances of the same shape as ``train_y``, or :obj:`None`
+                to infer the noise level.
+
+        Returns:
+            A ``SingleTaskGP``, a ``KroneckerMultiTaskGP`` with ``multitask``, or a
+            ``SingleTaskVariationalGP`` above ``sparse_threshold``, in eval mode.
+        """
+
+        if train_yvar is not None and self._multitask:
+            raise ValueError("multitask cannot be combined with train_yvar.")
+        start = time.perf_counter()
+        use_sparse = (
+            self._sparse_threshold is not None and train_x.size(0) >= self._sparse_threshold
+        )
+        is_sparse = self._sparse_state is not None and self.model is not None
+        n_new = self._count_new_observations(train_x, train_y, train_yvar)
+        if use_sparse:
+            path = "cached" if is_sparse and n_new == 0 else "sparse"
+        elif n_new is None or is_sparse:
+            path = "refit"
+        elif n_new == 0:
+            path = "cached"
+        else:
+            mll_drop = None
+            if self._refit_policy.mll_drop_threshold is not None:
+                mll_drop = self._reference_mll - self._log_likelihood(
+                    train_x[-n_new:],
+                    train_y[-n_new:],
+                    None if train_yvar is None else train_yvar[-n_new:],
+                )
+            if self._refit_policy.should_refit(self._n_conditioned + n_new, mll_drop):
+                path = "refit"
+            elif self._multitask:
+                path = "rebuild"
+            else:
+                path = "condition"
+
+        if path == "sparse":
+            self._fit_sparse(train_x, train_y)
+        elif path == "refit":
+            self._refit(train_x, train_y, train_yvar)
+        elif path == "rebuild":
+            self.model = self._build_model(train_x, train_y)
+            self.model.eval()
+            self._n_conditioned += n_new
+        elif path == "condition":
+            kwargs = {} if train_yvar is None else {"noise": train_yvar[-n_new:]}
+            self.model = self.model.condition_on_observations(
+                train_x[-n_new:], train_y[-n_new:], **kwargs
+            )
+            self._n_conditioned += n_new
+
+        self._train_x = train_x
+        self._train_y = train_y
+        self._train_yvar = train_yvar
+        self.last_update = {"path": path, "duration": time.perf_counter() - start}
+        return self.model
+
+    def _count_new_observations(
+        self,
+        train_x: "torch.Tensor",
+        train_y: "torch.Tensor",
+        train_yvar: Optional["torch.Tensor"],
+    ) -> Optional[int]:
+        # Returns None when the cached model cannot be extended to the given data.
+        if self.model is None:
+            return None
+        n_cached = self._train_x.size(0)
+        if (
+            train_x.size(0) < n_cached
+            or train_y.size(-1) != self._train_y.size(-1)
+            or not torch.equal(train_x[:n_cached], self._train_x)
+            or not torch.equal(train_y[:n_cached], self._train_y)
+            or (train_yvar is None) != (self._train_yvar is None)
+            or (
+                train_yvar is not None
+                and not torch.equal(train_yvar[:n_cached], self._train_yvar)
+            )
+        ):
+            return None
+        return train_x.size(0) - n_cached
+
+    def _log_likelihood(
+        self, x: "torch.Tensor", y: "torch.Tensor", yvar: Optional["torch.Tensor"]
+    ) -> float:
+        # Log predictive density per observation of `y` under the cached model. For the new
+        # observations this is their contribution to the log marginal likelihood.
+        model = self.model
+        with torch.no_grad():
+            y, yvar = model.outcome_transform(y, yvar)
+            if model.num_outputs == 1:
+                y = y.squeeze(-1)
+                if yvar is not None:
+                    yvar = yvar.squeeze(-1)
+            elif not self._multitask:
+                # The batched model has the outputs as a batch dimension.
+                x = x.unsqueeze(-3)
+                y = y.transpose(-1, -2)
+                if yvar is not None:
+                    yvar = yvar.transpose(-1, -2)
+            kwargs = {} if yvar is None else {"noise": yvar}
+            pred = model.likelihood(model(x), x, **kwargs)
+            return (pred.log_prob(y).sum() / y.numel()).item()
+
+    def _build_model(
+        self,
+        train_x: "torch.Tensor",
+        train_y: "torch.Tensor",
+        train_yvar: Optional["torch.Tensor"] = None,
+    ) -> Union["SingleTaskGP", "KroneckerMultiTaskGP"]:
+        if self._multitask:
+            model = KroneckerMultiTaskGP(
+                train_x, train_y, outcome_transform=Standardize(m=train_y.size(-1))
+            )
+        else:
+            model = SingleTaskGP(
+                train_x,
+                train_y,
+                train_Yvar=train_yvar,
+                outcome_transform=Standardize(m=train_y.size(-1)),
+            )
+        if self._hyperparameters is not None:
+            # Warm-start from the previous optimum. The outcome transform has just been
+            # computed from the new data and must not be overwritten.
+            state_dict = model.state_dict()
+            state_dict.update(
+                {
+                    k: v
+                    for k, v in self._hyperparameters.items()
+                    if k in state_dict and state_dict[k].shape == v.shape
+                }
+            )
+            # Bypass the BoTorch override, which re-applies the outcome transform to the train
+            # targets and does not handle the (n, n_outputs) targets of KroneckerMultiTaskGP.
+            torch.nn.Module.load_state_dict(model, state_dict)
+        return model
+
+    def _refit(
+        self,
+        train_x: "torch.Tensor",
+        train_y: "torch.Tensor",
+        train_yvar: Optional["torch.Tensor"],
+    ) -> None:
+        model = self._build_model(train_x, train_y, train_yvar)
+        mll = ExactMarginalLogLikelihood(model.likelihood, model)
+        _fit_gpytorch_mll_with_budget(
+            mll, self._refit_policy.time_budget, self._max_fit_attempts
+        )
+
+        model.train()
+        with torch.no_grad():
+            train_inputs = model.train_inputs
+            output = model.likelihood(model(*train_inputs), *train_inputs)
+            self._reference_mll = (
+                output.log_prob(model.train_targets).sum() / model.train_targets.numel()
+            ).item()
+        model.eval()
+
+        # `condition_on_observations` requires the prediction caches to exist.
+        with torch.no_grad():
+            model.posterior(train_x[:1])
+
+        self.model = model
+        self._hyperparameters = {
+            k: v.detach().clone()
+            for k, v in model.state_dict().items()
+            if not k.startswith("outcome_transform")
+        }
+        self._n_conditioned = 0
+        self._sparse_state = None
+
+    def _fit_sparse(self, train_x: "torch.Tensor", train_y: "torch.Tensor") -> None:
+        # Resume from the previous inducing points, variational parameters and hyperparameters.
+        inducing_points: Union[int, "torch.Tensor"] = min(self._num_inducing, train_x.size(0))
+        if self._sparse_state is not None:
+            inducing_points = self._sparse_state["model.variational_strategy.inducing_points"]
+        model = SingleTaskVariationalGP(
+            train_x,
+            train_y,
+            inducing_points=inducing_points,
+            outcome_transform=Standardize(m=train_y.size(-1)),
+        )
+        if self._sparse_state is not None:
+            state_dict = model.state_dict()
+            state_dict.update(
+                {
+                    k: v
+                    for k, v in self._sparse_state.items()
+                    if k in state_dict and state_dict[k].shape == v.shape
+                }
+            )
+            model.load_state_dict(state_dict)
+
+        mll = VariationalELBO(model.likelihood, model.model, num_data=train_x.size(0))
+        _fit_gpytorch_mll_with_budget(
+            mll, self._refit_policy.time_budget, self._max_fit_attempts
+        )
+        model.eval()
+
+        self.model = model
+        self._sparse_state = {
+            k: v.detach().clone()
+            for k, v in model.state_dict().items()
+            if not k.startswith("outcome_transform")
+        }
+        self._hyperparameters = None
+        self._reference_mll = None
+        self._n_conditioned = 0
+
+
+class GPModelListCache:
+    """Keeps one :class:`GPModelCache` per output and fits them concurrently.
+
+    Each output column gets an independent ``SingleTaskGP`` with its own hyperparameters and
+    refit schedule, and the models are returned as a ``ModelListGP``. The outputs are fitted
+    by a pool of ``max_workers`` threads. The number of torch intra-op threads is a
+    process-wide setting, so it is divided by the number of workers for the duration of the
+    concurrent fits, so that they do not compete for the same cores, and restored afterwards.
+    Other torch work of the process running at the same time also sees the lower setting.
+
+    The random restarts of ``fit_gpytorch_mll`` draw from the global torch generator, whose
+    state would then depend on the thread scheduling. To stay deterministic under a seed, a
+    fit is therefore attempted only once and keeps its starting hyperparameters if it fails,
+    unless ``max_workers`` is 1.
+
+    After each call of :meth:`get_model`, ``last_update`` holds the ``last_update`` of every
+    output and the wall-clock duration of the whole call.
+
+    Args:
+        refit_policy:
+            A :class:`RefitPolicy` shared by the outputs.
+        max_workers:
+            Number of outputs fitted at the same time. :obj:`None` fits all outputs at once.
+        sparse_threshold:
+            See :class:`GPModelCache`.
+        num_inducing:
+            See :class:`GPModelCache`.
+    """
+
+    def __init__(
+        self,
+        refit_policy: Optional[RefitPolicy] = None,
+        max_workers: Optional[int] = None,
+        sparse_threshold: Optional[int] = None,
+        num_inducing: int = 256,
+    ) -> None:
+        self._refit_policy = refit_policy
+        self._max_workers = max_workers
+        self._sparse_threshold = sparse_threshold
+        self._num_inducing = num_inducing
+
+        self.model_caches: List[GPModelCache] = []
+        self.last_update: Optional[Dict[str, Any]] = None
+
+    def reset(self) -> None:
+        self.model_caches = []
+        self.last_update = None
+
+    def get_model(
+        self,
+        train_x: "torch.Tensor",
+        train_y: "torch.Tensor",
+        train_yvar: Optional["torch.Tensor"] = None,
+    ) -> "ModelListGP":
+        """Return a ``ModelListGP`` with one GP per column of ``train_y``.
+
+        Args:
+            train_x:
+                Normalized parameter configurations of shape ``(n_trials, n_params)``.
+            train_y:
+                Observations of shape ``(n_trials, n_outputs)``.
+            train_yvar:
+                Observation noise variances of the same shape as ``train_y``, or :obj:`None`.
+
+        Returns:
+            A ``ModelListGP`` in eval mode.
+        """
+
+        start = time.perf_counter()
+        n_outputs = train_y.size(-1)
+        n_workers = min(self._max_workers or n_outputs, n_outputs)
+        if len(self.model_caches) != n_outputs:
+            self.model_caches = [
+                GPModelCache(
+                    self._refit_policy,
+                    self._sparse_threshold,
+                    self._num_inducing,
+                    max_fit_attempts=None if n_workers == 1 else 1,
+                )
+                for _ in range(n_outputs)
+            ]
+
+        def column(i: int) -> Tuple["torch.Tensor", Optional["torch.Tensor"]]:
+            yvar = None if train_yvar is None else train_yvar[:, i : i + 1]
+            return train_y[:, i : i + 1], yvar
+
+        if n_workers == 1:
+            models = [
+                cache.get_model(train_x, *column(i))
+                for i, cache in enumerate(self.model_caches)
+            ]
+        else:
+            total_threads = torch.get_num_threads()
+
+            def fit(i: int) -> "SingleTaskGP":
+                return self.model_caches[i].get_model(train_x, *column(i))
+
+            # torch.set_num_threads is process-wide, so it is set once here rather than in
+            # the workers.
+            torch.set_num_threads(max(1, total_threads // n_workers))
+            try:
+                with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                    models = list(executor.map(fit, range(n_outputs)))
+            finally:
+                torch.set_num_threads(total_threads)
+
+        self.last_update = {
+            "outputs": [cache.last_update for cache in self.model_caches],
+            "duration": time.perf_counter() - start,
+        }
+        return ModelListGP(*models)
+
+
+class ParetoCache:
+    """Keeps the feasible Pareto front and its box decomposition across trials.
+
+    :func:`qehvi_candidates_func` needs the partitioning of the space dominated by the
+    feasible observations. Instead of rebuilding it from all observations on every call, the
+    cached ``FastNondominatedPartitioning`` is extended with ``update`` only when a new
+    feasible observation enters the Pareto front, and reused as it is otherwise. It is
+    rebuilt when the reference point (the component-wise minimum of the observations) moves,
+    or when the observations are no longer an extension of the cached ones.
+
+    After each call of :meth:`get_partitioning`, ``last_update`` holds the path that ran
+    (``"rebuild"``, ``"update"`` or ``"cached"``), the size of the Pareto front and the
+    duration in seconds.
+    """
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.partitioning: Optional["FastNondominatedPartitioning"] = None
+        self.ref_point: Optional["torch.Tensor"] = None
+        self.last_update: Optional[Dict[str, Any]] = None
+        self._train_obj: Optional["torch.Tensor"] = None
+        self._is_feas: Optional["torch.Tensor"] = None
+
+    def get_partitioning(
+        self, train_obj: "torch.Tensor", is_feas: "torch.Tensor"
+    ) -> Tuple["torch.Tensor", "FastNondominatedPartitioning"]:
+        """Return the reference point and the partitioning of the feasible observations.
+
+        Args:
+            train_obj:
+                Objective values of shape ``(n_trials, n_objectives)``, to be maximized.
+            is_feas:
+                Boolean tensor of shape ``(n_trials,)``, True for the feasible trials.
+        """
+
+        start = time.perf_counter()
+        ref_point = train_obj.min(dim=0).values - 1e-8
+        n_new = self._count_new_observations(train_obj, is_feas)
+        if (
+            n_new is None
+            or self.partitioning is None
+            or not torch.equal(ref_point, self.ref_point)
+        ):
+            path = "rebuild"
+            self.partitioning = FastNondominatedPartitioning(
+                ref_point=ref_point, Y=train_obj[is_feas]
+            )
+            self.ref_point = ref_point
+        else:
+            new_obj = train_obj[train_obj.size(0) - n_new :][is_feas[is_feas.size(0) - n_new :]]
+            pareto_Y = self.partitioning.pareto_Y
+            # A point weakly dominated by the current front leaves the decomposition unchanged.
+            dominated = (pareto_Y.unsqueeze(0) >= new_obj.unsqueeze(1)).all(dim=-1).any(dim=-1)
+            if dominated.all():
+                path = "cached"
+            else:
+                path = "update"
+                self.partitioning.update(Y=new_obj[~dominated])
+
+        self._train_obj = train_obj
+        self._is_feas = is_feas
+        self.last_update = {
+            "path": path,
+            "n_pareto": self.partitioning.pareto_Y.size(-2),
+            "duration": time.perf_counter() - start,
+        }
+        return self.ref_point, self.partitioning
+
+    def _count_new_observations(
+        self, train_obj: "torch.Tensor", is_feas: "torch.Tensor"
+    ) -> Optional[int]:
+        if self._train_obj is None:
+            return None
+        n_cached = self._train_obj.size(0)
+        if (
+            train_obj.size(0) < n_cached
+            or train_obj.size(-1) != self._train_obj.size(-1)
+            or not torch.equal(train_obj[:n_cached], self._train_obj)
+            or not torch.equal(is_feas[:n_cached], self._is_feas)
+        ):
+            return None
+        return train_obj.size(0) - n_cached
+
+
+class AcquisitionBudget:
+    """Sizes the acquisition optimization to a wall-clock budget per suggestion.
+
+    The numbers of raw samples and restarts grow with the number of parameters and are capped
+    by what fits into ``time_budget``, using the cost per acquisition evaluation and per
+    restart measured in the previous calls. Restarts are run in batches of ``batch_limit`` and
+    the optimization stops early when the budget is spent or when the best acquisition value
+    stops improving.
+
+    After each optimization, ``last_run`` holds the planned numbers of raw samples and
+    restarts, the number of restarts that actually ran and the duration in seconds.
+
+    Args:
+        time_budget:
+            Target wall-clock time in seconds of the acquisition optimization for one
+            candidate. At least one batch of restarts is always run.
+        raw_samples_per_dim:
+            Number of raw samples per parameter before the budget is applied.
+        min_raw_samples:
+            Lower bound of the number of raw samples.
+        max_raw_samples:
+            Upper bound of the number of raw samples.
+        restarts_per_dim:
+            Number of restarts per parameter before the budget is applied.
+        min_restarts:
+            Lower bound of the number of restarts.
+        max_restarts:
+            Upper bound of the number of restarts.
+        batch_limit:
+            Number of restarts optimized jointly between two early-stopping checks.
+        maxiter:
+            Maximum number of L-BFGS-B iterations of a restart.
+        rel_tol:
+            A batch of restarts counts as an improvement only if it raises the best acquisition
+            value by more than ``rel_tol * max(1, |best value|)``. The absolute floor keeps the
+            tolerance meaningful for log-valued acquisition functions near 0.
+        patience:
+            Stop after this many consecutive batches without improvement.
+    """
+
+    def __init__(
+        self,
+        time_budget: float,
+        raw_samples_per_dim: int = 128,
+        min_raw_samples: int = 64,
+        max_raw_samples: int = 2048,
+        restarts_per_dim: int = 2,
+        min_restarts: int = 2,
+        max_restarts: int = 20,
+        batch_limit: int = 5,
+        maxiter: int = 200,
+        rel_tol: float = 1e-3,
+        patience: int = 1,
+    ) -> None:
+        self.time_budget = time_budget
+        self.raw_samples_per_dim = raw_samples_per_dim
+        self.min_raw_samples = min_raw_samples
+        self.max_raw_samples = max_raw_samples
+        self.restarts_per_dim = restarts_per_dim
+        self.min_restarts = min_restarts
+        self.max_restarts = max_restarts
+        self.batch_limit = batch_limit
+        self.maxiter = maxiter
+        self.rel_tol = rel_tol
+        self.patience = patience
+
+        self.last_run: Optional[Dict[str, Any]] = None
+        self._cost_per_eval: Optional[float] = None
+        self._cost_per_restart: Optional[float] = None
+
+    def plan(self, n_params: int) -> Tuple[int, int]:
+        """Return the numbers of raw samples and restarts for ``n_params`` parameters."""
+
+        raw_samples = min(
+            max(self.raw_samples_per_dim * n_params, self.min_raw_samples), self.max_raw_samples
+        )
+        num_restarts = min(
+            max(self.restarts_per_dim * n_params, self.min_restarts), self.max_restarts
+        )
+        # Spend at most a quarter of the budget on the raw samples and the rest on restarts.
+        if self._cost_per_eval is not None:
+            raw_samples = max(
+                min(raw_samples, int(0.25 * self.time_budget / self._cost_per_eval)),
+                self.min_raw_samples,
+            )
+        if self._cost_per_restart is not None:
+            remaining = self.time_budget - raw_samples * (self._cost_per_eval or 0.0)
+            num_restarts = max(
+                min(num_restarts, int(remaining / self._cost_per_restart)), self.min_restarts
+            )
+        return raw_samples, num_restarts
+
+    def record_eval_cost(self, cost: float) -> None:
+        self._cost_per_eval = _smooth(self._cost_per_eval, cost)
+
+    def record_restart_cost(self, cost: float) -> None:
+        self._cost_per_restart = _smooth(self._cost_per_restart, cost)
+
+
+def _smooth(previous: Optional[float], current: float) -> float:
+    # Exponential moving average, so that one slow call does not halve the next plan.
+    return current if previous is None else 0.5 * previous + 0.5 * current
+
+
+def _get_fitted_model(
+    train_x: "torch.Tensor",
+    train_y: "torch.Tensor",
+    model_cache: Optional[Union[GPModelCache, GPModelListCache]] = None,
+    train_yvar: Optional["torch.Tensor"] = None,
+) -> "SingleTaskGP":
+    if model_cache is not None:
+        return model_cache.get_model(train_x, train_y, train_yvar)
+
+    model = SingleTaskGP(
+        train_x,
+        train_y,
+        train_Yvar=train_yvar,
+        outcome_transform=Standardize(m=train_y.size(-1)),
+    )
+    mll = ExactMarginalLogLikelihood(model.likelihood, model)
+    fit_gpytorch_mll(mll)
+    return model
+
+
+def _get_sobol_pool(bounds: "torch.Tensor", pool_size: int) -> "torch.Tensor":
+    key = (bounds.size(-1), pool_size, bounds.dtype, str(bounds.device))
+    pool = _sobol_pools.get(key)
+    if pool is None:
+        engine = torch.quasirandom.SobolEngine(dimension=bounds.size(-1), scramble=True, seed=0)
+        pool = engine.draw(pool_size, dtype=bounds.dtype).to(bounds.device)
+        _sobol_pools[key] = pool
+        if len(_sobol_pools) > _SOBOL_POOL_CACHE_SIZE:
+            _sobol_pools.popitem(last=False)
+    else:
+        _sobol_pools.move_to_end(key)
+    return bounds[0] + (bounds[1] - bounds[0]) * pool
+
+
+def optimize_acqf_sobol_pool(
+    acq_function: "torch.nn.Module",
+    bounds: "torch.Tensor",
+    q: int = 1,
+    pool_size: int = 8192,
+    chunk_size: int = 1024,
+    n_polish: int = 3,
+    polish_maxiter: int = 20,
+) -> Tuple["torch.Tensor", "torch.Tensor"]:
+    """Optimize an acquisition function on a precomputed Sobol pool.
+
+    A cheaper alternative to ``optimize_acqf``. The acquisition function is evaluated on a
+    scrambled Sobol pool in chunks without gradients, and only the ``n_polish`` best points of
+    the pool are refined with a short L-BFGS-B run. The pool is drawn once per dimension and
+    ``pool_size``, kept for the few most recent configurations and rescaled to ``bounds``.
+
+    For ``q > 1`` the candidates are chosen sequentially like ``optimize_acqf`` with
+    ``sequential=True``: each candidate is added to ``X_pending`` of the acquisition function
+    before the next one is chosen, so ``q > 1`` requires an MC acquisition function.
+
+    Args:
+        acq_function:
+            The acquisition function to maximize. It must accept inputs of shape
+            ``(b, 1, n_params)``.
+        bounds:
+            A ``torch.Tensor`` of shape ``(2, n_params)`` with the lower and upper bounds.
+        q:
+            Number of candidates.
+        pool_size:
+            Number of points in the Sobol pool.
+        chunk_size:
+            Number of pool points evaluated at once.
+        n_polish:
+            Number of the best pool points refined by gradient ascent.
+        polish_maxiter:
+            Maximum number of L-BFGS-B iterations of the refinement.
+
+    Returns:
+        A tuple of the candidates of shape ``(q, n_params)`` and their acquisition values of
+        shape ``(q,)``, like ``optimize_acqf``.
+    """
+
+    pool = _get_sobol_pool(bounds, pool_size)
+
+    def optimize_one() -> Tuple["torch.Tensor", "torch.Tensor"]:
+        pool_values = _evaluate_in_chunks(acq_function, pool.unsqueeze(-2), chunk_size)
+        top = pool_values.topk(min(n_polish, pool_size)).indices
+        batch_candidates, batch_acq_values = gen_candidates_scipy(
+            initial_conditions=pool[top].unsqueeze(-2),
+            acquisition_function=acq_function,
+            lower_bounds=bounds[0],
+            upper_bounds=bounds[1],
+            options={"maxiter": polish_maxiter},
+        )
+        best = batch_acq_values.view(-1).argmax()
+        return batch_candidates[best].detach(), batch_acq_values.view(-1)[best].detach()
+
+    return _optimize_sequentially(acq_function, q, optimize_one)
+
+
+def optimize_acqf_with_budget(
+    acq_function: "torch.nn.Module",
+    bounds: "torch.Tensor",
+    budget: AcquisitionBudget,
+    q: int = 1,
+) -> Tuple["torch.Tensor", "torch.Tensor"]:
+    """Multi-start L-BFGS-B optimization of an acquisition function within a time budget.
+
+    Works like ``optimize_acqf`` with ``sequential=True``, but the numbers of raw samples and
+    restarts are taken from ``budget`` and the restarts stop early as described in
+    :class:`AcquisitionBudget`. The budget applies to each of the ``q`` candidates.
+
+    Args:
+        acq_function:
+            The acquisition function to maximize. It must accept inputs of shape
+            ``(b, 1, n_params)``.
+        bounds:
+            A ``torch.Tensor`` of shape ``(2, n_params)`` with the lower and upper bounds.
+        budget:
+            An :class:`AcquisitionBudget`. Its cost estimates are updated by this call.
+        q:
+            Number of candidates.
+
+    Returns:
+        A tuple of the candidates of shape ``(q, n_params)`` and their acquisition values of
+        shape ``(q,)``, like ``optimize_acqf``.
+    """
+
+    def optimize_one() -> Tuple["torch.Tensor", "torch.Tensor"]:
+        start = time.perf_counter()
+        raw_samples, num_restarts = budget.plan(bounds.size(-1))
+
+        X_raw = draw_sobol_samples(bounds=bounds, n=raw_samples, q=1)
+        Y_raw = _evaluate_in_chunks(acq_function, X_raw, 512)
+        budget.record_eval_cost((time.perf_counter() - start) / raw_samples)
+        X_init = X_raw[Y_raw.topk(min(num_restarts, raw_samples)).indices]
+
+        best_x = None
+        best_value = None
+        n_stalled = 0
+        n_run = 0
+        for i in range(0, X_init.size(0), budget.batch_limit):
+            if best_x is not None and time.perf_counter() - start > budget.time_budget:
+                break
+            batch_start = time.perf_counter()
+            batch_x, batch_values = gen_candidates_scipy(
+                initial_conditions=X_init[i : i + budget.batch_limit],
+                acquisition_function=acq_function,
+                lower_bounds=bounds[0],
+                upper_bounds=bounds[1],
+                options={"maxiter": budget.maxiter},
+            )
+            n_run += batch_x.size(0)
+            budget.record_restart_cost((time.perf_counter() - batch_start) / batch_x.size(0))
+
+            batch_values = batch_values.view(-1)
+            j = batch_values.argmax()
+            value = batch_values[j]
+            if (
+                best_value is not None
+                and value - best_value <= budget.rel_tol * best_value.abs().clamp_min(1.0)
+            ):
+                n_stalled += 1
+            else:
+                n_stalled = 0
+            if best_value is None or value > best_value:
+                best_x = batch_x[j]
+                best_value = value
+            if n_stalled >= budget.patience:
+                break
+
+        budget.last_run = {
+            "raw_samples": raw_samples,
+            "num_restarts": num_restarts,
+            "restarts_run": n_run,
+            "duration": time.perf_counter() - start,
+        }
+        return best_x.detach(), best_value.detach()
+
+    return _optimize_sequentially(acq_function, q, optimize_one)
+
+
+def _evaluate_in_chunks(
+    acq_function: "torch.nn.Module", X: "torch.Tensor", chunk_size: int
+) -> "torch.Tensor":
+    with torch.no_grad():
+        return torch.cat(
+            [acq_function(X[start : start + chunk_size]) for start in range(0, X.size(0), chunk_size)]
+        )
+
+
+def _optimize_sequentially(
+    acq_function: "torch.nn.Module",
+    q: int,
+    optimize_one: Callable[[], Tuple["torch.Tensor", "torch.Tensor"]],
+) -> Tuple["torch.Tensor", "torch.Tensor"]:
+    # Greedy sequential batch selection: each chosen candidate becomes a pending point of the
+    # acquisition function before the next one is optimized.
+    base_X_pending = getattr(acq_function, "X_pending", None)
+
+    candidate_list = []
+    acq_value_list = []
+    for i in range(q):
+        if i > 0:
+            acq_function.set_X_pending(
+                torch.cat(candidate_list, dim=-2)
+                if base_X_pending is None
+                else torch.cat([base_X_pending] + candidate_list, dim=-2)
+            )
+        candidate, acq_value = optimize_one()
+        candidate_list.append(candidate)
+        acq_value_list.append(acq_value)
+
+    if q > 1:
+        acq_function.set_X_pending(base_X_pending)
+    return torch.cat(candidate_list, dim=-2), torch.stack(acq_value_list)
+
+
+def _proximal_acqf(
+    acqf: "torch.nn.Module",
+    x_weight_list: list,
+    proximal_anchor: "torch.Tensor",
+    bounds: "torch.Tensor",
+    beta: Optional[float] = None,
+) -> "torch.nn.Module":
+    # `x_weight_list` holds the proximal lengthscales in the normalized search space.
+    proximal_weights = torch.tensor(x_weight_list, dtype=bounds.dtype, device=bounds.device)
+    anchor = normalize(proximal_anchor, bounds=bounds)
+    return proximal.ProximalAcquisitionFunction(acqf, proximal_weights, beta=beta, anchor=anchor)
+
+
+def _optimize_candidates(
+    acq_function: "torch.nn.Module",
+    bounds: "torch.Tensor",
+    q: int,
+    acqf_optimizer: str,
+    num_restarts: int,
+    raw_samples: int,
+    options: Dict[str, Any],
+    acqf_budget: Optional[AcquisitionBudget] = None,
+) -> Tuple["torch.Tensor", "torch.Tensor"]:
+    if acqf_optimizer == "sobol_pool":
+        return optimize_acqf_sobol_pool(acq_function, bounds, q=q)
+    elif acqf_optimizer == "optimize_acqf":
+        if acqf_budget is not None:
+            return optimize_acqf_with_budget(acq_function, bounds, acqf_budget, q=q)
+        return optimize_acqf(
+            acq_function=acq_function,
+            bounds=bounds,
+            q=q,
+            num_restarts=num_restarts,
+            raw_samples=raw_samples,
+            options=options,
+            sequential=True,
+        )
+    raise ValueError(
+        f"acqf_optimizer must be one of {_ACQF_OPTIMIZERS}. Actual: {acqf_optimizer}."
+    )
+
 
 @experimental_func("3.3.0")
 def logei_candidates_func(
@@ -90,6 +1070,13 @@ def logei_candidates_func(
     train_con: Optional["torch.Tensor"],
     bounds: "torch.Tensor",
     pending_x: Optional["torch.Tensor"],
+    model_cache: Optional[GPModelCache] = None,
+    q: int = 1,
+    acqf_optimizer: str = "optimize_acqf",
+    acqf_budget: Optional[AcquisitionBudget] = None,
+    proximal_anchor: Optional["torch.Tensor"] = None,
+    ramp_cost: Optional[RampCost] = None,
+    train_yvar: Optional["torch.Tensor"] = None,
 ) -> "torch.Tensor":
     """Log Expected Improvement (LogEI).
 
@@ -120,6 +1107,45 @@ def logei_candidates_func(
             ``(n_pending, n_params)``. ``n_pending`` is the number of the trials which are already
             suggested all their parameters but have not completed their evaluation, and
             ``n_params`` is identical to that of ``train_x``.
+            If given, the MC-based counterparts of the acquisition functions are used so that
+            the pending configurations are taken into account.
+        model_cache:
+            An optional :class:`GPModelCache`. If given, the GP is taken from the cache, which
+            conditions the previously fitted model on the new observations instead of fitting a
+            new model from scratch.
+        q:
+            Number of candidates to generate jointly. For ``q > 1`` the analytic acquisition
+            functions are replaced by their MC-based batch counterparts (qLogEI, or qEI on
+            botorch <0.9.0, and qUCB) and the candidates are optimized sequentially, each one
+            conditioned on the fantasized outcomes of the previous ones.
+        acqf_optimizer:
+            ``"optimize_acqf"`` runs BoTorch's multi-start L-BFGS-B. ``"sobol_pool"`` uses
+            :func:`optimize_acqf_sobol_pool`, which is much faster at a small loss of
+            acquisition value.
+        acqf_budget:
+            An optional :class:`AcquisitionBudget`. If given, the multi-start optimization
+            of ``"optimize_acqf"`` is sized to its time budget by
+            :func:`optimize_acqf_with_budget` instead of using fixed numbers of restarts and
+            raw samples.
+        proximal_anchor:
+            The current setpoint of the machine, a ``torch.Tensor`` of shape ``(n_params,)``
+            in the same space as ``train_x``. If given, the acquisition function is wrapped in
+            :class:`proximal.ProximalAcquisitionFunction` with ``x_weight_list`` as the
+            lengthscales, so that candidates far from the setpoint are penalized. UCB values
+            are first passed through a softplus on the scale of ``train_obj``, since they can
+            be negative.
+        ramp_cost:
+            An optional :class:`ramp_cost.RampCost` from the current setpoint. If given, the
+            acquisition function is divided by the predicted time of ramping the magnets to
+            the candidate and measuring it (:class:`ramp_cost.CostAwareAcquisitionFunction`),
+            so that the improvement per second is maximized. Ignored with UCB, whose values
+            can be negative.
+        train_yvar:
+            Observation noise variances. A ``torch.Tensor`` of shape
+            ``(n_trials, n_objectives + n_constraints)`` whose columns follow ``train_obj`` and
+            then ``train_con``, e.g. estimated from repeated measurements of each trial. If
+            given, the GP uses them as fixed per-observation noise instead of inferring a
+            single noise level, so that noisy regions do not blur the whole model.
 
     Returns:
         Next set of candidates. Usually the return value of BoTorch's ``optimize_acqf``.
@@ -146,18 +1172,42 @@ def logei_candidates_func(
         best_f = train_obj.max()
 
     train_x = normalize(train_x, bounds=bounds)
+    if pending_x is not None and pending_x.size(0) == 0:
+        pending_x = None
+    if pending_x is not None:
+        pending_x = normalize(pending_x, bounds=bounds)
 
-    model = SingleTaskGP(
-        train_x, train_y, outcome_transform=Standardize(m=train_y.size(-1))
-    )
-    mll = ExactMarginalLogLikelihood(model.likelihood, model)
-    fit_gpytorch_mll(mll)
+    model = _get_fitted_model(train_x, train_y, model_cache, train_yvar)
 
     Hitohude_lib = {}  # 一筆書きの可否を決める辞書を作成
 
-    acqf_logEI = LogExpectedImprovement(model=model, best_f=best_f)
+    if q == 1 and pending_x is None:
+        acqf_logEI = LogExpectedImprovement(model=model, best_f=best_f)
+
+        acqf_UCB = UpperConfidenceBound(model=model, beta=beta)
+    else:
+        # 解析的な獲得関数はq=1で測定中の点がない場合しか扱えないのでMC版を使う
+        if _imports_qlogei.is_successful():
+            acqf_logEI = qLogExpectedImprovement(
+                model=model,
+                best_f=best_f,
+                sampler=_get_sobol_qmc_normal_sampler(256),
+                X_pending=pending_x,
+            )
+        else:
+            acqf_logEI = qExpectedImprovement(
+                model=model,
+                best_f=best_f,
+                sampler=_get_sobol_qmc_normal_sampler(256),
+                X_pending=pending_x,
+            )
 
-    acqf_UCB = UpperConfidenceBound(model=model, beta=beta)
+        acqf_UCB = qUpperConfidenceBound(
+            model=model,
+            beta=beta,
+            sampler=_get_sobol_qmc_normal_sampler(256),
+            X_pending=pending_x,
+        )
     #print(beta)
 
     if UCB == True:
@@ -171,10 +1221,6 @@ def logei_candidates_func(
 
     Hitohude_lib["No_Hitohude"] = acqf  # 辞書にそのままの獲得関数を追加
 
-    proximal_weights_modified = torch.ones(len(x_name_list))
-
-    proximal_weights = torch.tensor(x_weight_list)
-
     # proximal_weights_modifiedはボツにした関数
     #for i in range(len(x_name_list)):
     #    proximal_weights_modified[i] = max(
@@ -189,23 +1235,33 @@ def logei_candidates_func(
     #    )  # 壁に寄ったらsigmaを大きくするように変更
     
     
-    acqf_proximal = proximal.ProximalAcquisitionFunction(acqf, proximal_weights,UCB,logEI)
-    
-    # acqf_proximal = proximal.ProximalAcquisitionFunction(acqf, proximal_weights_modified) #ガウス関数をかけている
+    if proximal_anchor is not None:
+        # UCBは負の値をとるので，目的関数のスケールのsoftplusで正にしてから重みをかける
+        proximal_beta = None
+        if UCB:
+            scale = train_obj.std().item() if train_obj.size(0) > 1 else 0.0
+            proximal_beta = 1.0 / scale if scale > 0 else 1.0
+        acqf = _proximal_acqf(acqf, x_weight_list, proximal_anchor, bounds, proximal_beta)
+        # acqf_proximal = proximal.ProximalAcquisitionFunction(acqf, proximal_weights_modified) #ガウス関数をかけている
+
+        Hitohude_lib["Yes_Hitohude"] = acqf  # 辞書に一筆書きの獲得関数を追加
 
-    Hitohude_lib["Yes_Hitohude"] = acqf_proximal  # 辞書に一筆書きの獲得関数を追加
+    # UCBは負の値をとるので時間で割れない
+    if ramp_cost is not None and not UCB:
+        acqf = CostAwareAcquisitionFunction(acqf, ramp_cost, bounds)
 
     standard_bounds = torch.zeros_like(bounds)
     standard_bounds[1] = 1
     #print("a")
-    candidates, _ = optimize_acqf(
-        acq_function=acqf,
-        bounds=standard_bounds,
-        q=1,
+    candidates, _ = _optimize_candidates(
+        acqf,
+        standard_bounds,
+        q,
+        acqf_optimizer,
         num_restarts=10,
         raw_samples=512,
         options={"batch_limit": 5, "maxiter": 200},
-        sequential=True,
+        acqf_budget=acqf_budget,
     )
     #print("b")
     candidates = unnormalize(candidates.detach(), bounds=bounds)
@@ -225,6 +1281,13 @@ def qei_candidates_func(
     train_con: Optional["torch.Tensor"],
     bounds: "torch.Tensor",
     pending_x: Optional["torch.Tensor"],
+    model_cache: Optional[GPModelCache] = None,
+    q: int = 1,
+    acqf_optimizer: str = "optimize_acqf",
+    acqf_budget: Optional[AcquisitionBudget] = None,
+    proximal_anchor: Optional["torch.Tensor"] = None,
+    ramp_cost: Optional[RampCost] = None,
+    train_yvar: Optional["torch.Tensor"] = None,
 ) -> "torch.Tensor":
     """Quasi MC-based batch Expected Improvement (qEI).
 
@@ -257,6 +1320,20 @@ def qei_candidates_func(
             ``(n_pending, n_params)``. ``n_pending`` is the number of the trials which are already
             suggested all their parameters but have not completed their evaluation, and
             ``n_params`` is identical to that of ``train_x``.
+        model_cache:
+            An optional :class:`GPModelCache` that provides the fitted GP.
+        q:
+            Number of candidates to generate jointly.
+        acqf_optimizer:
+            ``"optimize_acqf"`` or ``"sobol_pool"``. See :func:`logei_candidates_func`.
+        acqf_budget:
+            An optional :class:`AcquisitionBudget`. See :func:`logei_candidates_func`.
+        proximal_anchor:
+            The current setpoint of the machine. See :func:`logei_candidates_func`.
+        ramp_cost:
+            The cost of moving from the current setpoint. See :func:`logei_candidates_func`.
+        train_yvar:
+            Observation noise variances. See :func:`logei_candidates_func`.
     Returns:
         Next set of candidates. Usually the return value of BoTorch's ``optimize_acqf``.
 
@@ -282,7 +1359,7 @@ def qei_candidates_func(
 
         n_constraints = train_con.size(1)
         objective = ConstrainedMCObjective(
-            objective=lambda Z: Z[..., 0],
+            objective=lambda Z, X=None: Z[..., 0],
             constraints=[
                 (lambda Z, i=i: Z[..., -n_constraints + i])
                 for i in range(n_constraints)
@@ -299,11 +1376,7 @@ def qei_candidates_func(
     if pending_x is not None:
         pending_x = normalize(pending_x, bounds=bounds)
 
-    model = SingleTaskGP(
-        train_x, train_y, outcome_transform=Standardize(m=train_y.size(-1))
-    )
-    mll = ExactMarginalLogLikelihood(model.likelihood, model)
-    fit_gpytorch_mll(mll)
+    model = _get_fitted_model(train_x, train_y, model_cache, train_yvar)
 
     acqf = qExpectedImprovement(
         model=model,
@@ -313,17 +1386,23 @@ def qei_candidates_func(
         X_pending=pending_x,
     )
 
+    if proximal_anchor is not None:
+        acqf = _proximal_acqf(acqf, x_weight_list, proximal_anchor, bounds)
+    if ramp_cost is not None:
+        acqf = CostAwareAcquisitionFunction(acqf, ramp_cost, bounds)
+
     standard_bounds = torch.zeros_like(bounds)
     standard_bounds[1] = 1
 
-    candidates, _ = optimize_acqf(
-        acq_function=acqf,
-        bounds=standard_bounds,
-        q=1,
+    candidates, _ = _optimize_candidates(
+        acqf,
+        standard_bounds,
+        q,
+        acqf_optimizer,
         num_restarts=10,
         raw_samples=512,
         options={"batch_limit": 5, "maxiter": 200},
-        sequential=True,
+        acqf_budget=acqf_budget,
     )
 
     candidates = unnormalize(candidates.detach(), bounds=bounds)
@@ -333,12 +1412,22 @@ def qei_candidates_func(
 
 @experimental_func("3.3.0")
 def qnei_candidates_func(
+    x_name_list: list,
+    x_min_max_list: list,
+    x_weight_list: list,
+    UCB: bool,
+    logEI: bool,
     beta: float,
     train_x: "torch.Tensor",
     train_obj: "torch.Tensor",
     train_con: Optional["torch.Tensor"],
     bounds: "torch.Tensor",
     pending_x: Optional["torch.Tensor"],
+    q: int = 1,
+    acqf_optimizer: str = "optimize_acqf",
+    acqf_budget: Optional[AcquisitionBudget] = None,
+    proximal_anchor: Optional["torch.Tensor"] = None,
+    ramp_cost: Optional[RampCost] = None,
 ) -> "torch.Tensor":
     """Quasi MC-based batch Noisy Expected Improvement (qNEI).
 
@@ -385,17 +1474,23 @@ def qnei_candidates_func(
         X_pending=pending_x,
     )
 
+    if proximal_anchor is not None:
+        acqf = _proximal_acqf(acqf, x_weight_list, proximal_anchor, bounds)
+    if ramp_cost is not None:
+        acqf = CostAwareAcquisitionFunction(acqf, ramp_cost, bounds)
+
     standard_bounds = torch.zeros_like(bounds)
     standard_bounds[1] = 1
 
-    candidates, _ = optimize_acqf(
-        acq_function=acqf,
-        bounds=standard_bounds,
-        q=1,
+    candidates, _ = _optimize_candidates(
+        acqf,
+        standard_bounds,
+        q,
+        acqf_optimizer,
         num_restarts=10,
         raw_samples=512,
         options={"batch_limit": 5, "maxiter": 200},
-        sequential=True,
+        acqf_budget=acqf_budget,
     )
 
     candidates = unnormalize(candidates.detach(), bounds=bounds)
@@ -405,18 +1500,32 @@ def qnei_candidates_func(
 
 @experimental_func("2.4.0")
 def qehvi_candidates_func(
+    x_name_list: list,
+    x_min_max_list: list,
+    x_weight_list: list,
+    UCB: bool,
+    logEI: bool,
     beta: float,
     train_x: "torch.Tensor",
     train_obj: "torch.Tensor",
     train_con: Optional["torch.Tensor"],
     bounds: "torch.Tensor",
     pending_x: Optional["torch.Tensor"],
+    q: int = 1,
+    acqf_optimizer: str = "optimize_acqf",
+    acqf_budget: Optional[AcquisitionBudget] = None,
+    proximal_anchor: Optional["torch.Tensor"] = None,
+    ramp_cost: Optional[RampCost] = None,
+    pareto_cache: Optional[ParetoCache] = None,
 ) -> "torch.Tensor":
     """Quasi MC-based batch Expected Hypervolume Improvement (qEHVI).
 
     The default value of ``candidates_func`` in :class:`~optuna.integration.BoTorchSampler`
     with multi-objective optimization when the number of objectives is three or less.
 
+    If ``pareto_cache`` is given, the reference point and the box decomposition are taken
+    from it instead of being recomputed from all observations (see :class:`ParetoCache`).
+
     .. seealso::
         :func:`~optuna.integration.botorch.qei_candidates_func` for argument and return value
         descriptions.
@@ -428,7 +1537,6 @@ def qehvi_candidates_func(
         train_y = torch.cat([train_obj, train_con], dim=-1)
 
         is_feas = (train_con <= 0).all(dim=-1)
-        train_obj_feas = train_obj[is_feas]
 
         n_constraints = train_con.size(1)
         additional_qehvi_kwargs = {
@@ -443,7 +1551,7 @@ def qehvi_candidates_func(
     else:
         train_y = train_obj
 
-        train_obj_feas = train_obj
+        is_feas = torch.ones(train_obj.size(0), dtype=torch.bool, device=train_obj.device)
 
         additional_qehvi_kwargs = {}
 
@@ -457,18 +1565,21 @@ def qehvi_candidates_func(
     mll = ExactMarginalLogLikelihood(model.likelihood, model)
     fit_gpytorch_mll(mll)
 
-    # Approximate box decomposition similar to Ax when the number of objectives is large.
-    # https://github.com/facebook/Ax/blob/master/ax/models/torch/botorch_moo_defaults
-    if n_objectives > 2:
-        alpha = 10 ** (-8 + n_objectives)
+    if pareto_cache is not None:
+        ref_point, partitioning = pareto_cache.get_partitioning(train_obj, is_feas)
     else:
-        alpha = 0.0
+        # Approximate box decomposition similar to Ax when the number of objectives is large.
+        # https://github.com/facebook/Ax/blob/master/ax/models/torch/botorch_moo_defaults
+        if n_objectives > 2:
+            alpha = 10 ** (-8 + n_objectives)
+        else:
+            alpha = 0.0
 
-    ref_point = train_obj.min(dim=0).values - 1e-8
+        ref_point = train_obj.min(dim=0).values - 1e-8
 
-    partitioning = NondominatedPartitioning(
-        ref_point=ref_point, Y=train_obj_feas, alpha=alpha
-    )
+        partitioning = NondominatedPartitioning(
+            ref_point=ref_point, Y=train_obj[is_feas], alpha=alpha
+        )
 
     ref_point_list = ref_point.tolist()
 
@@ -480,17 +1591,24 @@ def qehvi_candidates_func(
         X_pending=pending_x,
         **additional_qehvi_kwargs,
     )
+
+    if proximal_anchor is not None:
+        acqf = _proximal_acqf(acqf, x_weight_list, proximal_anchor, bounds)
+    if ramp_cost is not None:
+        acqf = CostAwareAcquisitionFunction(acqf, ramp_cost, bounds)
+
     standard_bounds = torch.zeros_like(bounds)
     standard_bounds[1] = 1
 
-    candidates, _ = optimize_acqf(
-        acq_function=acqf,
-        bounds=standard_bounds,
-        q=1,
+    candidates, _ = _optimize_candidates(
+        acqf,
+        standard_bounds,
+        q,
+        acqf_optimizer,
         num_restarts=20,
         raw_samples=1024,
         options={"batch_limit": 5, "maxiter": 200, "nonnegative": True},
-        sequential=True,
+        acqf_budget=acqf_budget,
     )
 
     candidates = unnormalize(candidates.detach(), bounds=bounds)
@@ -500,12 +1618,22 @@ def qehvi_candidates_func(
 
 @experimental_func("3.1.0")
 def qnehvi_candidates_func(
+    x_name_list: list,
+    x_min_max_list: list,
+    x_weight_list: list,
+    UCB: bool,
+    logEI: bool,
     beta: float,
     train_x: "torch.Tensor",
     train_obj: "torch.Tensor",
     train_con: Optional["torch.Tensor"],
     bounds: "torch.Tensor",
     pending_x: Optional["torch.Tensor"],
+    q: int = 1,
+    acqf_optimizer: str = "optimize_acqf",
+    acqf_budget: Optional[AcquisitionBudget] = None,
+    proximal_anchor: Optional["torch.Tensor"] = None,
+    ramp_cost: Optional[RampCost] = None,
 ) -> "torch.Tensor":
     """Quasi MC-based batch Noisy Expected Hypervolume Improvement (qNEHVI).
 
@@ -572,17 +1700,23 @@ def qnehvi_candidates_func(
         **additional_qnehvi_kwargs,
     )
 
+    if proximal_anchor is not None:
+        acqf = _proximal_acqf(acqf, x_weight_list, proximal_anchor, bounds)
+    if ramp_cost is not None:
+        acqf = CostAwareAcquisitionFunction(acqf, ramp_cost, bounds)
+
     standard_bounds = torch.zeros_like(bounds)
     standard_bounds[1] = 1
 
-    candidates, _ = optimize_acqf(
-        acq_function=acqf,
-        bounds=standard_bounds,
-        q=1,
+    candidates, _ = _optimize_candidates(
+        acqf,
+        standard_bounds,
+        q,
+        acqf_optimizer,
         num_restarts=20,
         raw_samples=1024,
         options={"batch_limit": 5, "maxiter": 200, "nonnegative": True},
-        sequential=True,
+        acqf_budget=acqf_budget,
     )
 
     candidates = unnormalize(candidates.detach(), bounds=bounds)
@@ -592,79 +1726,117 @@ def qnehvi_candidates_func(
 
 @experimental_func("2.4.0")
 def qparego_candidates_func(
+    x_name_list: list,
+    x_min_max_list: list,
+    x_weight_list: list,
+    UCB: bool,
+    logEI: bool,
     beta: float,
     train_x: "torch.Tensor",
     train_obj: "torch.Tensor",
     train_con: Optional["torch.Tensor"],
     bounds: "torch.Tensor",
     pending_x: Optional["torch.Tensor"],
+    model_cache: Optional[GPModelCache] = None,
+    q: int = 1,
+    acqf_optimizer: str = "optimize_acqf",
+    acqf_budget: Optional[AcquisitionBudget] = None,
+    proximal_anchor: Optional["torch.Tensor"] = None,
+    ramp_cost: Optional[RampCost] = None,
+    train_yvar: Optional["torch.Tensor"] = None,
 ) -> "torch.Tensor":
     """Quasi MC-based extended ParEGO (qParEGO) for constrained multi-objective optimization.
 
     The default value of ``candidates_func`` in :class:`~optuna.integration.BoTorchSampler`
     with multi-objective optimization when the number of objectives is larger than three.
 
+    One GP is fitted on all objectives and constraints, and only the random Chebyshev
+    scalarization is drawn anew. With ``model_cache`` the GP is kept across trials, so a trial
+    costs one scalarization and one acquisition optimization. With ``q > 1`` each candidate
+    gets its own weight vector and the previous candidates are treated as pending, so one fit
+    yields candidates spread over the Pareto front.
+
     .. seealso::
-        :func:`~optuna.integration.botorch.qei_candidates_func` for argument and return value
-        descriptions.
+        :func:`qei_candidates_func` for argument and return value descriptions.
     """
 
     n_objectives = train_obj.size(-1)
 
-    weights = sample_simplex(n_objectives).squeeze()
-    scalarization = get_chebyshev_scalarization(weights=weights, Y=train_obj)
-
     if train_con is not None:
         train_y = torch.cat([train_obj, train_con], dim=-1)
         n_constraints = train_con.size(1)
-        objective = ConstrainedMCObjective(
-            objective=lambda Z: scalarization(Z[..., :n_objectives]),
-            constraints=[
-                (lambda Z, i=i: Z[..., -n_constraints + i])
-                for i in range(n_constraints)
-            ],
-        )
     else:
         train_y = train_obj
 
-        objective = GenericMCObjective(scalarization)
-
     train_x = normalize(train_x, bounds=bounds)
     if pending_x is not None:
         pending_x = normalize(pending_x, bounds=bounds)
 
-    model = SingleTaskGP(
-        train_x, train_y, outcome_transform=Standardize(m=train_y.size(-1))
-    )
-    mll = ExactMarginalLogLikelihood(model.likelihood, model)
-    fit_gpytorch_mll(mll)
-
-    acqf = qExpectedImprovement(
-        model=model,
-        best_f=objective(train_y).max(),
-        sampler=_get_sobol_qmc_normal_sampler(256),
-        objective=objective,
-        X_pending=pending_x,
-    )
+    model = _get_fitted_model(train_x, train_y, model_cache, train_yvar)
 
     standard_bounds = torch.zeros_like(bounds)
     standard_bounds[1] = 1
 
-    candidates, _ = optimize_acqf(
-        acq_function=acqf,
-        bounds=standard_bounds,
-        q=1,
-        num_restarts=20,
-        raw_samples=1024,
-        options={"batch_limit": 5, "maxiter": 200},
-        sequential=True,
-    )
+    candidates_list = []
+    for _ in range(q):
+        weights = sample_simplex(n_objectives, dtype=train_obj.dtype).squeeze()
+        scalarization = get_chebyshev_scalarization(weights=weights, Y=train_obj)
+
+        if train_con is not None:
+            objective = ConstrainedMCObjective(
+                objective=lambda Z, X=None, scalarization=scalarization: scalarization(
+                    Z[..., :n_objectives]
+                ),
+                constraints=[
+                    (lambda Z, i=i: Z[..., -n_constraints + i])
+                    for i in range(n_constraints)
+                ],
+            )
+        else:
+            objective = GenericMCObjective(scalarization)
+
+        acqf = qExpectedImprovement(
+            model=model,
+            best_f=objective(train_y).max(),
+            sampler=_get_sobol_qmc_normal_sampler(256),
+            objective=objective,
+            X_pending=pending_x,
+        )
 
-    candidates = unnormalize(candidates.detach(), bounds=bounds)
+        if proximal_anchor is not None:
+            acqf = _proximal_acqf(acqf, x_weight_list, proximal_anchor, bounds)
+        if ramp_cost is not None:
+            acqf = CostAwareAcquisitionFunction(acqf, ramp_cost, bounds)
+
+        candidate, _ = _optimize_candidates(
+            acqf,
+            standard_bounds,
+            1,
+            acqf_optimizer,
+            num_restarts=20,
+            raw_samples=1024,
+            options={"batch_limit": 5, "maxiter": 200},
+            acqf_budget=acqf_budget,
+        )
+        candidate = candidate.detach()
+        candidates_list.append(candidate)
+        pending_x = candidate if pending_x is None else torch.cat([pending_x, candidate])
+
+    candidates = unnormalize(torch.cat(candidates_list), bounds=bounds)
 
     return candidates
 
 
+_BUILTIN_CANDIDATES_FUNCS = (
+    logei_candidates_func,
+    qei_candidates_func,
+    qnei_candidates_func,
+    qehvi_candidates_func,
+    qnehvi_candidates_func,
+    qparego_candidates_func,
+)
+
+
 def _get_default_candidates_func(
     n_objectives: int,
     has_constraint: bool,
@@ -683,12 +1855,445 @@ def _get_default_candidates_func(
         return qparego_candidates_func
     elif n_objectives > 1:
         return qehvi_candidates_func
-    elif has_constraint or consider_running_trials:
+    elif has_constraint:
         return qei_candidates_func
     else:
         return logei_candidates_func
 
 
+class TrustRegionPolicy:
+    """Settings of the trust-region (TuRBO) mode of :class:`HitohudebayesSampler`.
+
+    Each trust region is a hyperrectangle in the normalized search space centered on the best
+    point found in it. Its side lengths are ``length`` scaled by the lengthscales of the local
+    GP. A region doubles its length after ``success_tolerance`` consecutive improvements,
+    halves it after ``failure_tolerance`` consecutive failures, and restarts from
+    ``length_init`` around the global incumbent once it shrinks below ``length_min``.
+
+    Args:
+        n_regions:
+            Number of trust regions. The regions take turns in proposing candidates.
+        length_init:
+            Initial side length in the normalized search space.
+        length_min:
+            A region restarts when its side length drops below this value.
+        length_max:
+            Upper bound of the side length.
+        success_tolerance:
+            Number of consecutive improvements after which the region expands.
+        failure_tolerance:
+            Number of consecutive failures after which the region shrinks. Defaults to
+            ``max(4, n_params)``.
+        min_local_points:
+            Minimum number of points used to fit the local GP. If fewer points lie inside the
+            region, the nearest points outside it are added.
+        max_local_points:
+            Maximum number of points used to fit the local GP. The points nearest to the center
+            are kept, which bounds the cost per suggestion regardless of the study length.
+    """
+
+    def __init__(
+        self,
+        n_regions: int = 1,
+        length_init: float = 0.8,
+        length_min: float = 0.5**7,
+        length_max: float = 1.6,
+        success_tolerance: int = 3,
+        failure_tolerance: Optional[int] = None,
+        min_local_points: int = 10,
+        max_local_points: int = 200,
+    ) -> None:
+        self.n_regions = n_regions
+        self.length_init = length_init
+        self.length_min = length_min
+        self.length_max = length_max
+        self.success_tolerance = success_tolerance
+        self.failure_tolerance = failure_tolerance
+        self.min_local_points = min_local_points
+        self.max_local_points = max_local_points
+
+
+class _TrustRegion:
+    def __init__(self, center: numpy.ndarray, best_value: float, length: float) -> None:
+        self.center = center
+        self.best_value = best_value
+        self.length = length
+        self.n_success = 0
+        self.n_failure = 0
+        self.half_width = numpy.full_like(center, length / 2)
+        # Center and length for which `half_width` was last shaped by the lengthscales.
+        self.shaped_for: Optional[Tuple[bytes, float]] = None
+        # Local training rows of the last ask and the number of buffer rows at that time.
+        self.rows: Optional[numpy.ndarray] = None
+        self.n_rows_seen = 0
+
+    def contains(self, x: numpy.ndarray) -> bool:
+        return bool((numpy.abs(x - self.center) <= self.half_width).all())
+
+
+class _TrustRegions:
+    """Trust-region states, updated from the rows of a :class:`_TrialBuffer`.
+
+    All coordinates are in the normalized search space ``[0, 1]^n_params``.
+    """
+
+    def __init__(self, policy: TrustRegionPolicy, model_cache_factory: Callable[[], Any]) -> None:
+        self._policy = policy
+        self._model_cache_factory = model_cache_factory
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget the regions, e.g. when the rows of the trial buffer are rebuilt."""
+        self.regions: List[_TrustRegion] = []
+        self.model_caches: List[Any] = []
+        self._region_of_trial: Dict[int, int] = {}
+        self._n_seen = 0
+        self._turn = 0
+
+    def assign(self, trial_id: int, index: int) -> None:
+        self._region_of_trial[trial_id] = index
+
+    def next_region(
+        self,
+        x: numpy.ndarray,
+        y: numpy.ndarray,
+        trial_ids: Sequence[int],
+        lengthscale_of: Callable[[Any], Optional[numpy.ndarray]],
+    ) -> Tuple[int, numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        """Update the regions with new rows and return the region that proposes next.
+
+        Args:
+            x:
+                Normalized parameters of all completed trials, ``(n_trials, n_params)``.
+            y:
+                Objective values of all completed trials (to be maximized), ``(n_trials,)``.
+            trial_ids:
+                Trial ids of the rows.
+            lengthscale_of:
+                Returns the lengthscales of a model, or :obj:`None`.
+
+        Returns:
+            The index of the region, the rows of its local training data, and its lower and
+            upper bounds in the normalized search space.
+        """
+
+        if not self.regions:
+            self._initialize(x, y)
+        self._observe(x, y, trial_ids)
+
+        index = self._turn % len(self.regions)
+        self._turn += 1
+        region = self.regions[index]
+
+        # The shape is only updated when the region moves or is resized. Reshaping it after
+        # every refit would change the local data, and with it the normalization of the local
+        # GP, on every ask, so that the cached model could never be conditioned on new rows.
+        shaped_for = (region.center.tobytes(), region.length)
+        reshaped = region.shaped_for != shaped_for
+        if reshaped:
+            weights = numpy.ones_like(region.center)
+            cache = self.model_caches[index]
+            lengthscale = None if cache is None else lengthscale_of(cache.model)
+            if lengthscale is not None and lengthscale.shape == weights.shape:
+                # TuRBO: stretch the region along directions in which the objective varies
+                # slowly.
+                weights = lengthscale / numpy.exp(numpy.log(lengthscale).mean())
+            region.half_width = weights * region.length / 2
+            region.shaped_for = shaped_for
+        lower = numpy.clip(region.center - region.half_width, 0.0, 1.0)
+        upper = numpy.clip(region.center + region.half_width, 0.0, 1.0)
+
+        distance = (numpy.abs(x - region.center) / region.half_width).max(axis=1)
+        # Candidates on the boundary come back slightly outside from the search space transform.
+        inside = distance <= 1.0 + 1e-6
+        rows = None
+        if not reshaped and region.rows is not None and len(x) >= region.n_rows_seen:
+            # While the region keeps its shape, the new rows inside it are appended to the
+            # previous local data, so that the cached model is only conditioned on them instead
+            # of being refitted.
+            new_rows = numpy.arange(region.n_rows_seen, len(x))
+            rows = numpy.concatenate([region.rows, new_rows[inside[new_rows]]])
+            if len(rows) > self._policy.max_local_points:
+                rows = None
+        if rows is None:
+            # Points inside the region, topped up or cut down to the nearest ones to the
+            # center, in buffer order.
+            n_inside = int(inside.sum())
+            n_local = min(
+                max(n_inside, self._policy.min_local_points),
+                self._policy.max_local_points,
+                len(x),
+            )
+            rows = numpy.sort(numpy.argsort(distance, kind="stable")[:n_local])
+        region.rows = rows
+        region.n_rows_seen = len(x)
+        return index, rows, lower, upper
+
+    def _initialize(self, x: numpy.ndarray, y: numpy.ndarray) -> None:
+        order = numpy.argsort(-y, kind="stable")
+        for i in range(self._policy.n_regions):
+            row = order[i % len(order)]
+            self.regions.append(_TrustRegion(x[row].copy(), float(y[row]), self._policy.length_init))
+            self.model_caches.append(self._model_cache_factory())
+        self._n_seen = len(y)
+
+    def _observe(self, x: numpy.ndarray, y: numpy.ndarray, trial_ids: Sequence[int]) -> None:
+        policy = self._policy
+        failure_tolerance = policy.failure_tolerance or max(4, x.shape[1])
+        for row in range(self._n_seen, len(y)):
+            value = float(y[row])
+            index = self._region_of_trial.pop(trial_ids[row], None)
+            if index is None:
+                # Enqueued or independently sampled trials only move the regions they fall in.
+                for region in self.regions:
+                    if value > region.best_value and region.contains(x[row]):
+                        region.center = x[row].copy()
+                        region.best_value = value
+                continue
+
+            region = self.regions[index]
+            if value > region.best_value + 1e-3 * abs(region.best_value):
+                region.n_success += 1
+                region.n_failure = 0
+            else:
+                region.n_success = 0
+                region.n_failure += 1
+            if value > region.best_value:
+                region.center = x[row].copy()
+                region.best_value = value
+
+            if region.n_success >= policy.success_tolerance:
+                region.length = min(2.0 * region.length, policy.length_max)
+                region.n_success = 0
+            elif region.n_failure >= failure_tolerance:
+                region.length /= 2.0
+                region.n_failure = 0
+            if region.length < policy.length_min:
+                best = int(numpy.argmax(y[: row + 1]))
+                self.regions[index] = _TrustRegion(
+                    x[best].copy(), float(y[best]), policy.length_init
+                )
+        self._n_seen = len(y)
+
+
+def _get_lengthscales(model: Any) -> Optional[numpy.ndarray]:
+    """Lengthscales of every output of ``model``, of shape ``(n_outputs, n_params)``.
+
+    Handles batched multi-output models, the :class:`~botorch.models.ModelListGP` of the
+    ``fit_workers`` option, with one row per sub-model, and the shared data kernel of a
+    :class:`~botorch.models.KroneckerMultiTaskGP`, with a single row. Returns None if some
+    output has no lengthscale.
+    """
+
+    models = getattr(model, "models", None)
+    if models is not None:
+        rows = [_get_lengthscales(m) for m in models]
+        if len(rows) == 0 or any(r is None for r in rows):
+            return None
+        return numpy.concatenate(rows)
+    covar_module = getattr(model, "covar_module", None)
+    covar_module = getattr(covar_module, "data_covar_module", covar_module)
+    kernel = getattr(covar_module, "base_kernel", covar_module)
+    lengthscale = getattr(kernel, "lengthscale", None)
+    if lengthscale is None:
+        return None
+    lengthscale = lengthscale.detach().cpu().numpy()
+    return lengthscale.reshape(-1, lengthscale.shape[-1])
+
+
+def _get_lengthscale(model: Any) -> Optional[numpy.ndarray]:
+    lengthscales = _get_lengthscales(model)
+    if lengthscales is None:
+        return None
+    # Average over the outputs of a multi-output model.
+    return lengthscales.mean(axis=0)
+
+
+class _TrialBuffer:
+    """Append-only storage of the completed trials in the transformed search space.
+
+    Each completed trial is transformed, signed for maximization and has its constraints read
+    from the storage exactly once. Later asks only ingest the trials that finished since the
+    previous one, so the cost of assembling the training data no longer grows with the number of
+    trials. Rows are kept in ingestion order, which makes the training data of consecutive asks
+    extensions of each other.
+    """
+
+    def __init__(
+        self,
+        search_space: Dict[str, BaseDistribution],
+        directions: Sequence[StudyDirection],
+        capacity: int = 64,
+    ) -> None:
+        self.search_space = search_space
+        self.trans = _SearchSpaceTransform(search_space)
+        self._signs = numpy.array(
+            [-1.0 if d == StudyDirection.MINIMIZE else 1.0 for d in directions]
+        )
+
+        self._params = numpy.empty((capacity, self.trans.bounds.shape[0]), dtype=numpy.float64)
+        self._values = numpy.empty((capacity, len(directions)), dtype=numpy.float64)
+        self._con: Optional[numpy.ndarray] = None
+        self._yvar: Optional[numpy.ndarray] = None
+        self._row_of_trial: Dict[int, int] = {}
+        self.trial_ids: List[int] = []
+        self._n = 0
+
+    @property
+    def params(self) -> numpy.ndarray:
+        return self._params[: self._n]
+
+    @property
+    def values(self) -> numpy.ndarray:
+        return self._values[: self._n]
+
+    @property
+    def constraints(self) -> Optional[numpy.ndarray]:
+        return None if self._con is None else self._con[: self._n]
+
+    @property
+    def noise(self) -> Optional[numpy.ndarray]:
+        return None if self._yvar is None else self._yvar[: self._n]
+
+    def ingest(
+        self,
+        study: Study,
+        completed_trials: Sequence[FrozenTrial],
+        read_constraints: bool,
+        read_noise: bool = False,
+    ) -> None:
+        if len(completed_trials) == self._n:
+            # Completed trials are never removed, so nothing has finished since the last call.
+            return
+
+        for trial in completed_trials:
+            if trial._trial_id in self._row_of_trial:
+                continue
+            assert len(self._signs) == len(trial.values)
+            constraints = None
+            noise = None
+            if read_constraints or read_noise:
+                system_attrs = study._storage.get_trial_system_attrs(trial._trial_id)
+                if read_constraints:
+                    constraints = system_attrs.get(_CONSTRAINTS_KEY)
+                if read_noise:
+                    noise = system_attrs.get(_NOISE_KEY)
+            self._append(
+                trial._trial_id,
+                self.trans.transform(trial.params),
+                self._signs * numpy.asarray(trial.values, dtype=numpy.float64),
+                constraints,
+                noise,
+            )
+
+    def _append(
+        self,
+        trial_id: int,
+        params: numpy.ndarray,
+        values: numpy.ndarray,
+        constraints: Optional[Sequence[float]],
+        noise: Optional[Sequence[float]] = None,
+    ) -> None:
+        if self._n == self._params.shape[0]:
+            self._grow()
+
+        row = self._n
+        self._params[row] = params
+        self._values[row] = values  # BoTorch always assumes maximization.
+        if constraints is not None:
+            n_constraints = len(constraints)
+            if self._con is None:
+                self._con = numpy.full(
+                    (self._params.shape[0], n_constraints), numpy.nan, dtype=numpy.float64
+                )
+            elif n_constraints != self._con.shape[1]:
+                raise RuntimeError(
+                    f"Expected {self._con.shape[1]} constraints "
+                    f"but received {n_constraints}."
+                )
+            self._con[row] = constraints
+        if noise is not None:
+            if self._yvar is None:
+                self._yvar = numpy.full(
+                    (self._params.shape[0], len(noise)), numpy.nan, dtype=numpy.float64
+                )
+            elif len(noise) != self._yvar.shape[1]:
+                raise RuntimeError(
+                    f"Expected {self._yvar.shape[1]} noise variances "
+                    f"but received {len(noise)}."
+                )
+            self._yvar[row] = noise
+
+        self._row_of_trial[trial_id] = row
+        self.trial_ids.append(trial_id)
+        self._n += 1
+
+    def _grow(self) -> None:
+        capacity = 2 * self._params.shape[0]
+        self._params = numpy.resize(self._params, (capacity, self._params.shape[1]))
+        self._values = numpy.resize(self._values, (capacity, self._values.shape[1]))
+        if self._con is not None:
+            con = numpy.full((capacity, self._con.shape[1]), numpy.nan, dtype=numpy.float64)
+            con[: self._n] = self._con[: self._n]
+            self._con = con
+        if self._yvar is not None:
+            yvar = numpy.full((capacity, self._yvar.shape[1]), numpy.nan, dtype=numpy.float64)
+            yvar[: self._n] = self._yvar[: self._n]
+            self._yvar = yvar
+
+
+def _latest_setpoint(
+    completed_trials: Sequence[FrozenTrial],
+    running_trials: Sequence[FrozenTrial],
+    search_space: Dict[str, BaseDistribution],
+) -> Optional[Dict[str, Any]]:
+    # The parameters of the most recently asked trial are what the machine is set to now.
+    # `get_trials` returns trials in the order of their numbers.
+    trials = [
+        t
+        for t in list(completed_trials[-1:]) + list(running_trials)
+        if all(p in t.params for p in search_space)
+    ]
+    if not trials:
+        return None
+    return max(trials, key=lambda t: t.number).params
+
+
+def fill_noise(yvar: numpy.ndarray, values: numpy.ndarray) -> Optional[numpy.ndarray]:
+    """Complete and floor the observation noise variances of a fixed-noise GP.
+
+    Trials without an estimate (e.g. a single measurement), marked by NaN, get the mean variance
+    of their output. Variances are floored so that repeated identical readings do not pin the
+    GP: the floor is ``1e-4`` of the outcome variance, which ``Standardize`` maps to the same
+    floor as BoTorch's ``MIN_INFERRED_NOISE_LEVEL``, so it holds even when every recorded
+    variance is 0.
+
+    Args:
+        yvar:
+            Noise variances of shape ``(n_trials, n_outputs)``, NaN where unknown.
+        values:
+            Observations of the same shape.
+
+    Returns:
+        The completed variances, or :obj:`None` if some output has no known variance.
+    """
+
+    yvar = yvar.copy()
+    for i in range(yvar.shape[1]):
+        known = numpy.isfinite(yvar[:, i])
+        if not known.any():
+            return None
+        mean = yvar[known, i].mean()
+        yvar[~known, i] = mean
+        outcome_variance = numpy.var(values[:, i])
+        if not outcome_variance > 0:
+            # Standardize leaves a constant outcome unscaled.
+            outcome_variance = 1.0
+        floor = max(1e-6 * mean, _MIN_NOISE_LEVEL * outcome_variance)
+        yvar[:, i] = numpy.maximum(yvar[:, i], floor)
+    return yvar
+
+
 @experimental_class("2.4.0")
 class HitohudebayesSampler(BaseSampler):
     """A sampler that uses BoTorch, a Bayesian optimization library built on top of PyTorch.
@@ -758,6 +2363,82 @@ class HitohudebayesSampler(BaseSampler):
         device:
             A ``torch.device`` to store input and output data of BoTorch. Please set a CUDA device
             if you fasten sampling.
+        persistent_model:
+            If True, the built-in ``candidates_func`` keeps its GP across trials in a
+            :class:`GPModelCache`. New observations are conditioned on the cached model and the
+            hyperparameter optimization is warm-started from the previous optimum, which keeps
+            the suggestion latency roughly flat as the study grows. :func:`qehvi_candidates_func`
+            likewise keeps the Pareto front and its box decomposition in a
+            :class:`ParetoCache`, and stores its update in the trial system attribute
+            ``"hitohudebayes:pareto_update"``. In single-objective studies, the predictive
+            standard deviation of the objective at the suggested point is stored in the trial
+            system attribute ``"hitohudebayes:predictive_std"``, so that the caller can decide
+            how many repeated measurements the point needs. Between refits, the conditioned
+            model keeps the previous hyperparameters, so the suggestions differ from those of a
+            fresh fit on every trial, which is what the default of False does.
+        refit_policy:
+            A :class:`RefitPolicy` that decides when the persistent model re-optimizes its
+            hyperparameters. Which path ran and how long it took is stored in the trial system
+            attribute ``"hitohudebayes:model_update"``. Ignored if ``persistent_model`` is False.
+        sparse_threshold:
+            If given, the persistent model switches to a variational GP with ``num_inducing``
+            inducing points once the number of completed trials reaches this value, e.g. when
+            a long archived study is loaded. See :class:`GPModelCache`. Ignored if
+            ``persistent_model`` is False.
+        num_inducing:
+            Number of inducing points of the variational GP.
+        batch_size:
+            Number of candidates generated by one acquisition optimization. The first candidate
+            is returned and the others are queued. Later asks are served from the queue without
+            fitting the model again, until a new observation arrives or the queue becomes older
+            than ``max_queue_age``. All built-in ``candidates_func`` receive it as ``q``;
+            :func:`qparego_candidates_func` draws one scalarization weight per candidate. Only
+            :func:`logei_candidates_func`, :func:`qei_candidates_func` and
+            :func:`qparego_candidates_func` also reuse the persistent model and the
+            observation noise; the others fit a new GP on every call. A custom
+            ``candidates_func`` may also return a ``(q, n_params)`` tensor to fill the queue.
+        max_queue_age:
+            Time in seconds after which queued candidates are discarded. :obj:`None` means that
+            the queue is only discarded when a new observation arrives.
+        acqf_optimizer:
+            How the built-in ``candidates_func`` maximize the acquisition function.
+            ``"optimize_acqf"`` runs BoTorch's multi-start L-BFGS-B. ``"sobol_pool"`` evaluates
+            the acquisition function on a cached Sobol pool and polishes only the best few
+            points (see :func:`optimize_acqf_sobol_pool`).
+        acqf_time_budget:
+            Wall-clock budget in seconds of the acquisition optimization per suggestion. If
+            given, the built-in ``candidates_func`` scale their restarts and raw samples with the
+            number of parameters and the measured cost of the acquisition function, and stop
+            early once the best value stops improving (see :class:`AcquisitionBudget`).
+            :obj:`None` keeps the fixed settings of each ``candidates_func``.
+        proximal_biasing:
+            If True, the built-in ``candidates_func`` weight the acquisition function with
+            :class:`proximal.ProximalAcquisitionFunction` (lengthscales ``x_weight_list``)
+            anchored on the parameters of the most recently asked trial, which is the current
+            setpoint of the machine (``Xold`` of the drivers). This limits how far the magnets
+            have to travel between two measurements.
+        trust_region:
+            A :class:`TrustRegionPolicy`. If given, candidates are proposed by local BO
+            (TuRBO): each suggestion fits a GP only to the points in and around one trust
+            region and optimizes the acquisition function inside it, which keeps the cost per
+            suggestion bounded for 8 or more parameters. The region of each trial is stored
+            in the trial system attribute ``"hitohudebayes:trust_region"``. Only
+            single-objective studies are supported.
+        noise_func:
+            An optional function that returns the observation noise variance of each objective
+            value of a trial followed by that of each constraint, e.g. estimated from the spread
+            of the repeated measurements taken for the trial. It is evaluated after each trial
+            and stored in the trial system attribute ``"hitohudebayes:noise"``. NaN marks an
+            unknown variance, which is replaced by the mean of the known ones. The variances
+            are passed as ``train_yvar`` to :func:`logei_candidates_func`,
+            :func:`qei_candidates_func` and :func:`qparego_candidates_func`, whose GP then
+            uses them as fixed heteroscedastic noise.
+        ramp_cost_model:
+            An optional :class:`ramp_cost.RampCostModel`. If given, the built-in
+            ``candidates_func`` maximize the acquisition value per second of ramping from the
+            current setpoint and measuring, instead of per trial. If a completed trial has the
+            user attribute ``"elapsed_time"`` (the seconds spent ramping to it and measuring
+            it), the model learns its coefficients from it.
     """
 
     def __init__(
@@ -787,9 +2468,26 @@ class HitohudebayesSampler(BaseSampler):
         independent_sampler: Optional[BaseSampler] = None,
         seed: Optional[int] = None,
         device: Optional["torch.device"] = None,
+        persistent_model: bool = False,
+        refit_policy: Optional[RefitPolicy] = None,
+        sparse_threshold: Optional[int] = None,
+        num_inducing: int = 256,
+        batch_size: int = 1,
+        max_queue_age: Optional[float] = None,
+        acqf_optimizer: str = "optimize_acqf",
+        acqf_time_budget: Optional[float] = None,
+        proximal_biasing: bool = False,
+        trust_region: Optional[TrustRegionPolicy] = None,
+        noise_func: Optional[Callable[[FrozenTrial], Sequence[float]]] = None,
+        ramp_cost_model: Optional[RampCostModel] = None,
     ):
         _imports.check()
 
+        if acqf_optimizer not in _ACQF_OPTIMIZERS:
+            raise ValueError(
+                f"acqf_optimizer must be one of {_ACQF_OPTIMIZERS}. Actual: {acqf_optimizer}."
+            )
+
 
         self.x_name_list = x_name_list
         self.x_min_max_list =  x_min_max_list
@@ -800,6 +2498,8 @@ class HitohudebayesSampler(BaseSampler):
 
         self._candidates_func = candidates_func
         self._constraints_func = constraints_func
+        self._noise_func = noise_func
+        self._ramp_cost_model = ramp_cost_model
         self._consider_running_trials = consider_running_trials
         self._independent_sampler = independent_sampler or RandomSampler(seed=seed)
         self._n_startup_trials = n_startup_trials
@@ -808,6 +2508,35 @@ class HitohudebayesSampler(BaseSampler):
         self._study_id: Optional[int] = None
         self._search_space = IntersectionSearchSpace()
         self._device = device or torch.device("cpu")
+        self._model_cache = (
+            GPModelCache(refit_policy, sparse_threshold, num_inducing) if persistent_model else None
+        )
+        self._pareto_cache = ParetoCache() if persistent_model else None
+        self._trust_regions: Optional[_TrustRegions] = None
+        if trust_region is not None:
+            # Each region keeps its own GP, since the local training sets differ.
+            self._trust_regions = _TrustRegions(
+                trust_region,
+                lambda: GPModelCache(refit_policy, sparse_threshold, num_inducing)
+                if persistent_model
+                else None,
+            )
+        self._trial_buffer: Optional[_TrialBuffer] = None
+        self._batch_size = batch_size
+        self._max_queue_age = max_queue_age
+        self._candidate_queue: List[numpy.ndarray] = []
+        self._queue_stds: List[Optional[float]] = []
+        self._queue_key: Optional[Tuple[_TrialBuffer, int]] = None
+        self._queue_time = 0.0
+        self._queue_region: Optional[int] = None
+        self._acqf_optimizer = acqf_optimizer
+        self._acqf_budget = (
+            AcquisitionBudget(acqf_time_budget) if acqf_time_budget is not None else None
+        )
+        self._proximal_biasing = proximal_biasing
+        # Guards the model, the queue and the ramp-cost model, since ``AskPipeline`` runs
+        # ``sample_relative`` in a background thread while ``after_trial`` runs in the caller's.
+        self._lock = threading.Lock()
 
     def infer_relative_search_space(
         self,
@@ -837,12 +2566,22 @@ class HitohudebayesSampler(BaseSampler):
         study: Study,
         trial: FrozenTrial,
         search_space: Dict[str, BaseDistribution],
+    ) -> Dict[str, Any]:
+        with self._lock:
+            return self._sample_relative(study, trial, search_space)
+
+    def _sample_relative(
+        self,
+        study: Study,
+        trial: FrozenTrial,
+        search_space: Dict[str, BaseDistribution],
     ) -> Dict[str, Any]:
         assert isinstance(search_space, dict)
 
         if len(search_space) == 0:
             return {}
 
+        trial_id = trial._trial_id
         completed_trials = study.get_trials(
             deepcopy=False, states=(TrialState.COMPLETE,)
         )
@@ -851,64 +2590,42 @@ class HitohudebayesSampler(BaseSampler):
             for t in study.get_trials(deepcopy=False, states=(TrialState.RUNNING,))
             if t != trial
         ]
-        trials = completed_trials + running_trials
-
-        n_trials = len(trials)
-        n_completed_trials = len(completed_trials)
+        n_trials = len(completed_trials) + len(running_trials)
         if n_trials < self._n_startup_trials:
             return {}
 
-        trans = _SearchSpaceTransform(search_space)
         n_objectives = len(study.directions)
-        values: Union[numpy.ndarray, torch.Tensor] = numpy.empty(
-            (n_trials, n_objectives), dtype=numpy.float64
+        if self._trial_buffer is None or self._trial_buffer.search_space != search_space:
+            self._trial_buffer = _TrialBuffer(search_space, study.directions)
+            if self._trust_regions is not None:
+                # The regions refer to rows of the previous buffer.
+                self._trust_regions.reset()
+        buffer = self._trial_buffer
+        trans = buffer.trans
+        buffer.ingest(
+            study,
+            completed_trials,
+            read_constraints=self._constraints_func is not None,
+            read_noise=self._noise_func is not None,
         )
-        params: Union[numpy.ndarray, torch.Tensor]
-        con: Optional[Union[numpy.ndarray, torch.Tensor]] = None
-        bounds: Union[numpy.ndarray, torch.Tensor] = trans.bounds
-        params = numpy.empty((n_trials, trans.bounds.shape[0]), dtype=numpy.float64)
-        for trial_idx, trial in enumerate(trials):
-            if trial.state == TrialState.COMPLETE:
-                params[trial_idx] = trans.transform(trial.params)
-                assert len(study.directions) == len(trial.values)
-                for obj_idx, (direction, value) in enumerate(
-                    zip(study.directions, trial.values)
-                ):
-                    assert value is not None
-                    if (
-                        direction == StudyDirection.MINIMIZE
-                    ):  # BoTorch always assumes maximization.
-                        value *= -1
-                    values[trial_idx, obj_idx] = value
-                if self._constraints_func is not None:
-                    constraints = study._storage.get_trial_system_attrs(
-                        trial._trial_id
-                    ).get(_CONSTRAINTS_KEY)
-                    if constraints is not None:
-                        n_constraints = len(constraints)
-
-                        if con is None:
-                            con = numpy.full(
-                                (n_completed_trials, n_constraints),
-                                numpy.nan,
-                                dtype=numpy.float64,
-                            )
-                        elif n_constraints != con.shape[1]:
-                            raise RuntimeError(
-                                f"Expected {con.shape[1]} constraints "
-                                f"but received {n_constraints}."
-                            )
-                        con[trial_idx] = constraints
-            elif trial.state == TrialState.RUNNING:
-                if all(p in trial.params for p in search_space):
-                    params[trial_idx] = trans.transform(trial.params)
-                else:
-                    params[trial_idx] = numpy.nan
-            else:
-                assert (
-                    False
-                ), "trail.state must be TrialState.COMPLETE or TrialState.RUNNING."
 
+        if self._candidate_queue:
+            if self._queue_key == (buffer, len(buffer.values)) and (
+                self._max_queue_age is None
+                or time.monotonic() - self._queue_time <= self._max_queue_age
+            ):
+                if self._queue_region is not None:
+                    self._trust_regions.assign(trial_id, self._queue_region)
+                predictive_std = self._queue_stds.pop(0)
+                if predictive_std is not None:
+                    study._storage.set_trial_system_attr(
+                        trial_id, PREDICTIVE_STD_KEY, predictive_std
+                    )
+                return trans.untransform(self._candidate_queue.pop(0))
+            self._candidate_queue = []
+            self._queue_stds = []
+
+        con = buffer.constraints
         if self._constraints_func is not None:
             if con is None:
                 warnings.warn(
@@ -921,15 +2638,42 @@ class HitohudebayesSampler(BaseSampler):
                     "constraints. Constraints passed to `candidates_func` will contain NaN."
                 )
 
-        values = torch.from_numpy(values).to(self._device)
-        params = torch.from_numpy(params).to(self._device)
-        if con is not None:
-            con = torch.from_numpy(con).to(self._device)
-        bounds = torch.from_numpy(bounds).to(self._device)
+        completed_values = buffer.values
+        completed_params = buffer.params
+        noise = None
+        if self._noise_func is not None and buffer.noise is not None:
+            noise = fill_noise(buffer.noise, buffer.values)
+        search_bounds = trans.bounds
+        model_cache = self._model_cache
+        region_index = None
+        if self._trust_regions is not None:
+            if n_objectives != 1:
+                raise ValueError("The trust-region mode supports single-objective studies only.")
+            lower, upper = trans.bounds[:, 0], trans.bounds[:, 1]
+            region_index, rows, region_lower, region_upper = self._trust_regions.next_region(
+                (buffer.params - lower) / (upper - lower),
+                buffer.values[:, 0],
+                buffer.trial_ids,
+                _get_lengthscale,
+            )
+            # The candidates function sees the local data and the region as its search space.
+            completed_values = completed_values[rows]
+            completed_params = completed_params[rows]
+            if con is not None:
+                con = con[rows]
+            if noise is not None:
+                noise = noise[rows]
+            search_bounds = numpy.stack(
+                [lower + region_lower * (upper - lower), lower + region_upper * (upper - lower)],
+                axis=1,
+            )
+            model_cache = self._trust_regions.model_caches[region_index]
 
+        completed_values = torch.from_numpy(completed_values).to(self._device)
+        completed_params = torch.from_numpy(completed_params).to(self._device)
         if con is not None:
-            if con.dim() == 1:
-                con.unsqueeze_(-1)
+            con = torch.from_numpy(con).to(self._device)
+        bounds = torch.from_numpy(search_bounds).to(self._device)
         bounds.transpose_(0, 1)
 
         if self._candidates_func is None:
@@ -939,14 +2683,49 @@ class HitohudebayesSampler(BaseSampler):
                 consider_running_trials=self._consider_running_trials,
             )
 
-        completed_values = values[:n_completed_trials]
-        completed_params = params[:n_completed_trials]
         if self._consider_running_trials:
-            running_params = params[n_completed_trials:]
-            running_params = running_params[~torch.isnan(running_params).any(dim=1)]
+            running_params = numpy.array(
+                [
+                    trans.transform(t.params)
+                    for t in running_trials
+                    if all(p in t.params for p in search_space)
+                ],
+                dtype=numpy.float64,
+            ).reshape(-1, trans.bounds.shape[0])
+            running_params = torch.from_numpy(running_params).to(self._device)
         else:
             running_params = None
 
+        candidates_func_kwargs: Dict[str, Any] = {}
+        if self._candidates_func in (
+            logei_candidates_func,
+            qei_candidates_func,
+            qparego_candidates_func,
+        ):
+            if model_cache is not None:
+                candidates_func_kwargs["model_cache"] = model_cache
+            if noise is not None:
+                candidates_func_kwargs["train_yvar"] = torch.from_numpy(noise).to(self._device)
+        if self._candidates_func is qehvi_candidates_func and self._pareto_cache is not None:
+            candidates_func_kwargs["pareto_cache"] = self._pareto_cache
+        if self._candidates_func in _BUILTIN_CANDIDATES_FUNCS:
+            if self._batch_size > 1:
+                candidates_func_kwargs["q"] = self._batch_size
+            if self._acqf_optimizer != "optimize_acqf":
+                candidates_func_kwargs["acqf_optimizer"] = self._acqf_optimizer
+            if self._acqf_budget is not None:
+                candidates_func_kwargs["acqf_budget"] = self._acqf_budget
+            if self._proximal_biasing or self._ramp_cost_model is not None:
+                setpoint = _latest_setpoint(completed_trials, running_trials, search_space)
+                if setpoint is not None:
+                    anchor = torch.from_numpy(trans.transform(setpoint)).to(self._device)
+                    if self._proximal_biasing:
+                        candidates_func_kwargs["proximal_anchor"] = anchor
+                    if self._ramp_cost_model is not None:
+                        candidates_func_kwargs["ramp_cost"] = self._ramp_cost_model.at(
+                            anchor, list(search_space)
+                        )
+
         with manual_seed(self._seed):
             # `manual_seed` makes the default candidates functions reproducible.
             # `SobolQMCNormalSampler`'s constructor has a `seed` argument, but its behavior is
@@ -963,30 +2742,59 @@ class HitohudebayesSampler(BaseSampler):
                 con,
                 bounds,
                 running_params,
+                **candidates_func_kwargs,
             )
             if self._seed is not None:
                 self._seed += 1
 
+        if "model_cache" in candidates_func_kwargs and model_cache.last_update is not None:
+            study._storage.set_trial_system_attr(
+                trial_id, _MODEL_UPDATE_KEY, model_cache.last_update
+            )
+        if "pareto_cache" in candidates_func_kwargs:
+            study._storage.set_trial_system_attr(
+                trial_id, _PARETO_UPDATE_KEY, self._pareto_cache.last_update
+            )
+        if region_index is not None:
+            self._trust_regions.assign(trial_id, region_index)
+            study._storage.set_trial_system_attr(
+                trial_id,
+                _TRUST_REGION_KEY,
+                {"index": region_index, "length": self._trust_regions.regions[region_index].length},
+            )
+
         if not isinstance(candidates, torch.Tensor):
             raise TypeError("Candidates must be a torch.Tensor.")
-        if candidates.dim() == 2:
-            if candidates.size(0) != 1:
-                raise ValueError(
-                    "Candidates batch optimization is not supported and the first dimension must "
-                    "have size 1 if candidates is a two-dimensional tensor. Actual: "
-                    f"{candidates.size()}."
-                )
-            # Batch size is one. Get rid of the batch dimension.
-            candidates = candidates.squeeze(0)
-        if candidates.dim() != 1:
+        if candidates.dim() == 1:
+            candidates = candidates.unsqueeze(0)
+        if candidates.dim() != 2:
             raise ValueError("Candidates must be one or two-dimensional.")
-        if candidates.size(0) != bounds.size(1):
+        if candidates.size(1) != bounds.size(1):
             raise ValueError(
                 "Candidates size must match with the given bounds. Actual candidates: "
-                f"{candidates.size(0)}, bounds: {bounds.size(1)}."
+                f"{candidates.size(1)}, bounds: {bounds.size(1)}."
             )
 
-        return trans.untransform(candidates.cpu().numpy())
+        # The predictive standard deviation of the objective at each candidate lets the caller
+        # decide how precisely the candidate has to be measured.
+        predictive_stds: List[Optional[float]] = [None] * candidates.size(0)
+        if n_objectives == 1 and "model_cache" in candidates_func_kwargs:
+            with torch.no_grad():
+                posterior = model_cache.model.posterior(normalize(candidates, bounds=bounds))
+            predictive_stds = posterior.variance[..., 0].clamp_min(0).sqrt().tolist()
+            study._storage.set_trial_system_attr(
+                trial_id, PREDICTIVE_STD_KEY, predictive_stds[0]
+            )
+
+        # The first candidate is used now and the rest of the batch is served to later asks.
+        candidates = candidates.cpu().numpy()
+        self._candidate_queue = list(candidates[1:])
+        self._queue_stds = predictive_stds[1:]
+        self._queue_key = (buffer, len(buffer.values))
+        self._queue_time = time.monotonic()
+        self._queue_region = region_index
+
+        return trans.untransform(candidates[0])
 
     def sample_independent(
         self,
@@ -1017,4 +2825,17 @@ class HitohudebayesSampler(BaseSampler):
             _process_constraints_after_trial(
                 self._constraints_func, study, trial, state
             )
+        if self._noise_func is not None and state == TrialState.COMPLETE:
+            noise = [float(v) for v in self._noise_func(trial)]
+            study._storage.set_trial_system_attr(trial._trial_id, _NOISE_KEY, noise)
+        elapsed_time = trial.user_attrs.get("elapsed_time")
+        if self._ramp_cost_model is not None and elapsed_time is not None and trial.number > 0:
+            # The magnets were ramped from the parameters of the previous trial.
+            previous = study.get_trials(deepcopy=False)[trial.number - 1]
+            if previous.params:
+                with self._lock:
+                    self._ramp_cost_model.observe(
+                        self._ramp_cost_model.n_steps(previous.params, trial.params),
+                        elapsed_time,
+                    )
         self._independent_sampler.after_trial(study, trial, state, values)
@@ -17,11 +17,11 @@ import threading
 import time, datetime
 import configparser
 import TheSummer.safeopt_code_basic as so
-import subprocess
-import select
-import matplotlib.pyplot as plt
-from matplotlib.colors import LogNorm
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+import TheSummer.ask_pipeline as ask_pipeline
+import TheSummer.pv_pool as pv_pool
+import TheSummer.loss_monitor as loss_monitor
+#図は別プロセスで描くので，このプロセスではmatplotlibをimportしない
+import TheSummer.diagnostics_renderer as diagnostics_renderer
 import random
 from epics import PV, caget, caput, camonitor
 import optuna
@@ -94,14 +94,22 @@ def setValueX_PV(x_name_list,x_step_list ,X , Xold, WaitTime,iter_i, iterN) :
     #print("nstep",nstep)
     #print("dstep",dstep)
     
+    settle_times = []
     for j in range(1, max(nstep) + 1):
+        step_start = time.monotonic()
+        settled = True
+        step_values = {}
         for k in range(len(x_name_list)):
             if j <= nstep[k]:
                 # wait for gate opening
                 #while caget(th_name_list[0]) < float(0.1) :
                 #    print("wait for gate opening...")
                 #    time.sleep(1)
-                caput(x_name_list[k], dstep[k] * j + Xold[k])
+                if settle_mode == "put_complete" :
+                    #put_completeのときはこのstepの全knobをまとめてputする
+                    step_values[x_name_list[k]] = dstep[k] * j + Xold[k]
+                else :
+                    pvs.put(x_name_list[k], dstep[k] * j + Xold[k])
                 if iter_i < iterN:
                     print( "Iteration {}/{} params x{} split {}/{}".format(iter_i+1, iterN,k,j, nstep[k]))
                     log_text += "Iteration {}/{} params x{} split {}/{}\n".format(iter_i+1, iterN,k,j, nstep[k])
@@ -110,22 +118,41 @@ def setValueX_PV(x_name_list,x_step_list ,X , Xold, WaitTime,iter_i, iterN) :
                     print( "Bestparams x{} split {}/{}".format(k,j, nstep[k]))
                     log_text += "Bestparams x{} split {}/{}\n".format(k,j, nstep[k])
                 
-        time.sleep(WaitTime)
+        if settle_mode == "put_complete" :
+            #全knobのputを同時に出し，全ての完了をまとめて待つ (WaitTimeはこのstep全体のtimeout)
+            not_completed = pvs.put_many(step_values, timeout=WaitTime)
+            settled = len(not_completed) == 0
+        elif settle_mode == "readback" :
+            #全てのknobのreadbackがこのstepの値からtolerance以内に入ったら次のstepへ進む
+            targets = {x_readback_list[k] : (dstep[k] * min(j, nstep[k]) + Xold[k], x_tolerance_list[k])
+                       for k in range(len(x_name_list))}
+            settled = pvs.wait_settled(targets, WaitTime) is not None
+        else :
+            time.sleep(WaitTime)
+        settle_times.append(time.monotonic() - step_start)
+        if not settled :
+            print("step {}/{} not settled within {} s".format(j, max(nstep), WaitTime))
+            log_text += "step {}/{} not settled within {} s\n".format(j, max(nstep), WaitTime)
+    
+    if settle_mode != "fixed" :
+        print("settle time mean {:.3f} s, max {:.3f} s, total {:.3f} s".format(
+            np.mean(settle_times), np.max(settle_times), np.sum(settle_times)))
+        log_text += "settle time mean {:.3f} s, max {:.3f} s, total {:.3f} s\n".format(
+            np.mean(settle_times), np.max(settle_times), np.sum(settle_times))
     return
 
 # ----------------------------------------------
 #  Y name list の Epics Recodeの値をゲットして
 #  functionTextに従って値を計算しそれを返す
+#  valsを渡したときはPVを読まずにその値で計算する
 # ----------------------------------------------
-def getValueY_th_PV(y_name_list, y_alias_list,th_name_list, th_alias_list, functionText) :
+def getValueY_th_PV(y_name_list, y_alias_list,th_name_list, th_alias_list, functionText, vals=None) :
     AllText = ""
-    for i in range(0, len(y_name_list) ) :
-        val = caget(y_name_list[i]) 
-        AllText += '{}={}\n'.format(y_alias_list[i], val)
-        
-    for i in range(0, len(th_name_list) ) :
-        val = caget(th_name_list[i]) 
-        AllText += '{}={}\n'.format(th_alias_list[i], val)
+    #YとthresholdのPVを1回のまとめた読み出しで取得する
+    if vals is None :
+        vals = pvs.get_many(y_name_list + th_name_list)
+    for alias, val in zip(y_alias_list + th_alias_list, vals) :
+        AllText += '{}={}\n'.format(alias, val)
     AllText += functionText
     calcVal = calc_text(AllText)
     return calcVal
@@ -134,7 +161,7 @@ def getValueY_th_PV(y_name_list, y_alias_list,th_name_list, th_alias_list, funct
 #   ベイズ最適化の1step
 # -----------------------------------------------------------
 def optimizationOneStep(study,x_name_list,y_name_list,y_alias_list,x_min_max_list,x_step_list,iter_i,WaitTime,dataN,threshold_list,functionText) :
-    global Xold
+    global Xold, pipeline
     
     log_text = ''
     X = [0 for i in range(len(x_name_list))]
@@ -142,16 +169,19 @@ def optimizationOneStep(study,x_name_list,y_name_list,y_alias_list,x_min_max_lis
     #初期状態から1trial目までをstep by stepでcaputするためにXoldに現在の値を詰める
     if iter_i < 1 :
         Xold = []
-        for i in range (len(x_name_list)):
-            present_x_val = caget(x_name_list[i])
+        for present_x_val in pvs.get_many(x_name_list):
             Xold.append(present_x_val)
         print(Xold)
 
-    trial = study.ask()
+    trial = pipeline.ask() if pipeline is not None else study.ask()
 
     for i in range(len(x_name_list)):
         X[i] = trial.suggest_float(x_name_list[i], x_min_max_list[i][0], x_min_max_list[i][1])
     
+    #測定中に次の候補点を計算しておく(今のtrialはX_pendingとして扱われる)
+    if pipeline is not None and iter_i + 1 < iterN :
+        pipeline.prefetch()
+    
     setValueX_PV(x_name_list,x_step_list ,X , Xold, WaitTime,iter_i, iterN)
     Xold = X.copy()  # Xoldを更新
     
@@ -161,6 +191,26 @@ def optimizationOneStep(study,x_name_list,y_name_list,y_alias_list,x_min_max_lis
     c_temp_val = 0.0
     data_i = 0
     
+    #逐次測定 : min_measurements回以上測った後，中央値の標準誤差がtoleranceを下回ったら測定を打ち切る
+    #relative_toleranceはサンプラーが記録したこの点でのGPの予測標準偏差に対する割合
+    tolerance = measurement_tolerance
+    predictive_std = study._storage.get_trial_system_attrs(trial._trial_id).get("hitohudebayes:predictive_std")
+    if relative_tolerance > 0 and predictive_std is not None :
+        tolerance = max(tolerance, relative_tolerance * predictive_std)
+    elif relative_tolerance > 0 :
+        #初期のランダムな試行や予測標準偏差を記録しないサンプラーではrelative_toleranceは使えない
+        print("no predictive std for this trial, relative_tolerance is not used")
+        log_text += "no predictive std for this trial, relative_tolerance is not used\n"
+    
+    #setpoint変更後に届いた更新だけをサンプルとして使う
+    sample_time = time.monotonic()
+    if loss_watcher is not None :
+        loss_watcher.reset()  #ロスモニターのmax, meanをこのtrialの測定分だけにする
+    #monitorの更新がmax_sample_misses回続けて来なければ，このtrialの残りはpollingで測る
+    use_monitor = monitor_sampling
+    sample_misses = 0
+    max_sample_misses = 3
+    
     while data_i < dataN :
     
         #getValueY_PVの入力がfunctionTextであることに注意。ans = [(functionの計算値), bool]という値になる
@@ -174,7 +224,27 @@ def optimizationOneStep(study,x_name_list,y_name_list,y_alias_list,x_min_max_lis
                 #    time.sleep(3)
                 #    print("wait for gate opening...")
             
-            ans = getValueY_th_PV(y_name_list, y_alias_list,th_name_list, th_alias_list, functionText)
+            if use_monitor :
+                #Yの先頭PVの次の更新を待ち，その時点での全PVの値を1サンプルとする
+                sample = pvs.next_sample(sampled_name_list, sample_time, timeout=sample_timeout)
+                if sample is None :
+                    sample_misses += 1
+                    print("no update of {} within {} s ({}/{})".format(y_name_list[0], sample_timeout, sample_misses, max_sample_misses))
+                    log_text += "no update of {} within {} s ({}/{})\n".format(y_name_list[0], sample_timeout, sample_misses, max_sample_misses)
+                    if sample_misses >= max_sample_misses :
+                        print("fall back to polling for this trial")
+                        log_text += "fall back to polling for this trial\n"
+                        use_monitor = False
+                    continue
+                sample_misses = 0
+                sample_time, sample_vals = sample
+                n_y_th = len(y_name_list) + len(th_name_list)
+                ans = getValueY_th_PV(y_name_list, y_alias_list,th_name_list, th_alias_list, functionText,
+                                      vals=sample_vals[:n_y_th])
+                lm_vals = sample_vals[n_y_th:]
+            else :
+                ans = getValueY_th_PV(y_name_list, y_alias_list,th_name_list, th_alias_list, functionText)
+                lm_vals = None
             if ans[1] == False :
                 print("calc_value error occurred.")
             else :
@@ -182,25 +252,48 @@ def optimizationOneStep(study,x_name_list,y_name_list,y_alias_list,x_min_max_lis
                 Y_temp_val_list.append(Y_temp_val)
                 
                 c_temp_list = []
-                for i in range(len(lm_name_list)):
-                    c_temp_val = float(caget(lm_name_list[i]))
-                    c_temp_list.append(c_temp_val) #制限を格納するリスト(制限の数だけ詰める)
+                if loss_watcher is not None :
+                    lm_vals = [] #ロスモニターはwatcherが測定中ずっと監視しているので読まない
+                elif lm_vals is None :
+                    lm_vals = pvs.get_many(lm_name_list)
+                for c_temp_val in lm_vals:
+                    c_temp_list.append(float(c_temp_val)) #制限を格納するリスト(制限の数だけ詰める)
                     #print(c_temp_list,"c_temp_list")
                 print('Iteration {}/{}  meas {}/{}  Y_temp_val = {}'.format(iter_i+1, iterN, data_i+1, dataN,Y_temp_val) )
                 log_text += 'Iteration {}/{}  meas {}/{}  Y_temp_val = {}\n'.format(iter_i+1, iterN, data_i+1, dataN,Y_temp_val)
-                time.sleep(1.1)
+                if not use_monitor :
+                    time.sleep(1.1)
                 c_temp_list_list.append(c_temp_list) #制限を格納するリストのリスト(n回のデータを詰める)
                 #print(c_temp_list_list,"c_temp_list_list")
             data_i += 1
             
+            if tolerance > 0 and len(Y_temp_val_list) >= max(min_measurements, 2) :
+                Y_se = np.sqrt(np.pi / 2 * statistics.variance(Y_temp_val_list) / len(Y_temp_val_list))
+                if Y_se <= tolerance :
+                    print('standard error {} <= tolerance {}, stop measuring'.format(Y_se, tolerance))
+                    break
+            
         elif len(threshold_list) == 0 :
             pass
         else : print("error happened in optimization.")
 
     #Y_val = statistics.mean(Y_temp_val_list)
     Y_val = statistics.median(Y_temp_val_list)
-    c_temp_list_list_np = np.array(c_temp_list_list) #numpyに変換
-    c_vals = np.max(c_temp_list_list_np, axis=0).tolist() #行列の列方向に中央値をとるその後ndarrayをlistに変換
+    #実際に使った測定回数を記録する
+    trial.set_user_attr("n_measurements", len(Y_temp_val_list))
+    log_text += 'Iteration {}/{}  measurements {}/{}\n'.format(iter_i+1, iterN, len(Y_temp_val_list), dataN)
+    #中央値の分散(正規分布なら π/2 * s^2/n)をtrialに保存し，GPの観測ノイズとして使う
+    if len(Y_temp_val_list) > 1 :
+        Y_var = np.pi / 2 * statistics.variance(Y_temp_val_list) / len(Y_temp_val_list)
+        trial.set_user_attr("objective_variance", Y_var)
+        log_text += 'Y variance = {}\n'.format(Y_var)
+    if loss_watcher is not None :
+        #測定中に届いた全ての更新の最大値 (サンプルの間のスパイクも含む)
+        c_vals = loss_watcher.max().tolist()
+        log_text += 'loss monitor max = {}, mean = {}\n'.format(c_vals, loss_watcher.mean().tolist())
+    else :
+        c_temp_list_list_np = np.array(c_temp_list_list) #numpyに変換
+        c_vals = np.max(c_temp_list_list_np, axis=0).tolist() #行列の列方向に中央値をとるその後ndarrayをlistに変換
     trial.set_user_attr("constraints", c_vals) #それぞれの制限のmaxを"constraints"に引き渡す
     print(c_vals,"c_vals")
     print('X = {}, Y = {}'.format(X, Y_val))
@@ -210,37 +303,6 @@ def optimizationOneStep(study,x_name_list,y_name_list,y_alias_list,x_min_max_lis
     
     return [X,Y_val,log_text, c_vals]
 
-#-----------------
-#　ロスモニター監視
-#-----------------
-def lossMeasure(lm_name):
-    global keep_running
-
-    process = subprocess.Popen(['camonitor', lm_name], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1, universal_newlines=True)
-
-    try:
-        while keep_running.is_set():
-            # 標準出力と標準エラー出力を監視
-            readable, _, _ = select.select([process.stdout, process.stderr], [], [], 1)
-            
-            for stream in readable:
-                if stream == process.stdout:
-                    line = stream.readline().strip()
-                    if line:
-                        print(f"{lm_name}: {line}")  # 出力を表示
-
-                if stream == process.stderr:
-                    error_line = stream.readline().strip()
-                    if error_line:
-                        print(f"{lm_name} Error: {error_line}")
-
-            time.sleep(0.1)
-    except Exception as e:
-        print(f"An error occurred in {lm_name}: {e}")
-    finally:
-        process.terminate()
-        process.wait()
-
 #-----------------------------------------------------------
 # Setting を呼び出す
 #-----------------------------------------------------------
@@ -257,6 +319,13 @@ def readSetting(args) :
 
     repetition = 5
     dataN = 3
+    min_measurements = 3
+    measurement_tolerance = 0.0
+    relative_tolerance = 0.0
+    monitor_sampling = False
+    sample_timeout = 10.0
+    watch_loss_monitors = False
+    settle_mode = "fixed"
     iterN = 50
     WaitTime = 1000
     
@@ -265,6 +334,8 @@ def readSetting(args) :
     x_init_list = []
     x_step_list = []
     x_weight_list = []
+    x_readback_list = []
+    x_tolerance_list = []
     y_name_list = []
     y_alias_list = []
     th_name_list = []
@@ -287,6 +358,19 @@ def readSetting(args) :
         nlm = int(config_ini.get("PV", "nlm"))
         repetition = int(config_ini.get("PV", "repetition"))
         dataN = int(config_ini.get("PV", "number_of_measurements"))
+        #逐次測定の設定 (toleranceが0なら毎回number_of_measurements回測る)
+        min_measurements = config_ini.getint("PV", "min_measurements", fallback=dataN)
+        measurement_tolerance = config_ini.getfloat("PV", "measurement_tolerance", fallback=0.0)
+        relative_tolerance = config_ini.getfloat("PV", "relative_tolerance", fallback=0.0)
+        #monitor_sampling = true ならYとthresholdとロスモニターをmonitorで購読し，
+        #固定のsleepの代わりにIOCの更新ごとに1サンプルを取る
+        monitor_sampling = config_ini.getboolean("PV", "monitor_sampling", fallback=False)
+        sample_timeout = config_ini.getfloat("PV", "sample_timeout", fallback=10.0)
+        #watch_loss_monitors = true ならロスモニターの全ての更新をプロセス内で監視し，その最大値を制限に使う
+        watch_loss_monitors = config_ini.getboolean("PV", "watch_loss_monitors", fallback=False)
+        #rampの各stepの待ち方 : fixed (evalsleepだけ待つ), readback (readbackがtolerance以内に入るまで),
+        #put_complete (caputの完了まで)。readbackとput_completeではevalsleepはtimeoutになる
+        settle_mode = config_ini.get("PV", "settle_mode", fallback="fixed")
         iterN = int(config_ini.get("PV", "n_trials"))
         WaitTime = float(config_ini.get("PV", "evalsleep"))
         functionText = str(config_ini.get("PV", "objective_function"))
@@ -330,6 +414,8 @@ def readSetting(args) :
         beta_obj = float(config_ini.get("PV", "beta_obj"))
         beta_con = float(config_ini.get("PV", "beta_con"))
         constraint_threshold = float(config_ini.get("PV", "constraint_threshold"))
+        #Trueなら測定中に次の候補点を計算する
+        pipeline = config_ini.getboolean("PV", "pipeline", fallback=False)
     
         
         for i in range(nxr):
@@ -344,6 +430,9 @@ def readSetting(args) :
             x_init_list.append(init)
             weight = float(config_ini.get("PV_XD{0}".format(i), "weight"))
             x_weight_list.append(weight)
+            #settle_mode = readback のときに見るreadbackのPVと許容誤差 (デフォルトはstepの半分)
+            x_readback_list.append(config_ini.get("PV_XD{0}".format(i), "readback", fallback=None))
+            x_tolerance_list.append(config_ini.getfloat("PV_XD{0}".format(i), "tolerance", fallback=step / 2))
             
         for i in range(ny):
             pvname = config_ini.get("PV_Y{0}".format(i), "name")
@@ -366,13 +455,23 @@ def readSetting(args) :
             lm_alias_list.append(alias)
             lossmonitor = config_ini.get("PV_lm{0}".format(i), "limitation")
             lossmonitor_list.append(lossmonitor)
+        
+        if settle_mode not in ("fixed", "readback", "put_complete") :
+            print("The settle mode is not correctly selected. Use fixed.")
+            settle_mode = "fixed"
+        if settle_mode == "readback" and None in x_readback_list :
+            print("readback is not set for all parameters. Use fixed settle mode.")
+            settle_mode = "fixed"
             
     return [repetition, dataN, iterN, WaitTime,
     x_name_list, x_min_max_list, x_init_list, x_step_list, x_weight_list,
     y_name_list, y_alias_list, th_name_list, th_alias_list, threshold_list,
     lm_name_list, lm_alias_list, lossmonitor_list, functionText,
     UCB_obj, EI_obj, UCB_con, EI_con, beta_obj, beta_con, constraint_threshold,
-    randomvalue, gridvalue, bestvalue, enqueueData]
+    randomvalue, gridvalue, bestvalue, enqueueData, pipeline,
+    min_measurements, measurement_tolerance, relative_tolerance,
+    monitor_sampling, sample_timeout, watch_loss_monitors,
+    settle_mode, x_readback_list, x_tolerance_list]
 
 ############################################
 # ---------------- main ----------------
@@ -396,14 +495,31 @@ if __name__ == '__main__':
     y_name_list, y_alias_list, th_name_list, th_alias_list, threshold_list,
     lm_name_list, lm_alias_list, lossmonitor_list, functionText,
     UCB_obj, EI_obj, UCB_con, EI_con, beta_obj, beta_con, constraint_threshold,
-    randomvalue, gridvalue, bestvalue, enqueueData] = readSetting(args[1])
+    randomvalue, gridvalue, bestvalue, enqueueData, pipeline,
+    min_measurements, measurement_tolerance, relative_tolerance,
+    monitor_sampling, sample_timeout, watch_loss_monitors,
+    settle_mode, x_readback_list, x_tolerance_list] = readSetting(args[1])
     print(lm_name_list)
     
+    #使うPVにはじめに1回だけ接続する (つながらないPVがあればここで止まる)
+    #monitor_samplingのときは測定するPVの更新をリングバッファに溜めておく
+    sampled_name_list = y_name_list + th_name_list
+    if not watch_loss_monitors :
+        sampled_name_list = sampled_name_list + lm_name_list
+    monitored_name_list = sampled_name_list if monitor_sampling else []
+    if settle_mode == "readback" :
+        monitored_name_list = monitored_name_list + x_readback_list
+    pvs = pv_pool.PVPool(x_name_list + sampled_name_list,
+                         monitored=monitored_name_list)
+    
     #if repetition < 1 : repetition = 1
     if repetition > 50 : repetition = 50
     t = 1000/repetition #timeoutして自動更新する時間を決めるrepetition
     newX = [] 
     log_text += "Repetition {}, dataN {}, IterN {} \n".format(repetition, dataN, iterN,)
+    log_text += "min_measurements {}, measurement_tolerance {}, relative_tolerance {} \n".format(min_measurements, measurement_tolerance, relative_tolerance)
+    log_text += "monitor_sampling {}, sample_timeout {}, watch_loss_monitors {} \n".format(monitor_sampling, sample_timeout, watch_loss_monitors)
+    log_text += "settle_mode {}, readback {}, tolerance {} \n".format(settle_mode, x_readback_list, x_tolerance_list)
     print(x_name_list)
     print(x_min_max_list)
     print(x_init_list)
@@ -418,6 +534,9 @@ if __name__ == '__main__':
     now = datetime.datetime.now()
     current_time = now.strftime("%Y_%m_%d_%H_%M_%S")
     
+    #獲得関数の図はサンプラーが数値だけを渡し，別プロセスで描く
+    acqf_renderer = diagnostics_renderer.DiagnosticsRenderer()
+    
     # --- Objective function ---
     study = optuna.create_study(
         # sampler=optuna.samplers.TPESampler(),
@@ -444,11 +563,14 @@ if __name__ == '__main__':
                     constraint_threshold = constraint_threshold,
                     candidates_func=constrained_candidates_func,
                     n_startup_trials=1,
+                    consider_running_trials=pipeline,
+                    diagnostics_callback=acqf_renderer,
                 )
         
         #制限なし
         #sampler=Hitohudebayes.HitohudebayesSampler(x_name_list,x_min_max_list,x_weight_list,UCB,EI,beta,n_startup_trials = 1,),
     )
+    pipeline = ask_pipeline.AskPipeline(study) if pipeline else None
     
     if randomvalue == True:
         study.enqueue_trial(x_init_dict)
@@ -495,24 +617,14 @@ if __name__ == '__main__':
     
     filename = "./log_" + current_time + ".csv"
     
-    '''
-    #ロスモニターの値を並列で参照するコード
-    keep_running = threading.Event()  #高級なbool値
-    keep_running.set()  #True
-    for lm_name in lm_name_list:
-        thread = threading.Thread(target=lossMeasure, args=(lm_name,))
-        thread.daemon = True  # デーモンスレッドとして設定、メインプロセスが落ちたらデーモンプロセスも落ちる
-        thread.start()
-    '''
-    
-    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=[18, 7])  # 1行2列のサブプロットを作成
+    #ロスモニターの値をプロセス内で並列に監視する (camonitorのサブプロセスは使わない)
+    loss_watcher = None
+    if watch_loss_monitors and len(lm_name_list) != 0 :
+        loss_watcher = loss_monitor.LossMonitorWatcher(lm_name_list)
     
-    # 初期カラーバーの作成
-    sc = ax2.scatter([], [], c=[], cmap="coolwarm", marker='o', s=100, vmin=0, vmax=100)
-    cbar = fig.colorbar(sc, ax=ax2, label='Injection Efficiency')
-    cbar.ax.yaxis.label.set_size(30)  # カラーバーのフォントサイズを設定
-    
-    plt.ion()  # インタラクティブモードをオン
+    #進捗の図も別プロセスで描き，描くたびにpngに保存する
+    progress_renderer = diagnostics_renderer.DiagnosticsRenderer(
+        min_interval=0.0, savefig="./plot" + current_time + ".png", figsize=(18, 7))
     
     iter_i_list,best_value_list = [],[]
     
@@ -527,54 +639,18 @@ if __name__ == '__main__':
         best_value_list.append(study.best_value)
         log_text += optimization_text
         
-        # プロットをクリア
-        ax1.clear()
-        # 線と点を描写
-        ax1.plot(iter_i_list, Y_values_list, color="tab:blue")  # 線を描写
-        ax1.scatter(iter_i_list[:-1], Y_values_list[:-1], color="tab:blue", s=100)  # 以前の点を描写
-        ax1.scatter(iter_i_list[-1], Y_values_list[-1], color="tab:blue", s=150, marker='*')  # 最新の点を星マークで描写
-
-        ax1.plot(iter_i_list, best_value_list, color="tab:orange")
-        ax1.scatter(iter_i_list[:-1], best_value_list[:-1], color="tab:orange", s=100)
-        ax1.scatter(iter_i_list[-1], best_value_list[-1], color="tab:orange", s=150, marker='*')  # 最新の最良点を星マークで描写
-        
-        ax1.set_ylim(0, 100)
-        ax1.set_xlabel('Trial', fontsize=30)
-        ax1.set_ylabel('Injection Efficiency', fontsize=30)
-        ax1.grid()
-        
-        # numpy配列に変換
-        X_values_list_np = np.array(X_values_list)
-        
-        # 行列を転置する
-        transposed_X_values_list_np = X_values_list_np.T
-        
-        # プロットをクリア
-        ax2.clear()
-        ax2.plot(transposed_X_values_list_np[0], transposed_X_values_list_np[1], marker='', linestyle='-', color='gray')
-        # scatterプロットで、各点に色をつける
-        sc = ax2.scatter(transposed_X_values_list_np[0][:-1], transposed_X_values_list_np[1][:-1], c=Y_values_list[:-1], cmap="coolwarm", marker='o', s=100, vmin=0, vmax=100)
-        # 最新の点を星マークで描写
-        ax2.scatter(transposed_X_values_list_np[0][-1], transposed_X_values_list_np[1][-1], c=Y_values_list[-1], cmap="coolwarm", marker='*', s=150, vmin=0, vmax=100)
-        
-        # 軸ラベルとフォントサイズの設定
-        ax2.set_xlabel("param 1", fontsize=30)
-        ax2.set_ylabel("param 2", fontsize=30)
-        
-        ax2.set_xlim(-5, 10)
-        ax2.set_ylim(0, 15)
-        
-        # グリッドの表示
-        ax2.grid()
-        
-        # カラーバーの更新
-        cbar.update_normal(sc)
-        
-        # 描写を更新
-        plt.draw()
-        plt.pause(0.01)  # 0.01秒待機
-        
-        
+        #進捗の図の数値を渡す (描画を待たずに次のtrialへ進む)
+        progress_renderer({
+            "kind": "progress",
+            "trials": np.array(iter_i_list),
+            "values": np.array(Y_values_list),
+            "best_values": np.array(best_value_list),
+            "params": np.array(X_values_list),
+            "value_label": "Injection Efficiency",
+            "value_range": (0, 100),
+            "param_xlim": (-5, 10),
+            "param_ylim": (0, 15),
+        })
         
         #if Y_val < bestY_value or iter_i == 0 :
         if Y_val > bestY_value or iter_i == 0 :
@@ -586,23 +662,25 @@ if __name__ == '__main__':
             writer.writerow(
             [iter_i, Y_val, study.best_value] + X_vals + list(study.best_params.values()) + c_vals
             )
-            fig.savefig("./plot" + current_time + ".png")
         
         info_text = f"best y = {study.best_value} at x = {list(study.best_params.values())}"
         log_text += info_text +'\n'
         
         iter_i += 1
     
-    #keep_running.clear()  #False
+    if pipeline is not None :
+        pipeline.close()
     
     #graph_view(X_values_list, Y_values_list, x_min_max_list)
     setValueX_PV(x_name_list,x_step_list ,list(study.best_params.values()) , Xold, WaitTime,iter_i, iterN) #最後に最適値をセットする
     print(f"best y = {study.best_value} at x = {list(study.best_params.values())}")
     print('Finish')
     log_text += 'Finish\n'
+    pvs.disconnect()
+    if loss_watcher is not None :
+        loss_watcher.close()
     data_i = 0
     iter_i = 0
     
-    plt.ioff()  #インタラクティブモードをオフ
-    plt.show() 
-    fig.savefig("./plot" + current_time + ".png")
+    acqf_renderer.close()
+    progress_renderer.close(block=True)  #進捗の図のウィンドウを閉じるまで待つ
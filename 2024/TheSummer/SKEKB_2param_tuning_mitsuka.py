@@ -20,9 +20,8 @@ import safeopt_code_another as so
 import Hitohudebayes
 import subprocess
 import select
-import matplotlib.pyplot as plt
-from matplotlib.colors import LogNorm
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+#図は別プロセスで描くので，このプロセスではmatplotlibをimportしない
+import diagnostics_renderer
 import random
 from epics import PV, caget, caput, camonitor
 import optuna
@@ -418,6 +417,9 @@ if __name__ == '__main__':
     now = datetime.datetime.now()
     current_time = now.strftime("%Y_%m_%d_%H_%M_%S")
     
+    #獲得関数の図はサンプラーが数値だけを渡し，別プロセスで描く
+    acqf_renderer = diagnostics_renderer.DiagnosticsRenderer()
+    
     # --- Objective function ---
     study = optuna.create_study(
         # sampler=optuna.samplers.TPESampler(),
@@ -444,6 +446,7 @@ if __name__ == '__main__':
                     constraint_threshold = constraint_threshold,
                     candidates_func=so.constrained_candidates_func,
                     n_startup_trials=1,
+                    diagnostics_callback=acqf_renderer,
                 )
         
         #制限なし
@@ -505,14 +508,9 @@ if __name__ == '__main__':
         thread.start()
     '''
     
-    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=[18, 7])  # 1行2列のサブプロットを作成
-    
-    # 初期カラーバーの作成
-    sc = ax2.scatter([], [], c=[], cmap="coolwarm", marker='o', s=100, vmin=0, vmax=100)
-    cbar = fig.colorbar(sc, ax=ax2, label='Injection Efficiency')
-    cbar.ax.yaxis.label.set_size(30)  # カラーバーのフォントサイズを設定
-    
-    plt.ion()  # インタラクティブモードをオン
+    #進捗の図も別プロセスで描き，描くたびにpngに保存する
+    progress_renderer = diagnostics_renderer.DiagnosticsRenderer(
+        min_interval=0.0, savefig="./plot" + current_time + ".png", figsize=(18, 7))
     
     iter_i_list,best_value_list = [],[]
     
@@ -527,54 +525,18 @@ if __name__ == '__main__':
         best_value_list.append(study.best_value)
         log_text += optimization_text
         
-        # プロットをクリア
-        ax1.clear()
-        # 線と点を描写
-        ax1.plot(iter_i_list, Y_values_list, color="tab:blue")  # 線を描写
-        ax1.scatter(iter_i_list[:-1], Y_values_list[:-1], color="tab:blue", s=100)  # 以前の点を描写
-        ax1.scatter(iter_i_list[-1], Y_values_list[-1], color="tab:blue", s=150, marker='*')  # 最新の点を星マークで描写
-
-        ax1.plot(iter_i_list, best_value_list, color="tab:orange")
-        ax1.scatter(iter_i_list[:-1], best_value_list[:-1], color="tab:orange", s=100)
-        ax1.scatter(iter_i_list[-1], best_value_list[-1], color="tab:orange", s=150, marker='*')  # 最新の最良点を星マークで描写
-        
-        ax1.set_ylim(0, 200)
-        ax1.set_xlabel('Trial', fontsize=30)
-        ax1.set_ylabel('Injection Efficiency', fontsize=30)
-        ax1.grid()
-        
-        # numpy配列に変換
-        X_values_list_np = np.array(X_values_list)
-        
-        # 行列を転置する
-        transposed_X_values_list_np = X_values_list_np.T
-        
-        # プロットをクリア
-        ax2.clear()
-        ax2.plot(transposed_X_values_list_np[0], transposed_X_values_list_np[1], marker='', linestyle='-', color='gray')
-        # scatterプロットで、各点に色をつける
-        sc = ax2.scatter(transposed_X_values_list_np[0][:-1], transposed_X_values_list_np[1][:-1], c=Y_values_list[:-1], cmap="coolwarm", marker='o', s=100, vmin=0, vmax=200)
-        # 最新の点を星マークで描写
-        ax2.scatter(transposed_X_values_list_np[0][-1], transposed_X_values_list_np[1][-1], c=Y_values_list[-1], cmap="coolwarm", marker='*', s=150, vmin=0, vmax=200)
-        
-        # 軸ラベルとフォントサイズの設定
-        ax2.set_xlabel("param 1", fontsize=30)
-        ax2.set_ylabel("param 2", fontsize=30)
-        
-        ax2.set_xlim(-5, 10)
-        ax2.set_ylim(0, 15)
-        
-        # グリッドの表示
-        ax2.grid()
-        
-        # カラーバーの更新
-        cbar.update_normal(sc)
-        
-        # 描写を更新
-        plt.draw()
-        plt.pause(0.01)  # 0.01秒待機
-        
-        
+        #進捗の図の数値を渡す (描画を待たずに次のtrialへ進む)
+        progress_renderer({
+            "kind": "progress",
+            "trials": np.array(iter_i_list),
+            "values": np.array(Y_values_list),
+            "best_values": np.array(best_value_list),
+            "params": np.array(X_values_list),
+            "value_label": "Injection Efficiency",
+            "value_range": (0, 200),
+            "param_xlim": (-5, 10),
+            "param_ylim": (0, 15),
+        })
         
         #if Y_val < bestY_value or iter_i == 0 :
         if Y_val > bestY_value or iter_i == 0 :
@@ -586,7 +548,6 @@ if __name__ == '__main__':
             writer.writerow(
             [iter_i, Y_val, study.best_value] + X_vals + list(study.best_params.values()) + c_vals
             )
-            fig.savefig("./plot" + current_time + ".png")
         
         info_text = f"best y = {study.best_value} at x = {list(study.best_params.values())}"
         log_text += info_text +'\n'
@@ -603,6 +564,5 @@ if __name__ == '__main__':
     data_i = 0
     iter_i = 0
     
-    plt.ioff()  #インタラクティブモードをオフ
-    plt.show() 
-    fig.savefig("./plot" + current_time + ".png")
+    acqf_renderer.close()
+    progress_renderer.close(block=True)  #進捗の図のウィンドウを閉じるまで待つ
@@ -0,0 +1,60 @@
+import concurrent.futures
+from typing import Optional
+
+import optuna
+from optuna.trial import Trial
+from optuna.trial import TrialState
+
+
+class AskPipeline:
+    """Computes the next candidate while the current one is being measured.
+
+    ``study.ask()`` is where the sampler fits the GP and optimizes the acquisition function. When
+    :meth:`prefetch` is called right after the parameters of the current trial have been
+    suggested, the next ``study.ask()`` runs in a background thread during the magnet ramp and
+    the repeated readouts, and :meth:`ask` then returns its result without waiting.
+
+    The sampler should be created with ``consider_running_trials=True`` so that the trial being
+    measured is passed to ``candidates_func`` as a pending point (``X_pending``). Otherwise the
+    prefetched candidate is computed as if the current point had not been chosen.
+
+    The prefetch runs the sampler's ``sample_relative`` while the caller may run its
+    ``after_trial`` through ``study.tell()``. :class:`~Hitohudebayes.HitohudebayesSampler`
+    serializes the two with a lock, so ``tell()`` waits for a running prefetch before it
+    updates the ramp-cost model. The ``after_trial`` of the SafeOpt samplers only writes to the
+    storage. Other samplers must only be used here if their ``after_trial`` does not modify
+    state read by ``sample_relative``.
+
+    Args:
+        study:
+            The study to ask.
+    """
+
+    def __init__(self, study: optuna.Study) -> None:
+        self._study = study
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._future: Optional[concurrent.futures.Future] = None
+
+    def ask(self) -> Trial:
+        """Return the prefetched trial, or ask a new one if nothing was prefetched."""
+        if self._future is not None:
+            future, self._future = self._future, None
+            return future.result()
+        return self._study.ask()
+
+    def prefetch(self) -> None:
+        """Start asking the next trial in the background."""
+        if self._future is None:
+            self._future = self._executor.submit(self._study.ask)
+
+    def close(self) -> None:
+        """Discard a prefetched trial that will not be evaluated and stop the worker."""
+        if self._future is not None:
+            future, self._future = self._future, None
+            try:
+                trial = future.result()
+            except Exception:
+                pass
+            else:
+                self._study.tell(trial, state=TrialState.FAIL)
+        self._executor.shutdown(wait=True)
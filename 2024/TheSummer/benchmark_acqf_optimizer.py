@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# coding: utf-8
+
+#---------------------------------------------------------------
+#  獲得関数の最適化方法を比べるベンチマーク
+#  optimize_acqf : 今までの設定 (num_restarts=10, raw_samples=512, maxiter=200)
+#  sobol_pool    : Hitohudebayes.optimize_acqf_sobol_pool
+#                  (キャッシュしたSobol点列で評価し，上位の点だけ勾配法で磨く)
+#  時間と，獲得関数値のregret (念入りに最適化した参照値との差) を次元ごとに表示する．
+#  獲得関数は LogEI とそれにproximalの重みをかけたもの．
+#
+#  使い方 : python benchmark_acqf_optimizer.py [dim ...]
+#---------------------------------------------------------------
+
+import statistics
+import sys
+import time
+import warnings
+
+import torch
+from botorch.acquisition.analytic import LogExpectedImprovement
+from botorch.models import SingleTaskGP
+from botorch.models.transforms.outcome import Standardize
+from botorch.optim import optimize_acqf
+from gpytorch.mlls import ExactMarginalLogLikelihood
+
+import Hitohudebayes
+import proximal
+
+
+N_TRAIN = 30
+N_REPEAT = 5
+
+
+def objective(X):
+    # 最大値が(0.3, 0.3, ...)にある多峰性の関数
+    return -((X - 0.3) ** 2).sum(dim=-1, keepdim=True) + 0.1 * torch.cos(10 * X).sum(dim=-1, keepdim=True)
+
+
+def make_acqfs(dim, seed):
+    torch.manual_seed(seed)
+    train_x = torch.rand(N_TRAIN, dim, dtype=torch.float64)
+    train_y = objective(train_x)
+    model = SingleTaskGP(train_x, train_y, outcome_transform=Standardize(m=1))
+    Hitohudebayes.fit_gpytorch_mll(ExactMarginalLogLikelihood(model.likelihood, model))
+    logEI = LogExpectedImprovement(model=model, best_f=train_y.max())
+    logEI_proximal = proximal.ProximalAcquisitionFunction(
+        logEI, torch.full((dim,), 0.3, dtype=torch.float64), False, True
+    )
+    return {"LogEI": logEI, "LogEI+proximal": logEI_proximal}
+
+
+def run(method, acqf, bounds):
+    start = time.perf_counter()
+    if method == "optimize_acqf":
+        candidates, _ = optimize_acqf(
+            acq_function=acqf,
+            bounds=bounds,
+            q=1,
+            num_restarts=10,
+            raw_samples=512,
+            options={"batch_limit": 5, "maxiter": 200},
+            sequential=True,
+        )
+    else:
+        candidates, _ = Hitohudebayes.optimize_acqf_sobol_pool(acqf, bounds)
+    elapsed = time.perf_counter() - start
+    with torch.no_grad():
+        value = acqf(candidates.unsqueeze(-2)).item()
+    return elapsed, value
+
+
+def reference_value(acqf, bounds):
+    candidates, _ = optimize_acqf(
+        acq_function=acqf,
+        bounds=bounds,
+        q=1,
+        num_restarts=50,
+        raw_samples=4096,
+        options={"batch_limit": 10, "maxiter": 500},
+    )
+    with torch.no_grad():
+        return acqf(candidates.unsqueeze(-2)).item()
+
+
+if __name__ == '__main__':
+    warnings.simplefilter("ignore")
+    dims = [int(d) for d in sys.argv[1:]] or [2, 4, 8]
+    methods = ["optimize_acqf", "sobol_pool"]
+
+    print("{:>4} {:>15} {:>28} {:>28}".format("dim", "acqf", "optimize_acqf", "sobol_pool"))
+    print("{:>4} {:>15} {:>28} {:>28}".format(
+        "", "", "median time[ms] / regret", "median time[ms] / regret"))
+    for dim in dims:
+        bounds = torch.stack([torch.zeros(dim), torch.ones(dim)]).to(torch.float64)
+        # 最初の1回はSobol点列の生成を含むので先に済ませておく
+        Hitohudebayes.optimize_acqf_sobol_pool(make_acqfs(dim, 0)["LogEI"], bounds)
+        results = {}
+        for seed in range(N_REPEAT):
+            for name, acqf in make_acqfs(dim, seed).items():
+                ref = reference_value(acqf, bounds)
+                for method in methods:
+                    elapsed, value = run(method, acqf, bounds)
+                    results.setdefault((name, method), []).append((elapsed, max(ref - value, 0.0)))
+        for name in ["LogEI", "LogEI+proximal"]:
+            columns = []
+            for method in methods:
+                times = [r[0] for r in results[(name, method)]]
+                regrets = [r[1] for r in results[(name, method)]]
+                columns.append("{:>12.1f} / {:>9.2e}".format(
+                    statistics.median(times) * 1000, statistics.mean(regrets)))
+            print("{:>4} {:>15} {:>28} {:>28}".format(dim, name, *columns))
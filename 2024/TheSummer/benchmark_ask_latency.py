@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# coding: utf-8
+
+#---------------------------------------------------------------
+#  study.ask() のレイテンシを試行数ごとに測るベンチマーク
+#  before : optuna.integration.BoTorchSampler (Hitohudebayes の元になったコード)
+#           毎回全試行を変換し，制約を1試行ずつstorageから読む
+#  after  : Hitohudebayes.HitohudebayesSampler
+#           前回のaskから終わった試行だけを_TrialBufferに取り込む
+#  GPの学習時間を除くため，candidates_funcは探索範囲の中点を返すだけにしている．
+#
+#  使い方 : python benchmark_ask_latency.py [n_trials ...]
+#---------------------------------------------------------------
+
+import os
+import statistics
+import sys
+import tempfile
+import time
+import warnings
+
+import optuna
+from optuna.distributions import FloatDistribution
+from optuna.samplers._base import _CONSTRAINTS_KEY
+from optuna.trial import create_trial
+
+import Hitohudebayes
+
+
+N_PARAMS = 4
+N_ASKS = 20
+
+
+def midpoint_candidates_func(*args, **kwargs):
+    # HitohudebayesSampler(11引数) と BoTorchSampler(5引数) のどちらからも呼べるようにする
+    bounds = args[-2]
+    return ((bounds[0] + bounds[1]) / 2).unsqueeze(0)
+
+
+def constraints_func(trial):
+    return trial.user_attrs["constraints"]
+
+
+def make_study(sampler, storage, n_trials):
+    study = optuna.create_study(storage=storage, sampler=sampler, direction="minimize")
+    distributions = {f"x{i}": FloatDistribution(-5.0, 5.0) for i in range(N_PARAMS)}
+    for i in range(n_trials):
+        params = {name: (i % 97) / 10.0 - 4.8 for name in distributions}
+        study.add_trial(
+            create_trial(
+                params=params,
+                distributions=distributions,
+                value=float(i),
+                user_attrs={"constraints": [float(i % 3) - 1.0]},
+                system_attrs={_CONSTRAINTS_KEY: [float(i % 3) - 1.0]},
+            )
+        )
+    return study, distributions
+
+
+def measure(sampler, storage, n_trials):
+    study, distributions = make_study(sampler, storage, n_trials)
+    latencies = []
+    for i in range(N_ASKS):
+        start = time.perf_counter()
+        trial = study.ask(distributions)
+        latencies.append(time.perf_counter() - start)
+        trial.set_user_attr("constraints", [-1.0])
+        study.tell(trial, float(i))
+    # 最初のaskは全試行の取り込みを含むので別に報告する
+    return latencies[0], statistics.median(latencies[1:])
+
+
+if __name__ == '__main__':
+    warnings.simplefilter("ignore")
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    sizes = [int(n) for n in sys.argv[1:]] or [50, 500, 5000]
+    x_name_list = [f"x{i}" for i in range(N_PARAMS)]
+    x_min_max_list = [[-5.0, 5.0] for _ in range(N_PARAMS)]
+    x_weight_list = [1.0 for _ in range(N_PARAMS)]
+
+    print("{:>8} {:>22} {:>22}".format("n_trials", "before first/median[ms]", "after first/median[ms]"))
+    for n in sizes:
+        results = []
+        for name in ["before", "after"]:
+            if name == "before":
+                sampler = optuna.integration.BoTorchSampler(
+                    candidates_func=midpoint_candidates_func,
+                    constraints_func=constraints_func,
+                    n_startup_trials=1,
+                )
+            else:
+                sampler = Hitohudebayes.HitohudebayesSampler(
+                    x_name_list, x_min_max_list, x_weight_list, False, True, 2.0,
+                    candidates_func=midpoint_candidates_func,
+                    constraints_func=constraints_func,
+                    n_startup_trials=1,
+                )
+            with tempfile.TemporaryDirectory() as tmpdir:
+                storage = "sqlite:///" + os.path.join(tmpdir, "benchmark.db")
+                first, median = measure(sampler, storage, n)
+            results.append("{:>10.1f} / {:>9.1f}".format(first * 1000, median * 1000))
+        print("{:>8} {:>22} {:>22}".format(n, *results))
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# coding: utf-8
+
+#---------------------------------------------------------------
+#  目的関数+ロスモニターのGPの学習時間をモニター数ごとに測るベンチマーク
+#  batched : Hitohudebayes.GPModelCache (全出力を1つの多出力GPとして1回で学習)
+#  serial  : Hitohudebayes.GPModelListCache(max_workers=1) (出力ごとのGPを順番に学習)
+#  threads : Hitohudebayes.GPModelListCache(max_workers=None) (出力ごとのGPを並列に学習)
+#  毎回キャッシュをresetして，ハイパーパラメータの最適化を最初から行う．
+#  threadsは同じseedで2回学習し，事後平均が一致するか (決定的か) も確認する．
+#
+#  使い方 : python benchmark_fit_workers.py [n_monitors ...]
+#---------------------------------------------------------------
+
+import statistics
+import sys
+import time
+import warnings
+
+import torch
+
+import Hitohudebayes
+
+
+N_TRAIN = 60
+N_PARAMS = 4
+N_REPEAT = 3
+
+
+def make_data(n_monitors, seed=0):
+    # 目的関数(入射効率)と，それに相関したロスモニターの値
+    torch.manual_seed(seed)
+    train_x = torch.rand(N_TRAIN, N_PARAMS, dtype=torch.float64)
+    obj = -((train_x - 0.4) ** 2).sum(dim=-1, keepdim=True)
+    monitors = [
+        ((train_x - 0.1 * i) ** 2).sum(dim=-1, keepdim=True) + 0.05 * torch.sin(5 * train_x[:, i % N_PARAMS : i % N_PARAMS + 1])
+        for i in range(n_monitors)
+    ]
+    train_y = torch.cat([obj] + monitors, dim=-1)
+    return train_x, train_y + 0.01 * torch.randn_like(train_y)
+
+
+def make_cache(method):
+    if method == "batched":
+        return Hitohudebayes.GPModelCache()
+    if method == "serial":
+        return Hitohudebayes.GPModelListCache(max_workers=1)
+    return Hitohudebayes.GPModelListCache()
+
+
+def fit(method, train_x, train_y, seed=0):
+    cache = make_cache(method)
+    torch.manual_seed(seed)
+    start = time.perf_counter()
+    model = cache.get_model(train_x, train_y)
+    duration = time.perf_counter() - start
+    with torch.no_grad():
+        mean = model.posterior(train_x[:5]).mean
+    return duration, mean
+
+
+if __name__ == '__main__':
+    warnings.simplefilter("ignore")
+    sizes = [int(n) for n in sys.argv[1:]] or [1, 2, 3, 5, 8]
+    methods = ["batched", "serial", "threads"]
+
+    print("torch threads: {}".format(torch.get_num_threads()))
+    print("{:>10} {:>12} {:>12} {:>12} {:>14}".format(
+        "n_monitors", *["{}[s]".format(m) for m in methods], "deterministic"))
+    for n in sizes:
+        train_x, train_y = make_data(n)
+        results = []
+        for method in methods:
+            durations = [fit(method, train_x, train_y)[0] for _ in range(N_REPEAT)]
+            results.append("{:>12.3f}".format(statistics.median(durations)))
+        _, mean_a = fit("threads", train_x, train_y, seed=1)
+        _, mean_b = fit("threads", train_x, train_y, seed=1)
+        print("{:>10} {} {:>14}".format(n, " ".join(results), str(torch.equal(mean_a, mean_b))))
@@ -0,0 +1,250 @@
+r"""
+Draws the numeric diagnostics of the SafeOpt candidate functions outside the optimization.
+
+The candidate functions of the ``safeopt_code_*`` modules only produce dictionaries of NumPy
+arrays, and the tuning scripts describe their progress the same way. :class:`DiagnosticsRenderer`
+sends them to a separate process that owns the only matplotlib figure, so matplotlib is never
+imported by the optimization process and drawing does not add to the suggestion latency.
+"""
+from __future__ import annotations
+
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+import multiprocessing
+import queue
+import time
+
+
+class DiagnosticsRenderer:
+    """Renders diagnostics in a background process, throttled and reusing one figure.
+
+    Calling the renderer only puts the diagnostics into a queue of size one and returns
+    immediately. If the previous diagnostics have not been drawn yet, they are replaced, so
+    a slow renderer never holds back the optimization and only the latest state is drawn.
+
+    Example:
+        >>> renderer = DiagnosticsRenderer(min_interval=2.0)
+        >>> sampler = SafeOptSampler(..., diagnostics_callback=renderer)
+        >>> ...
+        >>> renderer.close()
+
+    Args:
+        min_interval:
+            Minimum time in seconds between two redraws.
+        savefig:
+            If given, the figure is also saved to this path after each redraw.
+        backend:
+            matplotlib backend of the rendering process, e.g. ``"Agg"`` to only save the
+            figure. If omitted, the default backend is used.
+        figsize:
+            Size of the figure in inches.
+    """
+
+    def __init__(
+        self,
+        min_interval: float = 1.0,
+        savefig: Optional[str] = None,
+        backend: Optional[str] = None,
+        figsize: Tuple[float, float] = (24, 6),
+    ) -> None:
+        # "spawn" so that the child does not inherit the torch and EPICS state of the parent.
+        context = multiprocessing.get_context("spawn")
+        self._queue = context.Queue(maxsize=1)
+        self._process = context.Process(
+            target=_render_loop,
+            args=(self._queue, min_interval, savefig, backend, figsize),
+            daemon=True,
+        )
+        self._process.start()
+
+    def __call__(self, diagnostics: Dict[str, Any]) -> None:
+        if not self._process.is_alive():
+            return
+        try:
+            self._queue.put_nowait(diagnostics)
+        except queue.Full:
+            # Replace the diagnostics that have not been drawn yet.
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                self._queue.put_nowait(diagnostics)
+            except queue.Full:
+                pass
+
+    def close(self, timeout: float = 5.0, block: bool = False) -> None:
+        """Stop the renderer.
+
+        With ``block``, the last figure stays on screen and the call returns once its window
+        has been closed, like ``plt.show()`` at the end of a script.
+        """
+        if self._process.is_alive():
+            try:
+                self._queue.put(_BLOCK if block else None, timeout=timeout)
+            except queue.Full:
+                pass
+            self._process.join(None if block else timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+
+
+# Message that makes the rendering process show the figure until its window is closed.
+_BLOCK = "block"
+
+
+def _render_loop(
+    diagnostics_queue: "multiprocessing.Queue",
+    min_interval: float,
+    savefig: Optional[str],
+    backend: Optional[str],
+    figsize: Tuple[float, float],
+) -> None:
+    import matplotlib
+
+    if backend is not None:
+        matplotlib.use(backend)
+    import matplotlib.pyplot as plt
+
+    plt.ion()
+    fig = None
+    last_draw = 0.0
+    while True:
+        try:
+            diagnostics = diagnostics_queue.get(timeout=0.1)
+        except queue.Empty:
+            if fig is not None:
+                # Keep the window responsive while waiting.
+                fig.canvas.flush_events()
+            continue
+        if diagnostics is None:
+            break
+        if diagnostics == _BLOCK:
+            if fig is not None:
+                plt.ioff()
+                plt.show()
+            break
+
+        wait = last_draw + min_interval - time.monotonic()
+        if wait > 0 and fig is not None:
+            plt.pause(wait)
+            # Newer diagnostics may have arrived in the meantime.
+            try:
+                newer = diagnostics_queue.get_nowait()
+            except queue.Empty:
+                newer = diagnostics
+            if newer is None or newer == _BLOCK:
+                # Draw the latest diagnostics before stopping.
+                diagnostics_queue.put(newer)
+            else:
+                diagnostics = newer
+
+        if fig is None:
+            fig = plt.figure(figsize=figsize)
+        fig.clear()
+        if diagnostics["kind"] == "acquisition_grid":
+            _draw_acquisition_grid(fig, diagnostics)
+        elif diagnostics["kind"] == "safe_set":
+            _draw_safe_set(fig, diagnostics)
+        elif diagnostics["kind"] == "progress":
+            _draw_progress(fig, diagnostics)
+        fig.tight_layout()
+        fig.canvas.draw_idle()
+        plt.pause(0.001)
+        if savefig is not None:
+            fig.savefig(savefig)
+        last_draw = time.monotonic()
+
+    plt.close("all")
+
+
+def _draw_acquisition_grid(fig, diagnostics: Dict[str, Any]) -> None:
+    X = diagnostics["grid_x"]
+    Y = diagnostics["grid_y"]
+    train_x = diagnostics["train_x"]
+    # Only the acquisition functions that were computed get a panel.
+    panels = [
+        (title, values)
+        for title, values in [
+            ("Objective Function (Acquisition)", diagnostics["acq_obj"]),
+            ("Constraint Function (Acquisition)", diagnostics["acq_con"]),
+            ("Constrained Acquisition Function", diagnostics["acq_constrained"]),
+        ]
+        if values is not None
+    ]
+    axes = fig.subplots(1, len(panels), squeeze=False)[0]
+    for ax, (title, values) in zip(axes, panels):
+        contour = ax.contourf(X, Y, values, levels=50, cmap="plasma")
+        ax.scatter(train_x[:, 0], train_x[:, 1], color="white", marker="x", label="Training Data")
+        ax.set_title(title)
+        ax.set_xlabel("X1")
+        ax.set_ylabel("X2")
+        fig.colorbar(contour, ax=ax)
+    grid_max = diagnostics["grid_max"]
+    candidate = diagnostics["candidate"]
+    axes[-1].scatter(grid_max[0], grid_max[1], color="cyan", marker="o", s=100, label="Max Value")
+    axes[-1].scatter(candidate[0], candidate[1], color="lime", marker="*", s=150, label="Candidate")
+    axes[-1].legend()
+
+
+def _draw_safe_set(fig, diagnostics: Dict[str, Any]) -> None:
+    points = diagnostics["points"]
+    train_x = diagnostics["train_x"]
+    candidate = diagnostics["candidate"]
+    ax = fig.subplots(1, 1)
+    if points.shape[1] != 2:
+        # Only the first two parameters are shown beyond 2-D.
+        ax.set_title("Safe Set (X1, X2 projection)")
+    else:
+        ax.set_title("Safe Set")
+    ax.scatter(points[:, 0], points[:, 1], color="lightgray", marker="s", s=4, label="Unsafe")
+    for name, color in [("safe", "green"), ("expanders", "orange"), ("maximizers", "magenta")]:
+        cells = points[diagnostics[name]]
+        ax.scatter(cells[:, 0], cells[:, 1], color=color, marker="s", s=4, label=name)
+    ax.scatter(train_x[:, 0], train_x[:, 1], color="black", marker="x", label="Training Data")
+    ax.scatter(candidate[0], candidate[1], color="cyan", marker="o", s=100, label="Next")
+    ax.set_xlabel("X1")
+    ax.set_ylabel("X2")
+    ax.legend()
+
+
+def _draw_progress(fig, diagnostics: Dict[str, Any]) -> None:
+    # Objective and best value per trial on the left, the visited parameters on the right.
+    trials = diagnostics["trials"]
+    values = diagnostics["values"]
+    best_values = diagnostics["best_values"]
+    params = diagnostics["params"]
+    vmin, vmax = diagnostics.get("value_range", (None, None))
+    ax1, ax2 = fig.subplots(1, 2)
+
+    ax1.plot(trials, values, color="tab:blue")
+    ax1.scatter(trials[:-1], values[:-1], color="tab:blue", s=100)
+    ax1.scatter(trials[-1:], values[-1:], color="tab:blue", s=150, marker="*")
+    ax1.plot(trials, best_values, color="tab:orange")
+    ax1.scatter(trials[:-1], best_values[:-1], color="tab:orange", s=100)
+    ax1.scatter(trials[-1:], best_values[-1:], color="tab:orange", s=150, marker="*")
+    ax1.set_ylim(vmin, vmax)
+    ax1.set_xlabel("Trial", fontsize=30)
+    ax1.set_ylabel(diagnostics.get("value_label", "Objective"), fontsize=30)
+    ax1.grid()
+
+    ax2.plot(params[:, 0], params[:, 1], marker="", linestyle="-", color="gray")
+    sc = ax2.scatter(
+        params[:-1, 0], params[:-1, 1], c=values[:-1], cmap="coolwarm", marker="o", s=100,
+        vmin=vmin, vmax=vmax,
+    )
+    ax2.scatter(
+        params[-1:, 0], params[-1:, 1], c=values[-1:], cmap="coolwarm", marker="*", s=150,
+        vmin=vmin, vmax=vmax,
+    )
+    ax2.set_xlabel("param 1", fontsize=30)
+    ax2.set_ylabel("param 2", fontsize=30)
+    if diagnostics.get("param_xlim") is not None:
+        ax2.set_xlim(*diagnostics["param_xlim"])
+    if diagnostics.get("param_ylim") is not None:
+        ax2.set_ylim(*diagnostics["param_ylim"])
+    ax2.grid()
+    cbar = fig.colorbar(sc, ax=ax2, label=diagnostics.get("value_label", "Objective"))
+    cbar.ax.yaxis.label.set_size(30)
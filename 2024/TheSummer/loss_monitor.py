@@ -0,0 +1,106 @@
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Sequence
+import threading
+
+import numpy as np
+from epics import PV
+
+
+class LossMonitorWatcher:
+    """Subscribes to the loss monitors and keeps their running max and mean in this process.
+
+    Every update of a loss monitor updates its statistics in the CA callback thread in
+    constant time, so the constraint of a trial is the maximum loss over the whole
+    measurement, including the spikes between two samples of the objective, without an
+    external ``camonitor`` process, text parsing or a ``caget`` per sample.
+
+    The statistics cover the updates since the last :meth:`reset`. The value in effect at the
+    reset counts as the first update, so that a monitor that does not update during a short
+    measurement still has a value.
+
+    Example:
+        >>> watcher = LossMonitorWatcher(lm_name_list)
+        >>> setValueX_PV(...)
+        >>> watcher.reset()
+        >>> ...  # measure the objective
+        >>> c_vals = watcher.max().tolist()
+
+    Args:
+        names:
+            Names of the loss monitor PVs.
+        timeout:
+            Time in seconds to wait for the connections.
+        verbose:
+            If True, every update is printed, as the ``camonitor`` threads did.
+
+    Raises:
+        ConnectionError:
+            If some of the PVs do not connect within ``timeout``.
+    """
+
+    def __init__(self, names: Sequence[str], timeout: float = 5.0, verbose: bool = False) -> None:
+        self.names: List[str] = list(names)
+        self._index: Dict[str, int] = {name: i for i, name in enumerate(self.names)}
+        self._verbose = verbose
+        self._lock = threading.Lock()
+        n = len(self.names)
+        self._last = np.full(n, np.nan)
+        self._max = np.full(n, -np.inf)
+        self._sum = np.zeros(n)
+        self._count = np.zeros(n, dtype=np.int64)
+        self._pvs = [
+            PV(name, auto_monitor=True, connection_timeout=timeout, callback=self._on_update)
+            for name in self.names
+        ]
+
+        failed = [pv.pvname for pv in self._pvs if not pv.wait_for_connection(timeout=timeout)]
+        if failed:
+            raise ConnectionError("Could not connect to PVs: {}".format(", ".join(failed)))
+
+    def reset(self) -> None:
+        """Start new statistics from the current values of the monitors."""
+        with self._lock:
+            known = ~np.isnan(self._last)
+            self._max = np.where(known, self._last, -np.inf)
+            self._sum = np.where(known, self._last, 0.0)
+            self._count = known.astype(np.int64)
+
+    def max(self) -> np.ndarray:
+        """Maximum of each monitor since the last reset, NaN if it has no value yet."""
+        with self._lock:
+            return np.where(self._count > 0, self._max, np.nan)
+
+    def mean(self) -> np.ndarray:
+        """Mean of the updates of each monitor since the last reset, NaN if there are none."""
+        with self._lock:
+            return np.where(self._count > 0, self._sum / np.maximum(self._count, 1), np.nan)
+
+    def count(self) -> np.ndarray:
+        with self._lock:
+            return self._count.copy()
+
+    def last(self) -> np.ndarray:
+        with self._lock:
+            return self._last.copy()
+
+    def close(self) -> None:
+        for pv in self._pvs:
+            pv.clear_callbacks()
+            pv.disconnect()
+        self._pvs = []
+
+    def _on_update(self, pvname: str = "", value: Any = None, **kwargs: Any) -> None:
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        i = self._index[pvname]
+        with self._lock:
+            self._last[i] = value
+            self._max[i] = max(self._max[i], value)
+            self._sum[i] += value
+            self._count[i] += 1
+        if self._verbose:
+            print("{}: {}".format(pvname, value))
@@ -17,6 +17,7 @@ import threading
 import time, datetime
 import configparser
 import numpy as np
+from typing import Optional
 
 import torch
 from botorch.acquisition import AcquisitionFunction
@@ -29,9 +30,19 @@ from torch.nn import Module
 class ProximalAcquisitionFunction(AcquisitionFunction):
     """A wrapper around AcquisitionFunctions to add proximal weighting of the
     acquisition function. Acquisition function is weighted via a squared exponential
-    centered at the last training point, with varying lengthscales corresponding to
-    `proximal_weights`. Can only be used with acquisition functions based on single
-    batch models.
+    centered at an anchor point, with varying lengthscales corresponding to
+    `proximal_weights`.
+
+    The anchor is the current setpoint of the machine (`Xold` of the drivers) if given,
+    otherwise the last training point. The weight is evaluated in log space: it is added
+    to acquisition functions that return log values (LogEI, qLogEI) and multiplied onto
+    all others. Multiplying a negative value by a weight below one would move it up,
+    i.e. away from the anchor, so non-log acquisition values must be non-negative
+    (EI, qEI, qNEI, qEHVI, ...). Acquisition functions that can be negative (UCB,
+    PosteriorMean) need `beta`, which maps them through a softplus first. MC-based
+    acquisition functions can be wrapped as well, and for `q > 1` the log weights of
+    the `q` points are summed, i.e. every point of the batch is biased towards the
+    anchor.
 
     Small values of `proximal_weights` corresponds to strong biasing towards recently
     observed points, which smoothes optimization with a small potential decrese in
@@ -49,82 +60,117 @@ class ProximalAcquisitionFunction(AcquisitionFunction):
         self,
         acq_function: AcquisitionFunction,
         proximal_weights: Tensor,
-        UCB: bool,
-        logEI: bool,
+        beta: Optional[float] = None,
+        logEI: bool = False,
+        anchor: Optional[Tensor] = None,
     ) -> None:
-        r"""Derived Acquisition Function weighted by proximity to recently
-        observed point.
+        r"""Derived Acquisition Function weighted by proximity to the current setpoint.
 
         Args:
             acq_function: The base acquisition function, operating on input tensors
                 of feature dimension `d`.
             proximal_weights: A `d` dim tensor used to bias locality
                 along each axis.
+            beta: If not None, the values of a non-log `acq_function` are passed
+                through `softplus(value, beta)` before the weighting, which allows
+                negative values. Larger values follow the base values more closely.
+            logEI: If True, `acq_function` is treated as returning log values even if
+                it is not a LogEI class.
+            anchor: A `d` dim tensor of the point to bias towards, in the same
+                (normalized) space as the model inputs. Defaults to the last training
+                point.
         """
         Module.__init__(self)
 
         self.acq_func = acq_function
-        self.UCB = UCB
+        self.beta = beta
         self.logEI = logEI
+        self.log_acqf = logEI or _returns_log_values(acq_function)
 
-        if hasattr(acq_function, "X_pending"):
-            if acq_function.X_pending is not None:
-                raise BotorchWarning(
-                    "Proximal biasing behavior will be based on pending "
-                    "observation points, may result in unintuitive "
-                    "behavior."
-                )
-            self.X_pending = acq_function.X_pending
+        # check to make sure that weights match the feature dimension
+        if len(proximal_weights.shape) != 1:
+            raise ValueError("`proximal_weights` must be a one dimensional tensor.")
 
-        self.register_buffer("proximal_weights", proximal_weights)
-
-        # check model for train_inputs and single batch
-        if not hasattr(self.acq_func.model, "train_inputs"):
-            raise UnsupportedError(
-                "Acquisition function model must have " "`train_inputs`."
-            )
-
-        if (
-            self.acq_func.model.batch_shape != torch.Size([])
-            and self.acq_func.model.train_inputs[0].shape[1] != 1
-        ):
-            raise UnsupportedError(
-                "Proximal acquisition function requires a single batch model"
-            )
-
-        # check to make sure that weights match the training data shape
-        if (
-            len(self.proximal_weights.shape) != 1
-            or self.proximal_weights.shape[0]
-            != self.acq_func.model.train_inputs[0][-1].shape[-1]
-        ):
+        if anchor is None:
+            anchor = _last_train_input(self.acq_func.model)
+        anchor = anchor.reshape(-1).to(proximal_weights)
+        if anchor.shape != proximal_weights.shape:
             raise ValueError(
                 "`proximal_weights` must be a one dimensional tensor with "
                 "same feature dimension as model."
             )
 
-    @t_batch_mode_transform(expected_q=1, assert_output_shape=False)
+        # 毎回の評価で割り算をしないように，長さスケールの逆数の2乗を先に計算しておく
+        self.register_buffer("proximal_weights", proximal_weights)
+        self.register_buffer("inv_sq_weights", proximal_weights.pow(-2))
+        self.register_buffer("anchor", anchor)
+
+    @property
+    def model(self):
+        # optimize_acqf(sequential=True) looks up the model of the acquisition function.
+        return self.acq_func.model
+
+    @property
+    def X_pending(self) -> Optional[Tensor]:
+        return getattr(self.acq_func, "X_pending", None)
+
+    def set_X_pending(self, X_pending: Optional[Tensor] = None) -> None:
+        # Pending points are handled by the base acquisition function.
+        self.acq_func.set_X_pending(X_pending)
+
+    def log_proximal_weight(self, X: Tensor) -> Tensor:
+        r"""Log of the proximal weight of each t-batch.
+
+        Args:
+            X: A `batch_shape x q x d`-dim Tensor.
+
+        Returns:
+            A `batch_shape`-dim Tensor.
+        """
+        return -0.5 * ((X - self.anchor).pow(2) * self.inv_sq_weights).sum(dim=(-2, -1))
+
+    @t_batch_mode_transform(assert_output_shape=False)
     def forward(self, X: Tensor) -> Tensor:
         r"""Evaluate base acquisition function with proximal weighting.
 
         Args:
-            X: Input tensor of feature dimension `d` .
+            X: A `batch_shape x q x d`-dim Tensor.
 
         Returns:
-            Base acquisition function evaluated on tensor `X` multiplied by proximal
-            weighting.
+            Base acquisition function evaluated on tensor `X` with the proximal
+            weighting applied.
+
+        Raises:
+            RuntimeError: If a non-log `acq_function` returns negative values and `beta`
+                is None.
         """
-        
-        last_X = self.acq_func.model.train_inputs[0][-1].reshape(1, 1, -1)
-        diff = X - last_X
-        
-        M = torch.linalg.norm(diff /self.proximal_weights, dim=-1) ** 2
-        proximal_acq_weight = torch.exp(-0.5 * M)
-        
-        if  self.logEI == True:
-            #print("yeah!!")
-            return self.acq_func(X) + torch.log(proximal_acq_weight.flatten())
-        elif self.UCB == True:
-            #print("yooh!!")
-            return self.acq_func(X) * proximal_acq_weight.flatten()
-        else : print("The acquisition function is not correctly selected.")
\ No newline at end of file
+        value = self.acq_func(X)
+        log_weight = self.log_proximal_weight(X)
+        if self.log_acqf:
+            return value + log_weight
+        if self.beta is not None:
+            value = torch.nn.functional.softplus(value, beta=self.beta)
+        elif (value < 0).any():
+            raise RuntimeError(
+                "Cannot use proximal biasing for negative acquisition function values, "
+                "set a value for beta to fix this with a softplus transform."
+            )
+        return value * torch.exp(log_weight)
+
+
+def _returns_log_values(acq_function: AcquisitionFunction) -> bool:
+    # botorch>=0.9 marks the LogEI family with `_log`. Older versions are recognized by name.
+    if getattr(acq_function, "_log", False):
+        return True
+    return type(acq_function).__name__.startswith(("Log", "qLog"))
+
+
+def _last_train_input(model) -> Tensor:
+    if hasattr(model, "models"):
+        # ModelListGP
+        model = model.models[0]
+    if not hasattr(model, "train_inputs"):
+        raise UnsupportedError(
+            "Acquisition function model must have " "`train_inputs`."
+        )
+    return model.train_inputs[0][..., -1, :]
@@ -0,0 +1,288 @@
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+import threading
+import time
+
+import numpy as np
+from epics import PV
+from epics import ca
+
+
+class RingBuffer:
+    """Fixed-size buffer of the latest ``(time, value)`` updates of a monitored PV.
+
+    The times are ``time.monotonic()`` at the arrival of the update, so that they compare
+    with the time of a setpoint change taken on this host, whatever the clock of the IOC.
+
+    Args:
+        capacity:
+            Number of updates kept. Older updates are overwritten.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        if capacity < 1:
+            raise ValueError("capacity must be positive.")
+        self._times = np.full(capacity, -np.inf)
+        self._values = np.full(capacity, np.nan)
+        self._n = 0
+
+    def append(self, t: float, value: float) -> None:
+        i = self._n % len(self._times)
+        self._values[i] = value
+        self._times[i] = t
+        self._n += 1
+
+    def __len__(self) -> int:
+        return min(self._n, len(self._times))
+
+    def last_value(self) -> float:
+        if self._n == 0:
+            return np.nan
+        return float(self._values[(self._n - 1) % len(self._times)])
+
+    def last_time(self) -> float:
+        if self._n == 0:
+            return -np.inf
+        return float(self._times[(self._n - 1) % len(self._times)])
+
+    def snapshot(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Return copies of the kept times and values, oldest first."""
+        capacity = len(self._times)
+        if self._n <= capacity:
+            return self._times[: self._n].copy(), self._values[: self._n].copy()
+        start = self._n % capacity
+        order = np.r_[start:capacity, 0:start]
+        return self._times[order], self._values[order]
+
+    def since(self, t: float) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the kept updates that arrived after ``t``, oldest first."""
+        times, values = self.snapshot()
+        fresh = times > t
+        return times[fresh], values[fresh]
+
+    def value_at(self, t: float) -> Optional[float]:
+        """Return the value in effect at ``t``, i.e. the latest update not after ``t``."""
+        times, values = self.snapshot()
+        i = np.searchsorted(times, t, side="right")
+        if i == 0:
+            return None
+        return float(values[i - 1])
+
+
+class PVPool:
+    """Keeps one connected ``epics.PV`` per name and reads groups of them in one batch.
+
+    Module-level ``caget`` and ``caput`` look the channel up by name on every call and read
+    one PV per round trip. The pool connects every PV of the run once at startup, so that a
+    PV that cannot be reached is reported before the first trial instead of in the middle of
+    a measurement. :meth:`get_many` then sends the read requests of all the given PVs before
+    waiting for any of them, so a sample costs one network round trip however many PVs it
+    reads.
+
+    Example:
+        >>> pvs = PVPool(x_name_list + y_name_list + th_name_list + lm_name_list)
+        >>> y_values = pvs.get_many(y_name_list)
+        >>> pvs.put(x_name_list[0], 1.0)
+
+    Args:
+        names:
+            Names of the PVs to connect. Duplicates are connected once.
+        timeout:
+            Time in seconds to wait for the connections and for each read.
+        monitored:
+            Names of the PVs to subscribe to. Each of their updates is pushed into a
+            :class:`RingBuffer`, from which :meth:`next_sample` reads without polling.
+        capacity:
+            Number of updates kept per monitored PV.
+
+    Raises:
+        ConnectionError:
+            If some of the PVs do not connect within ``timeout``.
+    """
+
+    def __init__(
+        self,
+        names: Sequence[str],
+        timeout: float = 5.0,
+        monitored: Sequence[str] = (),
+        capacity: int = 1024,
+    ) -> None:
+        self._timeout = timeout
+        self._pvs: Dict[str, PV] = {}
+        self._buffers: Dict[str, RingBuffer] = {}
+        # Notified by the monitor callbacks, which run in the CA thread.
+        self._updated = threading.Condition()
+        for name in list(names) + list(monitored):
+            if name in self._pvs:
+                continue
+            if name in monitored:
+                self._buffers[name] = RingBuffer(capacity)
+                self._pvs[name] = PV(
+                    name,
+                    auto_monitor=True,
+                    connection_timeout=timeout,
+                    callback=self._on_update,
+                )
+            else:
+                # Values are read on demand, so the PVs are not monitored.
+                self._pvs[name] = PV(name, auto_monitor=False, connection_timeout=timeout)
+
+        failed = [
+            name for name, pv in self._pvs.items() if not pv.wait_for_connection(timeout=timeout)
+        ]
+        if failed:
+            raise ConnectionError("Could not connect to PVs: {}".format(", ".join(failed)))
+
+    def __getitem__(self, name: str) -> PV:
+        return self._pvs[name]
+
+    def get(self, name: str) -> Any:
+        return self._pvs[name].get(timeout=self._timeout)
+
+    def get_many(self, names: Sequence[str]) -> List[Any]:
+        """Read the PVs in one batch. A PV that does not answer in time reads as None."""
+        chids = [self._pvs[name].chid for name in names]
+        for chid in chids:
+            ca.get(chid, wait=False)
+        ca.poll()
+        return [ca.get_complete(chid, timeout=self._timeout) for chid in chids]
+
+    def buffer(self, name: str) -> RingBuffer:
+        return self._buffers[name]
+
+    def next_sample(
+        self, names: Sequence[str], since: float, timeout: Optional[float] = None
+    ) -> Optional[Tuple[float, List[Optional[float]]]]:
+        """Wait for the first update of ``names[0]`` after ``since`` and return one sample.
+
+        ``names[0]`` is the clock of the sample: the call returns as soon as it updates, so the
+        sampling rate is the update rate of the IOC. The other PVs contribute the value they
+        had at that update, which lets slow PVs, such as thresholds, be sampled with a fast
+        one. Pass the returned time as ``since`` of the next call to get consecutive samples.
+
+        Args:
+            names:
+                Names of monitored PVs. The first one sets the time of the sample.
+            since:
+                ``time.monotonic()`` after which the sample must arrive, e.g. the end of the
+                setpoint change.
+            timeout:
+                Time in seconds to wait for the update. Defaults to the timeout of the pool.
+
+        Returns:
+            ``(time, values)`` with the values in the order of ``names``, or None if
+            ``names[0]`` did not update in time. A PV that had no value yet reads as None.
+        """
+        if timeout is None:
+            timeout = self._timeout
+        clock = self._buffers[names[0]]
+        deadline = time.monotonic() + timeout
+        with self._updated:
+            while clock.last_time() <= since:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._updated.wait(remaining)
+            times, values = clock.since(since)
+            t = float(times[0])
+            sample = [float(values[0])] + [self._buffers[name].value_at(t) for name in names[1:]]
+        return t, sample
+
+    def wait_settled(
+        self, targets: Dict[str, Tuple[float, float]], timeout: float
+    ) -> Optional[float]:
+        """Wait until every monitored readback is within tolerance of its target.
+
+        Args:
+            targets:
+                ``{readback name: (target, tolerance)}``. The readbacks must be monitored.
+            timeout:
+                Time in seconds to wait at most.
+
+        Returns:
+            The time in seconds it took to settle, or None if some readback was still out of
+            tolerance after ``timeout``.
+        """
+        start = time.monotonic()
+        deadline = start + timeout
+        with self._updated:
+            # A readback without a value yet is NaN and never within tolerance.
+            while not all(
+                abs(self._buffers[name].last_value() - target) <= tolerance
+                for name, (target, tolerance) in targets.items()
+            ):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._updated.wait(remaining)
+        return time.monotonic() - start
+
+    def _on_update(self, pvname: str = "", value: Any = None, **kwargs: Any) -> None:
+        t = time.monotonic()
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        with self._updated:
+            self._buffers[pvname].append(t, value)
+            self._updated.notify_all()
+
+    def put(
+        self, name: str, value: Any, wait: bool = False, timeout: Optional[float] = None
+    ) -> Any:
+        """Write ``value``. With ``wait``, block until the IOC reports the put as complete.
+
+        Returns the result of ``epics.PV.put``, which is -1 if a waited put timed out.
+        """
+        if timeout is None:
+            timeout = self._timeout
+        return self._pvs[name].put(value, wait=wait, timeout=timeout)
+
+    def put_many(self, values: Dict[str, Any], timeout: Optional[float] = None) -> List[str]:
+        """Write several PVs at once and wait for all of their put completions together.
+
+        All the puts are sent before waiting for any of them, so the call takes as long as the
+        slowest device instead of the sum over the devices.
+
+        Args:
+            values:
+                ``{name: value}`` to write.
+            timeout:
+                Deadline in seconds for all the completions. Defaults to the timeout of the
+                pool.
+
+        Returns:
+            Names of the PVs whose put did not complete before the deadline, empty if all did.
+        """
+        if timeout is None:
+            timeout = self._timeout
+        deadline = time.monotonic() + timeout
+        pending = set(values)
+        completed = threading.Condition()
+
+        def on_complete(pvname: str = "", **kwargs: Any) -> None:
+            with completed:
+                pending.discard(pvname)
+                completed.notify_all()
+
+        for name, value in values.items():
+            # Returns at once; on_complete is called from the CA thread.
+            self._pvs[name].put(value, callback=on_complete, use_complete=True)
+        with completed:
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                completed.wait(remaining)
+            return [name for name in values if name in pending]
+
+    def disconnect(self) -> None:
+        for pv in self._pvs.values():
+            pv.clear_callbacks()
+            pv.disconnect()
+        self._pvs = {}
+        self._buffers = {}
@@ -0,0 +1,193 @@
+r"""
+Wall-clock cost of moving the magnets to a candidate, for cost-aware acquisition.
+
+``setValueX_PV`` ramps every parameter in ``int(abs(dx) / step) + 1`` sub-steps and sleeps
+``WaitTime`` after each of them, so a far-away candidate costs many times the measurement
+itself. :class:`RampCostModel` predicts the time of a trial from the current setpoint, and
+:class:`CostAwareAcquisitionFunction` divides an acquisition function by it, so that the
+optimization maximizes the improvement per second instead of per trial.
+"""
+from __future__ import annotations
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+import numpy as np
+import torch
+from botorch.acquisition import AcquisitionFunction
+from botorch.utils import t_batch_mode_transform
+from botorch.utils.transforms import unnormalize
+from torch import Tensor
+from torch.nn import Module
+
+import proximal
+
+
+class RampCostModel:
+    """Predicts the duration of a trial as ``wait_time * n_steps + measurement_time``.
+
+    ``n_steps`` is the number of ramp sub-steps of the slowest parameter, as in
+    ``setValueX_PV``. The initial ``wait_time`` and ``measurement_time`` are the configured
+    ones. With ``learn``, every observed trial duration is recorded by :meth:`observe`, and
+    once ``min_observations`` trials with different ``n_steps`` have been seen, both
+    coefficients are re-estimated by least squares, which also absorbs the overhead of
+    ``caput`` and of the sampler.
+
+    Example:
+        >>> cost_model = RampCostModel(x_name_list, x_step_list, WaitTime, dataN * 1.1)
+        >>> sampler = HitohudebayesSampler(..., ramp_cost_model=cost_model)
+
+    Args:
+        x_name_list:
+            Names of the parameters.
+        x_step_list:
+            Ramp step of each parameter, in the order of ``x_name_list``.
+        wait_time:
+            Sleep in seconds after each ramp sub-step.
+        measurement_time:
+            Time in seconds spent measuring a trial once the magnets are set.
+        learn:
+            If True, the coefficients are learned from the observed trial durations.
+        min_observations:
+            Number of observed trials needed before the learned coefficients are used.
+    """
+
+    def __init__(
+        self,
+        x_name_list: Sequence[str],
+        x_step_list: Sequence[float],
+        wait_time: float,
+        measurement_time: float = 0.0,
+        learn: bool = True,
+        min_observations: int = 3,
+    ) -> None:
+        if len(x_name_list) != len(x_step_list):
+            raise ValueError("x_name_list and x_step_list must have the same length.")
+        self._steps = dict(zip(x_name_list, (float(s) for s in x_step_list)))
+        self._learn = learn
+        self._min_observations = min_observations
+        self.wait_time = float(wait_time)
+        self.measurement_time = float(measurement_time)
+        self.observations: List[Tuple[int, float]] = []
+
+    def step_sizes(self, names: Sequence[str]) -> List[float]:
+        # Parameters that are not ramped do not cost anything.
+        return [self._steps.get(name, float("inf")) for name in names]
+
+    def n_steps(self, setpoint: Dict[str, Any], params: Dict[str, Any]) -> int:
+        """Number of ramp sub-steps from ``setpoint`` to ``params``, as in ``setValueX_PV``."""
+        return max(
+            (
+                int(abs(params[name] - setpoint[name]) / step) + 1
+                for name, step in self._steps.items()
+                if name in params and name in setpoint
+            ),
+            default=1,
+        )
+
+    def predict(self, n_steps: float) -> float:
+        return self.wait_time * n_steps + self.measurement_time
+
+    def observe(self, n_steps: int, duration: float) -> None:
+        """Record the duration of a trial that took ``n_steps`` ramp sub-steps."""
+        if not self._learn:
+            return
+        self.observations.append((n_steps, duration))
+        n, t = np.array(self.observations, dtype=np.float64).T
+        if len(n) < self._min_observations or np.ptp(n) == 0:
+            return
+        wait_time, measurement_time = np.polyfit(n, t, 1)
+        self.wait_time = max(float(wait_time), 0.0)
+        self.measurement_time = max(float(measurement_time), 0.0)
+
+    def at(self, setpoint: Tensor, names: Sequence[str]) -> "RampCost":
+        """Return the cost function from ``setpoint``, whose entries follow ``names``."""
+        step_sizes = torch.tensor(
+            self.step_sizes(names), dtype=setpoint.dtype, device=setpoint.device
+        )
+        return RampCost(setpoint, step_sizes, self.wait_time, self.measurement_time)
+
+
+class RampCost:
+    """Smooth, differentiable cost in seconds of visiting candidates from a fixed setpoint.
+
+    The integer number of sub-steps is relaxed to ``|dx| / step + 1`` and the maximum over the
+    parameters to a log-sum-exp with a temperature of one sub-step, so that gradient-based
+    acquisition optimization sees a continuous cost. For a batch of ``q`` candidates, the
+    candidates are visited in order and the costs of the moves are summed.
+    """
+
+    def __init__(
+        self, setpoint: Tensor, step_sizes: Tensor, wait_time: float, measurement_time: float
+    ) -> None:
+        self.setpoint = setpoint.reshape(-1)
+        self.step_sizes = step_sizes
+        self.wait_time = wait_time
+        self.measurement_time = measurement_time
+
+    def __call__(self, X: Tensor) -> Tensor:
+        """Cost of the ``batch_shape x q x d`` candidates ``X``, of shape ``batch_shape``."""
+        start = self.setpoint.to(X).expand(*X.shape[:-2], 1, X.size(-1))
+        dx = torch.diff(torch.cat([start, X], dim=-2), dim=-2)
+        scale = self.step_sizes.to(X)
+        finite = torch.isfinite(scale)
+        # Smooth |dx| so that the gradient exists at the setpoint.
+        abs_dx = (dx.pow(2) + (1e-3 * scale.where(finite, torch.ones_like(scale))).pow(2)).sqrt()
+        n_steps = torch.where(finite, abs_dx / scale, torch.zeros_like(abs_dx)) + 1
+        n_steps = torch.logsumexp(n_steps, dim=-1)
+        cost = (self.wait_time * n_steps + self.measurement_time).sum(dim=-1)
+        # A learned cost of zero would make the acquisition value infinite.
+        return cost.clamp_min(1e-3)
+
+
+class CostAwareAcquisitionFunction(AcquisitionFunction):
+    """Divides an acquisition function by the :class:`RampCost` of its candidates.
+
+    The result is the expected improvement (or hypervolume improvement) per second of ramping
+    and measuring. Acquisition functions that return log values, such as LogEI, get the log
+    of the cost subtracted instead. The base acquisition function should be non-negative,
+    which holds for the EI and EHVI families but not for UCB.
+
+    Args:
+        acq_function:
+            The base acquisition function, on the normalized inputs of the model.
+        ramp_cost:
+            A :class:`RampCost` in the unnormalized parameter space.
+        bounds:
+            Bounds of shape ``(2, d)`` used to unnormalize the inputs for ``ramp_cost``.
+    """
+
+    def __init__(
+        self, acq_function: AcquisitionFunction, ramp_cost: RampCost, bounds: Tensor
+    ) -> None:
+        Module.__init__(self)
+        self.acq_func = acq_function
+        self.ramp_cost = ramp_cost
+        self.register_buffer("bounds", bounds)
+        self.log_acqf = getattr(acq_function, "log_acqf", None)
+        if self.log_acqf is None:
+            self.log_acqf = proximal._returns_log_values(acq_function)
+
+    @property
+    def model(self):
+        # optimize_acqf(sequential=True) looks up the model of the acquisition function.
+        return self.acq_func.model
+
+    @property
+    def X_pending(self) -> Optional[Tensor]:
+        return getattr(self.acq_func, "X_pending", None)
+
+    def set_X_pending(self, X_pending: Optional[Tensor] = None) -> None:
+        self.acq_func.set_X_pending(X_pending)
+
+    @t_batch_mode_transform(assert_output_shape=False)
+    def forward(self, X: Tensor) -> Tensor:
+        value = self.acq_func(X)
+        cost = self.ramp_cost(unnormalize(X, bounds=self.bounds))
+        if self.log_acqf:
+            return value - cost.log()
+        return value / cost
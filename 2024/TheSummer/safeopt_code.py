@@ -30,7 +30,6 @@ import proximal
 import sys
 import configparser
 from epics import PV, caget, caput
-import matplotlib.pyplot as plt
 
 
 
@@ -86,7 +85,7 @@ def constrained_candidates_func(
     beta_obj: float = 2.0,
     beta_con: float = 2.0,
     constraint_threshold: float = 0.5,
-    fig=None, ax=None,
+    diagnostics: Optional[Callable[[Dict[str, Any]], None]] = None,
 ) -> torch.Tensor:
     
     if train_con is not None:
@@ -133,8 +132,8 @@ def constrained_candidates_func(
     grid_size = 50
     x = torch.linspace(0, 1, grid_size)
     y = torch.linspace(0, 1, grid_size)
-    X, Y = torch.meshgrid(x, y)
-    XY = torch.stack([X.ravel(), Y.ravel()], dim=-1).to(train_x.device)
+    X, Y = torch.meshgrid(x, y, indexing="ij")
+    XY = torch.stack([X.ravel(), Y.ravel()], dim=-1).to(train_x)
     XY = XY.unsqueeze(1)
     
     with torch.no_grad():
@@ -188,43 +187,19 @@ def constrained_candidates_func(
         print("RuntimeError encountered:", e)
         raise e
 
-    if fig is not None:
-        plt.close(fig)
-
-    fig, ax = plt.subplots(1, 3, figsize=(24, 6))
-
-    # 目的関数の獲得関数の最大値をプロット
-    obj_acq_contour = ax[0].contourf(X.numpy(), Y.numpy(), acq_values_obj, levels=50, cmap="viridis")
-    ax[0].scatter(train_x[:, 0].cpu().numpy(), train_x[:, 1].cpu().numpy(), color="red", marker="x", label="Training Data")
-    ax[0].scatter(max_x_obj, max_y_obj, color="blue", marker="o", s=100, label="Max Value")
-    ax[0].set_title("Objective Function (Acquisition)")
-    ax[0].set_xlabel("X1")
-    ax[0].set_ylabel("X2")
-    fig.colorbar(obj_acq_contour, ax=ax[0])
-
-    # 制約の獲得関数の最大値をプロット
-    if acqf_con is not None:
-        con_acq_contour = ax[1].contourf(X.numpy(), Y.numpy(), acq_values_con, levels=50, cmap="viridis")
-        ax[1].scatter(train_x[:, 0].cpu().numpy(), train_x[:, 1].cpu().numpy(), color="red", marker="x", label="Training Data")
-        ax[1].scatter(max_x_con, max_y_con, color="blue", marker="o", s=100, label="Max Value")
-        ax[1].set_title("Constraint Function (Acquisition)")
-        ax[1].set_xlabel("X1")
-        ax[1].set_ylabel("X2")
-        fig.colorbar(con_acq_contour, ax=ax[1])
-
-    # 制約付き獲得関数の最大値をプロット
-    constrained_acq_contour = ax[2].contourf(X.numpy(), Y.numpy(), constrained_acq_values, levels=50, cmap="viridis")
-    ax[2].scatter(train_x[:, 0].cpu().numpy(), train_x[:, 1].cpu().numpy(), color="red", marker="x", label="Training Data")
-    ax[2].scatter(max_x_constrained, max_y_constrained, color="blue", marker="o", s=100, label="Max Value")
-    ax[2].set_title("Constrained Acquisition Function")
-    ax[2].set_xlabel("X1")
-    ax[2].set_ylabel("X2")
-    ax[2].legend()
-    fig.colorbar(constrained_acq_contour, ax=ax[2])
-
-    plt.tight_layout()
-    plt.show()
-    plt.pause(0.01)
+    # 図は描かず，数値だけをdiagnosticsに渡す (描画はDiagnosticsRendererが別プロセスで行う)
+    if diagnostics is not None:
+        diagnostics({
+            "kind": "acquisition_grid",
+            "grid_x": X.numpy(),
+            "grid_y": Y.numpy(),
+            "acq_obj": acq_values_obj,
+            "acq_con": acq_values_con if acqf_con is not None else None,
+            "acq_constrained": constrained_acq_values,
+            "grid_max": numpy.array([max_x_constrained.item(), max_y_constrained.item()]),
+            "train_x": train_x.cpu().numpy(),
+            "candidate": candidates.detach()[0].cpu().numpy(),
+        })
 
     return best_candidate
 
@@ -271,6 +246,9 @@ class SafeOptSampler(BaseSampler):
         independent_sampler: Optional[BaseSampler] = None,
         seed: Optional[int] = None,
         device: Optional["torch.device"] = None,
+        # 2次元のとき獲得関数のグリッド値などをdictで受け取るcallback. 図はサンプラーでは描かないので，
+        # 描く場合はdiagnostics_renderer.DiagnosticsRendererを渡す
+        diagnostics_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
     ):
         self.x_name_list = x_name_list
         self.x_min_max_list = x_min_max_list
@@ -293,6 +271,7 @@ class SafeOptSampler(BaseSampler):
         self._study_id: Optional[int] = None
         self._search_space = IntersectionSearchSpace()
         self._device = device or torch.device("cpu")
+        self._diagnostics_callback = diagnostics_callback
 
     def infer_relative_search_space(
         self,
@@ -414,6 +393,10 @@ class SafeOptSampler(BaseSampler):
         else:
             running_params = None
 
+        candidates_func_kwargs = {}
+        if self._diagnostics_callback is not None and self._candidates_func is constrained_candidates_func:
+            candidates_func_kwargs["diagnostics"] = self._diagnostics_callback
+
         with manual_seed(self._seed):
             candidates = self._candidates_func(
                 completed_params,          # train_x
@@ -425,7 +408,8 @@ class SafeOptSampler(BaseSampler):
                 acquisition_type_con="EI" if self.EI_con else "UCB",  # acquisition_type_con
                 beta_obj=self.beta_obj,    # 目的関数用のbeta値
                 beta_con=self.beta_con,    # 制約用のbeta値
-                constraint_threshold=self.constraint_threshold   # constraint_threshold (適宜変更可能)
+                constraint_threshold=self.constraint_threshold,   # constraint_threshold (適宜変更可能)
+                **candidates_func_kwargs,
             )
             if self._seed is not None:
                 self._seed += 1
@@ -27,10 +27,10 @@ from optuna.study import StudyDirection
 from optuna.trial import FrozenTrial
 from optuna.trial import TrialState
 import proximal
+import Hitohudebayes
 import sys
 import configparser
 from epics import PV, caget, caput
-import matplotlib.pyplot as plt
 
 
 
@@ -75,6 +75,31 @@ from gpytorch.mlls import ExactMarginalLogLikelihood
 
 _logger = logging.get_logger(__name__)
 
+def _acquisition_grid_diagnostics(acqf_obj, train_x, candidate, grid_size: int = 50) -> Dict[str, Any]:
+    # 2次元の正規化された定義域のグリッド上で目的関数の獲得関数を評価する
+    x = torch.linspace(0, 1, grid_size)
+    y = torch.linspace(0, 1, grid_size)
+    X, Y = torch.meshgrid(x, y, indexing="ij")
+    XY = torch.stack([X.ravel(), Y.ravel()], dim=-1).to(train_x)
+    XY = XY.unsqueeze(1)
+
+    with torch.no_grad():
+        acq_values_obj = acqf_obj(XY)
+
+    max_idx = acq_values_obj.argmax()
+    return {
+        "kind": "acquisition_grid",
+        "grid_x": X.numpy(),
+        "grid_y": Y.numpy(),
+        "acq_obj": acq_values_obj.reshape(grid_size, grid_size).cpu().numpy(),
+        "acq_con": None,
+        "acq_constrained": None,
+        "grid_max": XY[max_idx, 0].cpu().numpy(),
+        "train_x": train_x.cpu().numpy(),
+        "candidate": candidate.cpu().numpy(),
+    }
+
+
 def constrained_candidates_func(
     train_x: torch.Tensor,
     train_obj: torch.Tensor,
@@ -86,19 +111,32 @@ def constrained_candidates_func(
     beta_obj: float = 2.0,
     beta_con: float = 2.0,
     constraint_threshold: float = 0.5,
-    fig=None, ax=None,
+    diagnostics: Optional[Callable[[Dict[str, Any]], None]] = None,
+    acqf_budget: Optional[Hitohudebayes.AcquisitionBudget] = None,
+    train_yvar: Optional[torch.Tensor] = None,
+    stats: Optional[Dict[str, Any]] = None,
 ) -> torch.Tensor:
 
     # 訓練データを正規化
     train_x = normalize(train_x, bounds=bounds)
 
     # 目的関数のためのGPモデルを作成
-    model_obj = SingleTaskGP(train_x, train_obj, outcome_transform=Standardize(m=train_obj.size(-1)))
+    # train_yvarがあれば試行ごとの観測ノイズとして固定し，ノイズを1つの値として推定しない
+    model_obj = SingleTaskGP(train_x, train_obj, train_Yvar=train_yvar, outcome_transform=Standardize(m=train_obj.size(-1)))
     mll_obj = ExactMarginalLogLikelihood(model_obj.likelihood, model_obj)
     fit_gpytorch_mll(mll_obj)
     
     # 目的関数の獲得関数を選択
-    if acquisition_type_obj == "EI":
+    if pending_x is not None and pending_x.size(0) > 0:
+        # 測定中の点がある場合はX_pendingを扱えるMC版の獲得関数を使う
+        pending_x = normalize(pending_x, bounds=bounds)
+        if acquisition_type_obj == "EI":
+            acqf_obj = qExpectedImprovement(model=model_obj, best_f=train_obj.max(), sampler=_get_sobol_qmc_normal_sampler(256), X_pending=pending_x)
+        elif acquisition_type_obj == "UCB":
+            acqf_obj = qUpperConfidenceBound(model=model_obj, beta=beta_obj, sampler=_get_sobol_qmc_normal_sampler(256), X_pending=pending_x)
+        else:
+            raise ValueError(f"Unknown acquisition type: {acquisition_type_obj}")
+    elif acquisition_type_obj == "EI":
         acqf_obj = ExpectedImprovement(model=model_obj, best_f=train_obj.max())
     elif acquisition_type_obj == "UCB":
         acqf_obj = UpperConfidenceBound(model=model_obj, beta=beta_obj)
@@ -108,48 +146,34 @@ def constrained_candidates_func(
     standard_bounds = torch.zeros_like(bounds)
     standard_bounds[1] = 1
 
-    grid_size = 50
-    x = torch.linspace(0, 1, grid_size)
-    y = torch.linspace(0, 1, grid_size)
-    X, Y = torch.meshgrid(x, y)
-    XY = torch.stack([X.ravel(), Y.ravel()], dim=-1).to(train_x.device)
-    XY = XY.unsqueeze(1)
-    
-    with torch.no_grad():
-        acq_values_obj = acqf_obj(XY).reshape(grid_size, grid_size).detach().cpu().numpy()
-
     try:
-        candidates, acq_value = optimize_acqf(
-            acq_function=acqf_obj,
-            bounds=standard_bounds,
-            q=1,
-            num_restarts=20,
-            raw_samples=1024,
-            options={"batch_limit": 5, "maxiter": 200},
-            sequential=True,
-        )
+        if acqf_budget is not None:
+            # 時間予算に合わせてrestartとraw samplesの数を決める
+            candidates, acq_value = Hitohudebayes.optimize_acqf_with_budget(acqf_obj, standard_bounds, acqf_budget)
+        else:
+            candidates, acq_value = optimize_acqf(
+                acq_function=acqf_obj,
+                bounds=standard_bounds,
+                q=1,
+                num_restarts=20,
+                raw_samples=1024,
+                options={"batch_limit": 5, "maxiter": 200},
+                sequential=True,
+            )
         best_candidate = unnormalize(candidates.detach(), bounds=bounds)
     except RuntimeError as e:
         print("RuntimeError encountered:", e)
         raise e
 
-    if fig is not None:
-        plt.close(fig)
+    # statsを渡すと，選んだ候補点での目的関数のGPの予測標準偏差(元のスケール)を"predictive_std"に書き込む
+    if stats is not None:
+        with torch.no_grad():
+            posterior = model_obj.posterior(candidates.detach().reshape(-1, train_x.size(-1))[:1])
+        stats["predictive_std"] = float(posterior.variance[..., 0].clamp_min(0).sqrt().item())
 
-    fig, ax = plt.subplots(figsize=(8, 6))
-
-    # 目的関数の獲得関数の最大値をプロット
-    obj_acq_contour = ax.contourf(X.numpy(), Y.numpy(), acq_values_obj, levels=50, cmap="viridis")
-    ax.scatter(train_x[:, 0].cpu().numpy(), train_x[:, 1].cpu().numpy(), color="red", marker="x", label="Training Data")
-    #ax.scatter(X, Y, color="blue", marker="o", s=100, label="Max Value")
-    ax.set_title("Objective Function (Acquisition)")
-    ax.set_xlabel("X1")
-    ax.set_ylabel("X2")
-    fig.colorbar(obj_acq_contour, ax=ax)
-
-    plt.tight_layout()
-    plt.show()
-    plt.pause(0.01)
+    # 図は描かず，数値だけをdiagnosticsに渡す (描画はDiagnosticsRendererが別プロセスで行う)
+    if diagnostics is not None and train_x.size(-1) == 2:
+        diagnostics(_acquisition_grid_diagnostics(acqf_obj, train_x, candidates.detach()[0]))
 
     return best_candidate
 
@@ -197,6 +221,10 @@ class SafeOptSampler(BaseSampler):
         independent_sampler: Optional[BaseSampler] = None,
         seed: Optional[int] = None,
         device: Optional["torch.device"] = None,
+        acqf_time_budget: Optional[float] = None,  # 獲得関数の最適化にかける時間[s]
+        # 2次元のとき獲得関数のグリッド値などをdictで受け取るcallback. 図はサンプラーでは描かないので，
+        # 描く場合はdiagnostics_renderer.DiagnosticsRendererを渡す
+        diagnostics_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
     ):
         self.x_name_list = x_name_list
         self.x_min_max_list = x_min_max_list
@@ -219,6 +247,12 @@ class SafeOptSampler(BaseSampler):
         self._study_id: Optional[int] = None
         self._search_space = IntersectionSearchSpace()
         self._device = device or torch.device("cpu")
+        self._acqf_budget = (
+            Hitohudebayes.AcquisitionBudget(acqf_time_budget)
+            if acqf_time_budget is not None
+            else None
+        )
+        self._diagnostics_callback = diagnostics_callback
 
     def infer_relative_search_space(
         self,
@@ -254,6 +288,9 @@ class SafeOptSampler(BaseSampler):
         if len(search_space) == 0:
             return {}
 
+        # 下のループで変数trialが上書きされるので，今のtrialのidを先に取っておく
+        trial_id = trial._trial_id
+
         completed_trials = study.get_trials(
             deepcopy=False, states=(TrialState.COMPLETE,)
         )
@@ -277,6 +314,20 @@ class SafeOptSampler(BaseSampler):
                 
         #con = None  #debug
 
+        # 繰り返し測定のばらつきから求めた目的関数の分散
+        # 分散の無い試行(測定1回など)の補完と下限はHitohudebayesSamplerと同じHitohudebayes.fill_noiseで行う
+        yvar = None
+        # Noneはfloat64の配列でNaN(分散なし)になる
+        variances = numpy.array(
+            [[trial.user_attrs.get("objective_variance")] for trial in completed_trials],
+            dtype=numpy.float64,
+        ).reshape(-1, 1)
+        filled = Hitohudebayes.fill_noise(
+            variances, numpy.array([[t.values[0]] for t in completed_trials], dtype=numpy.float64)
+        )
+        if filled is not None:
+            yvar = torch.from_numpy(filled).to(self._device)
+
         running_trials = [
             t
             for t in study.get_trials(deepcopy=False, states=(TrialState.RUNNING,))
@@ -340,6 +391,17 @@ class SafeOptSampler(BaseSampler):
         else:
             running_params = None
 
+        candidates_func_kwargs = {}
+        if self._acqf_budget is not None and self._candidates_func is constrained_candidates_func:
+            candidates_func_kwargs["acqf_budget"] = self._acqf_budget
+        if yvar is not None and self._candidates_func is constrained_candidates_func:
+            candidates_func_kwargs["train_yvar"] = yvar
+        if self._candidates_func is constrained_candidates_func:
+            # 逐次測定のrelative_toleranceに使うGPの予測標準偏差を受け取る
+            candidates_func_kwargs["stats"] = {}
+            if self._diagnostics_callback is not None:
+                candidates_func_kwargs["diagnostics"] = self._diagnostics_callback
+
         with manual_seed(self._seed):
             candidates = self._candidates_func(
                 completed_params,          # train_x
@@ -351,11 +413,19 @@ class SafeOptSampler(BaseSampler):
                 acquisition_type_con="EI" if self.EI_con else "UCB",  # acquisition_type_con
                 beta_obj=self.beta_obj,    # 目的関数用のbeta値
                 beta_con=self.beta_con,    # 制約用のbeta値
-                constraint_threshold=self.constraint_threshold   # constraint_threshold (適宜変更可能)
+                constraint_threshold=self.constraint_threshold,   # constraint_threshold (適宜変更可能)
+                **candidates_func_kwargs,
             )
             if self._seed is not None:
                 self._seed += 1
 
+        if candidates_func_kwargs.get("stats", {}).get("predictive_std") is not None:
+            study._storage.set_trial_system_attr(
+                trial_id,
+                Hitohudebayes.PREDICTIVE_STD_KEY,
+                candidates_func_kwargs["stats"]["predictive_std"],
+            )
+
         if not isinstance(candidates, torch.Tensor):
             raise TypeError("Candidates must be a torch.Tensor.")
         if candidates.dim() == 2:
@@ -27,10 +27,14 @@ from optuna.study import StudyDirection
 from optuna.trial import FrozenTrial
 from optuna.trial import TrialState
 import proximal
+import Hitohudebayes
+from safeset import SafeSetGrid
+from Hitohudebayes import GPModelCache
+from Hitohudebayes import GPModelListCache
+from Hitohudebayes import RefitPolicy
 import sys
 import configparser
 from epics import PV, caget, caput
-import matplotlib.pyplot as plt
 
 
 
@@ -75,6 +79,55 @@ from gpytorch.mlls import ExactMarginalLogLikelihood, SumMarginalLogLikelihood
 
 _logger = logging.get_logger(__name__)
 
+_SAFE_SET_KEY = "safeopt:safe_set"
+
+def _expected_improvement(mean: torch.Tensor, sigma: torch.Tensor, best_f: torch.Tensor) -> torch.Tensor:
+    # 解析的なEI. 事後分布の平均と標準偏差から計算するのでモデルを再評価しない
+    u = (mean - best_f) / sigma
+    normal = torch.distributions.Normal(torch.zeros_like(u), torch.ones_like(u))
+    return sigma * (torch.exp(normal.log_prob(u)) + u * normal.cdf(u))
+
+
+def _acquisition_grid_diagnostics(
+    model, train_x, train_obj, train_con, best_f, qEI, constrained_obj, candidate,
+    grid_size: int = 50,
+) -> Dict[str, Any]:
+    x = torch.linspace(0, 1, grid_size)
+    y = torch.linspace(0, 1, grid_size)
+    X, Y = torch.meshgrid(x, y, indexing="ij")
+    XY = torch.stack([X.ravel(), Y.ravel()], dim=-1).to(train_x)
+    XY = XY.unsqueeze(1)
+
+    # グリッド上の事後分布を1回だけ計算し，3つの図の獲得関数値を全てそこから求める
+    with torch.no_grad():
+        grid_posterior = model.posterior(XY)
+        mean = grid_posterior.mean.squeeze(-2)
+        sigma = grid_posterior.variance.clamp_min(1e-12).sqrt().squeeze(-2)
+        acq_values_obj = _expected_improvement(mean[..., 0], sigma[..., 0], train_obj.max())
+        acq_values_con = None
+        if train_con is not None:
+            acq_values_con = _expected_improvement(mean[..., 1], sigma[..., 1], train_con[:, 0].min())
+            acq_values_con = acq_values_con.reshape(grid_size, grid_size).cpu().numpy()
+
+        # qEIと同じ計算(q=1)を，グリッドの事後分布からのサンプルに対して行う
+        samples = qEI.sampler(grid_posterior)
+        improvement = (constrained_obj(samples) - best_f).clamp_min(0).max(dim=-1).values
+        constrained_acq_values = improvement.mean(dim=0)
+
+    max_idx = constrained_acq_values.argmax()
+    return {
+        "kind": "acquisition_grid",
+        "grid_x": X.numpy(),
+        "grid_y": Y.numpy(),
+        "acq_obj": acq_values_obj.reshape(grid_size, grid_size).cpu().numpy(),
+        "acq_con": acq_values_con,
+        "acq_constrained": constrained_acq_values.reshape(grid_size, grid_size).cpu().numpy(),
+        "grid_max": XY[max_idx, 0].cpu().numpy(),
+        "train_x": train_x.cpu().numpy(),
+        "candidate": candidate.cpu().numpy(),
+    }
+
+
 def constrained_candidates_func(
     train_x: torch.Tensor,
     train_obj: torch.Tensor,
@@ -86,7 +139,10 @@ def constrained_candidates_func(
     beta_obj: float = 2.0,
     beta_con: float = 2.0,
     constraint_threshold: float = 0.5,
-    fig=None, ax=None,
+    diagnostics: Optional[Callable[[Dict[str, Any]], None]] = None,
+    model_cache: Optional[Union[GPModelCache, GPModelListCache]] = None,
+    acqf_optimizer: str = "optimize_acqf",
+    acqf_budget: Optional[Hitohudebayes.AcquisitionBudget] = None,
 ) -> torch.Tensor:
     
     if train_con is not None:
@@ -95,64 +151,47 @@ def constrained_candidates_func(
         print("制約なしの候補点生成を行っています...")
 
     train_x = normalize(train_x, bounds=bounds)
+    n_constraints = 0 if train_con is None else train_con.size(-1)
 
-    # 目的関数のためのGPモデルを作成
-    model_obj = SingleTaskGP(train_x, train_obj, outcome_transform=Standardize(m=train_obj.size(-1)))
-    mll_obj   = ExactMarginalLogLikelihood(model_obj.likelihood, model_obj)
-    fit_gpytorch_mll(mll_obj)    
-    acqf_obj = ExpectedImprovement(model=model_obj, best_f=train_obj.max())
-
-    # 制約がある場合、制約のためのGPモデルを作成
-    #train_con = normalize(train_con, bounds=torch.tensor([[0.0], [1.0]]).to(train_con.device))
-    model_con = SingleTaskGP(train_x, train_con, outcome_transform=Standardize(m=train_con.size(-1)))
-    mll_con = ExactMarginalLogLikelihood(model_con.likelihood, model_con)
-    fit_gpytorch_mll(mll_con)
-    acqf_con = ExpectedImprovement(model=model_con, best_f=train_con.min())
-
-    standard_bounds = torch.zeros_like(bounds)
-    standard_bounds[1] = 1
-
-    grid_size = 50
-    x = torch.linspace(0, 1, grid_size)
-    y = torch.linspace(0, 1, grid_size)
-    X, Y = torch.meshgrid(x, y)
-    XY = torch.stack([X.ravel(), Y.ravel()], dim=-1).to(train_x.device)
-    XY = XY.unsqueeze(1)
-    
-    with torch.no_grad():
-        acq_values_obj = acqf_obj(XY).reshape(grid_size, grid_size).detach().cpu().numpy()
-        acq_values_con = acqf_con(XY).reshape(grid_size, grid_size).detach().cpu().numpy()
-
-    from botorch.acquisition.objective import ConstrainedMCObjective
+    # 目的関数と全ての制約(ロスモニター)を1つの多出力GPにまとめ，ハイパーパラメータの最適化を1回で済ませる
+    # (出力ごとに独立なハイパーパラメータを持つバッチモデルなので，別々に学習するのと同じモデルになる)
+    # model_cacheがある場合はRefitPolicyに従って前回のモデルを再利用する
+    # GPModelListCacheなら出力ごとに独立なGPを並列に学習してModelListGPにまとめる
+    # multitaskのGPModelCacheなら出力間の相関も学習するKroneckerMultiTaskGPになる
+    train_y = train_obj if train_con is None else torch.cat([train_obj, train_con], dim=-1)
+    model = Hitohudebayes._get_fitted_model(train_x, train_y, model_cache)
 
     # define a feasibility-weighted objective for optimization
+    # 制約はconstraint_threshold以下で満たされる (SafeSetGridと同じ基準)
     constrained_obj = ConstrainedMCObjective(
-        objective=lambda Z: Z[..., 0],
-        constraints=[lambda Z: Z[..., 1]],
+        objective=lambda Z, X=None: Z[..., 0],
+        constraints=[
+            (lambda Z, i=i: Z[..., 1 + i] - constraint_threshold) for i in range(n_constraints)
+        ],
     )
 
-    models = ModelListGP(model_obj, model_con)  #複数のモデルを扱うためModelListを使う
-    mll = SumMarginalLogLikelihood(models.likelihood, models)
-    fit_gpytorch_mll(mll)  #model_objとmodel_conのハイパーパラメータの最適化
-
-    qEI = qExpectedImprovement(model=models, best_f=(train_obj * (train_con <= 0.1)).max(), objective=constrained_obj,sampler=SobolQMCNormalSampler(sample_shape=torch.Size([1024])),)
+    if train_con is not None:
+        best_f = (train_obj * (train_con <= constraint_threshold).all(dim=-1, keepdim=True)).max()
+    else:
+        best_f = train_obj.max()
+    qEI = qExpectedImprovement(model=model, best_f=best_f, objective=constrained_obj,sampler=SobolQMCNormalSampler(sample_shape=torch.Size([1024])),)
     #qEI = UpperConfidenceBound(model=model_obj, beta=beta_obj)
     #qEI = qExpectedImprovement(model=models, best_f=train_obj.max())
-    # constrained_acqf(X) の結果を計算して最大値を見つける
-    constrained_acq_values = qEI(XY).reshape(grid_size, grid_size).detach().cpu().numpy()
-    max_idx_constrained = constrained_acq_values.argmax()
 
-    max_x_constrained, max_y_constrained = X.ravel()[max_idx_constrained], Y.ravel()[max_idx_constrained]
+    standard_bounds = torch.zeros_like(bounds)
+    standard_bounds[1] = 1
 
     try:
-        candidates, acq_value = optimize_acqf(
-            acq_function=qEI,
-            bounds=standard_bounds,
-            q=1,
+        # acqf_optimizer="sobol_pool"ならSobol点列上で評価して上位の点だけ勾配法で磨く
+        candidates, acq_value = Hitohudebayes._optimize_candidates(
+            qEI,
+            standard_bounds,
+            1,
+            acqf_optimizer,
             num_restarts=10,
             raw_samples=512,
             options={"batch_limit": 5, "maxiter": 200, "nonnegative": True},
-            sequential=True,
+            acqf_budget=acqf_budget,
         )
         best_candidate = unnormalize(candidates.detach(), bounds=bounds)
         print(acq_value)
@@ -160,49 +199,86 @@ def constrained_candidates_func(
         print("RuntimeError encountered:", e)
         raise e
 
-    if fig is not None:
-        plt.close(fig)
-
-    fig, ax = plt.subplots(1, 3, figsize=(24, 6))
-
-    # 目的関数の獲得関数の最大値をプロット
-    obj_acq_contour = ax[0].contourf(X.numpy(), Y.numpy(), acq_values_obj, levels=50, cmap = "plasma")
-    ax[0].scatter(train_x[:, 0].cpu().numpy(), train_x[:, 1].cpu().numpy(), color="white", marker="x", label="Training Data")
-    #ax[0].scatter(max_x_obj, max_y_obj, color="blue", marker="o", s=100, label="Max Value")
-    ax[0].set_title("Objective Function (Acquisition)")
-    ax[0].set_xlabel("X1")
-    ax[0].set_ylabel("X2")
-    fig.colorbar(obj_acq_contour, ax=ax[0])
-
-    # 制約の獲得関数の最大値をプロット
-    if acqf_con is not None:
-        con_acq_contour = ax[1].contourf(X.numpy(), Y.numpy(), acq_values_con, levels=50, cmap = "plasma")
-        ax[1].scatter(train_x[:, 0].cpu().numpy(), train_x[:, 1].cpu().numpy(), color="white", marker="x", label="Training Data")
-        #ax[1].scatter(max_x_con, max_y_con, color="blue", marker="o", s=100, label="Max Value")
-        ax[1].set_title("Constraint Function (Acquisition)")
-        ax[1].set_xlabel("X1")
-        ax[1].set_ylabel("X2")
-        fig.colorbar(con_acq_contour, ax=ax[1])
-
-    # 制約付き獲得関数の最大値をプロット
-    constrained_acq_contour = ax[2].contourf(X.numpy(), Y.numpy(), constrained_acq_values, levels=50, cmap = "plasma")
-    ax[2].scatter(train_x[:, 0].cpu().numpy(), train_x[:, 1].cpu().numpy(), color="white", marker="x", label="Training Data")
-    ax[2].scatter(max_x_constrained, max_y_constrained, color="cyan", marker="o", s=100, label="Max Value")
-    ax[2].set_title("Constrained Acquisition Function")
-    ax[2].set_xlabel("X1")
-    ax[2].set_ylabel("X2")
-    ax[2].legend()
-    fig.colorbar(constrained_acq_contour, ax=ax[2])
-
-    plt.tight_layout()
-    plt.show()
-    plt.pause(0.01)
+    # 図は描かず，数値だけをdiagnosticsに渡す (描画はDiagnosticsRendererが別プロセスで行う)
+    if diagnostics is not None and train_x.size(-1) == 2:
+        diagnostics(
+            _acquisition_grid_diagnostics(
+                model, train_x, train_obj, train_con, best_f, qEI, constrained_obj,
+                normalize(best_candidate, bounds=bounds)[0],
+            )
+        )
 
     return best_candidate
 
 
 
 
+def _model_update_paths(model_cache: Optional[Union[GPModelCache, GPModelListCache]]) -> list:
+    if model_cache is None or model_cache.last_update is None:
+        return []
+    if isinstance(model_cache, GPModelListCache):
+        return [update["path"] for update in model_cache.last_update["outputs"]]
+    return [model_cache.last_update["path"]]
+
+
+def safeopt_candidates_func(
+    train_x: torch.Tensor,
+    train_obj: torch.Tensor,
+    train_con: Optional[torch.Tensor],
+    bounds: torch.Tensor,
+    pending_x: torch.Tensor = None,
+    acquisition_type_obj: str = "EI",
+    acquisition_type_con: str = "EI",
+    beta_obj: float = 2.0,
+    beta_con: float = 2.0,
+    constraint_threshold: float = 0.5,
+    diagnostics: Optional[Callable[[Dict[str, Any]], None]] = None,
+    model_cache: Optional[Union[GPModelCache, GPModelListCache]] = None,
+    safe_set: Optional[SafeSetGrid] = None,
+) -> torch.Tensor:
+    # グリッドの全点で獲得関数を評価する代わりに，SafeSetGridに保持した安全集合から
+    # SafeOptの規則(maximizerとexpanderのうち信頼区間が最も広い点)で次の点を選ぶ
+
+    if train_con is None:
+        raise ValueError("safeopt_candidates_func requires constraints.")
+
+    train_x = normalize(train_x, bounds=bounds)
+    train_y = torch.cat([train_obj, train_con], dim=-1)
+    model = Hitohudebayes._get_fitted_model(train_x, train_y, model_cache)
+
+    if safe_set is None:
+        safe_set = SafeSetGrid(
+            beta_obj=beta_obj, beta_con=beta_con, threshold=constraint_threshold
+        )
+    # モデルが新しい観測で条件付けされただけなら，その近くのセルだけを更新する
+    paths = _model_update_paths(model_cache)
+    incremental = len(paths) > 0 and all(path in ("cached", "condition") for path in paths)
+    safe_set.update(
+        model, train_x, train_y, Hitohudebayes._get_lengthscales(model), incremental
+    )
+
+    next_point = safe_set.next_point()
+    if next_point is None:
+        # 安全集合が空のときは，制約の違反が最も小さかった観測点に戻る
+        next_point = train_x[train_con.nan_to_num(float("inf")).max(dim=-1).values.argmin()]
+    candidate = torch.as_tensor(next_point, dtype=train_x.dtype, device=train_x.device)
+    best_candidate = unnormalize(candidate.unsqueeze(0), bounds=bounds)
+
+    if diagnostics is not None:
+        diagnostics(
+            {
+                "kind": "safe_set",
+                "points": safe_set.points,
+                "safe": safe_set.safe,
+                "expanders": safe_set.expanders,
+                "maximizers": safe_set.maximizers,
+                "train_x": train_x.cpu().numpy(),
+                "candidate": candidate.cpu().numpy(),
+            }
+        )
+
+    return best_candidate
+
 
 @experimental_class("2.4.0")
 class SafeOptSampler(BaseSampler):
@@ -273,6 +349,42 @@ class SafeOptSampler(BaseSampler):
         device:
             A ``torch.device`` to store input and output data of BoTorch. Please set a CUDA device
             if you fasten sampling.
+        persistent_model:
+            If True, the GP of :func:`constrained_candidates_func`, which models the objective
+            and all constraints at once, is kept across trials in a
+            :class:`~Hitohudebayes.GPModelCache` and only conditioned on new observations
+            between refits, keeping the previous hyperparameters. If False, the GP is fitted
+            from scratch on every trial.
+        refit_policy:
+            A :class:`~Hitohudebayes.RefitPolicy` that decides when the persistent model
+            re-optimizes its hyperparameters. Which path ran and how long it took is stored in
+            the trial system attribute ``"hitohudebayes:model_update"``.
+        acqf_optimizer:
+            ``"optimize_acqf"`` or ``"sobol_pool"``. Passed to :func:`constrained_candidates_func`.
+            See :func:`~Hitohudebayes.optimize_acqf_sobol_pool`.
+        acqf_time_budget:
+            Wall-clock budget in seconds of the acquisition optimization per suggestion. See
+            :class:`~Hitohudebayes.AcquisitionBudget`. :obj:`None` keeps the fixed settings.
+        fit_workers:
+            If given, the objective and each constraint get an independent GP, and this many of
+            them are fitted concurrently. See :class:`~Hitohudebayes.GPModelListCache`.
+            :obj:`None` fits the single multi-output GP.
+        multitask_model:
+            If True, the objective and the constraints are modelled by one correlated
+            ``KroneckerMultiTaskGP`` that shares the input kernel between the outputs, so the
+            feasible region is also learned from the objective observations. See
+            :class:`~Hitohudebayes.GPModelCache`. Cannot be combined with ``fit_workers``.
+        safe_set:
+            A :class:`~safeset.SafeSetGrid` kept across trials by
+            :func:`safeopt_candidates_func`. If omitted, one is created from ``beta_obj``,
+            ``beta_con`` and ``constraint_threshold``. Its last update is stored in the trial
+            system attribute ``"safeopt:safe_set"``.
+        diagnostics_callback:
+            Called by the built-in candidate functions with a dictionary of NumPy arrays
+            describing the suggestion (acquisition values on a grid for 2-D problems, or the
+            safe-set grid, the training points and the candidate). No figures are drawn in
+            the sampler. Pass a :class:`~diagnostics_renderer.DiagnosticsRenderer` to plot
+            them in a separate process. :obj:`None` skips computing the diagnostics.
     """
 
     def __init__(
@@ -311,7 +423,18 @@ class SafeOptSampler(BaseSampler):
         independent_sampler: Optional[BaseSampler] = None,
         seed: Optional[int] = None,
         device: Optional["torch.device"] = None,
+        persistent_model: bool = False,
+        refit_policy: Optional[RefitPolicy] = None,
+        acqf_optimizer: str = "optimize_acqf",
+        acqf_time_budget: Optional[float] = None,
+        fit_workers: Optional[int] = None,
+        multitask_model: bool = False,
+        safe_set: Optional[SafeSetGrid] = None,
+        diagnostics_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
     ):
+        if fit_workers is not None and multitask_model:
+            raise ValueError("fit_workers cannot be combined with multitask_model.")
+
         self.x_name_list = x_name_list
         self.x_min_max_list = x_min_max_list
         self.x_weight_list = x_weight_list
@@ -333,6 +456,22 @@ class SafeOptSampler(BaseSampler):
         self._study_id: Optional[int] = None
         self._search_space = IntersectionSearchSpace()
         self._device = device or torch.device("cpu")
+        self._acqf_optimizer = acqf_optimizer
+        self._acqf_budget = (
+            Hitohudebayes.AcquisitionBudget(acqf_time_budget)
+            if acqf_time_budget is not None
+            else None
+        )
+        self._safe_set = safe_set or SafeSetGrid(
+            beta_obj=beta_obj, beta_con=beta_con, threshold=constraint_threshold
+        )
+        self._persistent_model = persistent_model
+        self._diagnostics_callback = diagnostics_callback
+        self._model_cache: Optional[Union[GPModelCache, GPModelListCache]] = None
+        if fit_workers is not None:
+            self._model_cache = GPModelListCache(refit_policy, fit_workers)
+        elif persistent_model or multitask_model:
+            self._model_cache = GPModelCache(refit_policy, multitask=multitask_model)
 
     def infer_relative_search_space(
         self,
@@ -368,6 +507,7 @@ class SafeOptSampler(BaseSampler):
         if len(search_space) == 0:
             return {}
 
+        trial_id = trial._trial_id
         completed_trials = study.get_trials(
             deepcopy=False, states=(TrialState.COMPLETE,)
         )
@@ -454,6 +594,22 @@ class SafeOptSampler(BaseSampler):
         else:
             running_params = None
 
+        candidates_func_kwargs = {}
+        if self._candidates_func in (constrained_candidates_func, safeopt_candidates_func):
+            if self._model_cache is not None:
+                if not self._persistent_model:
+                    self._model_cache.reset()
+                candidates_func_kwargs["model_cache"] = self._model_cache
+            if self._diagnostics_callback is not None:
+                candidates_func_kwargs["diagnostics"] = self._diagnostics_callback
+        if self._candidates_func is safeopt_candidates_func:
+            candidates_func_kwargs["safe_set"] = self._safe_set
+        if self._candidates_func is constrained_candidates_func:
+            if self._acqf_optimizer != "optimize_acqf":
+                candidates_func_kwargs["acqf_optimizer"] = self._acqf_optimizer
+            if self._acqf_budget is not None:
+                candidates_func_kwargs["acqf_budget"] = self._acqf_budget
+
         with manual_seed(self._seed):
             candidates = self._candidates_func(
                 completed_params,          # train_x
@@ -465,11 +621,21 @@ class SafeOptSampler(BaseSampler):
                 acquisition_type_con="EI" if self.EI_con else "UCB",  # acquisition_type_con
                 beta_obj=self.beta_obj,    # 目的関数用のbeta値
                 beta_con=self.beta_con,    # 制約用のbeta値
-                constraint_threshold=self.constraint_threshold   # constraint_threshold (適宜変更可能)
+                constraint_threshold=self.constraint_threshold,   # constraint_threshold (適宜変更可能)
+                **candidates_func_kwargs,
             )
             if self._seed is not None:
                 self._seed += 1
 
+        if "model_cache" in candidates_func_kwargs and self._model_cache.last_update is not None:
+            study._storage.set_trial_system_attr(
+                trial_id, Hitohudebayes._MODEL_UPDATE_KEY, self._model_cache.last_update
+            )
+        if "safe_set" in candidates_func_kwargs and self._safe_set.last_update is not None:
+            study._storage.set_trial_system_attr(
+                trial_id, _SAFE_SET_KEY, self._safe_set.last_update
+            )
+
         if not isinstance(candidates, torch.Tensor):
             raise TypeError("Candidates must be a torch.Tensor.")
         if candidates.dim() == 2:
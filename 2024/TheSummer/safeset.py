@@ -0,0 +1,408 @@
+r"""
+A persistent discretization of the normalized search space holding the safe set, the
+expanders and the maximizers of SafeOpt.
+"""
+from __future__ import annotations
+
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Sequence
+import time
+import warnings
+
+import numpy as np
+import torch
+from torch import Tensor
+
+
+_SETS = ("safe", "expanders", "maximizers")
+
+
+class SafeSetGrid:
+    """Keeps the SafeOpt sets on a lazily grown grid across trials.
+
+    The unit cube is discretized with ``points_per_dim`` points along each axis, chosen from
+    the GP lengthscales so that every lengthscale spans about ``cells_per_lengthscale``
+    cells. Only the cells of the safe set and their axis neighbours are materialized, so the
+    memory and the number of posterior evaluations follow the size of the safe region rather
+    than the full ``prod(points_per_dim)`` mesh, which makes the grid usable beyond 2-D.
+
+    The posterior mean and standard deviation of every output are stored per cell. When the
+    model was only conditioned on new observations since the previous call (``incremental``),
+    only the cells within reach of the new observations, where the kernel correlation with
+    them exceeds ``update_tol``, are re-evaluated. Otherwise, e.g. after a hyperparameter
+    refit, all cells are re-evaluated, and the grid is rebuilt if the resolution implied by
+    the new lengthscales differs by more than a factor of two.
+
+    The output 0 of the model is the objective (maximized) and the others are constraints,
+    which are satisfied when ``<= threshold``. Following SafeOpt with multiple constraints
+    (Berkenkamp et al., 2016):
+
+    - a cell is safe once the upper confidence bound of every constraint is below
+      ``threshold``. The safe set never shrinks. The cells of the feasible observations are
+      safe seeds.
+    - a safe cell is a maximizer if the upper confidence bound of the objective exceeds the
+      best lower confidence bound among the safe cells.
+    - a safe cell is an expander if, with the optimistic (lower) constraint values and the
+      Lipschitz constants, an unsafe neighbouring cell would become safe.
+
+    The sets are stored as packed bit arrays (``numpy.packbits``).
+
+    After each call of :meth:`update`, ``last_update`` holds the number of cells, of cells
+    re-evaluated and of safe cells, and the duration in seconds.
+
+    Args:
+        beta_obj:
+            Width of the confidence interval of the objective in standard deviations.
+        beta_con:
+            Width of the confidence interval of the constraints in standard deviations.
+        threshold:
+            A constraint value equal to or smaller than this is feasible.
+        lipschitz:
+            Lipschitz constants of the constraints in the normalized search space, one per
+            constraint. If omitted, they are estimated from the posterior mean differences
+            between neighbouring cells.
+        cells_per_lengthscale:
+            Target number of grid cells per GP lengthscale.
+        min_points_per_dim:
+            Lower bound of the number of grid points along an axis.
+        max_points_per_dim:
+            Upper bound of the number of grid points along an axis. Also used when the model
+            does not expose lengthscales.
+        max_cells:
+            Maximum number of materialized cells. The safe set stops growing at this size.
+        update_tol:
+            Kernel correlation with the new observations below which a cell is not
+            re-evaluated in an incremental update.
+        chunk_size:
+            Number of cells evaluated per posterior call.
+    """
+
+    def __init__(
+        self,
+        beta_obj: float = 2.0,
+        beta_con: float = 2.0,
+        threshold: float = 0.0,
+        lipschitz: Optional[Sequence[float]] = None,
+        cells_per_lengthscale: float = 4.0,
+        min_points_per_dim: int = 5,
+        max_points_per_dim: int = 50,
+        max_cells: int = 200000,
+        update_tol: float = 0.01,
+        chunk_size: int = 4096,
+    ) -> None:
+        self.beta_obj = beta_obj
+        self.beta_con = beta_con
+        self.threshold = threshold
+        self.lipschitz = None if lipschitz is None else np.asarray(lipschitz, dtype=np.float64)
+        self.cells_per_lengthscale = cells_per_lengthscale
+        self.min_points_per_dim = min_points_per_dim
+        self.max_points_per_dim = max_points_per_dim
+        self.max_cells = max_cells
+        self.update_tol = update_tol
+        self.chunk_size = chunk_size
+        self.reset()
+
+    def reset(self) -> None:
+        self.points_per_dim: Optional[np.ndarray] = None
+        self.last_update: Optional[Dict[str, Any]] = None
+        self._n_observations: Optional[int] = None
+        self._scale: Optional[np.ndarray] = None
+        self._clear_cells()
+
+    @property
+    def n_cells(self) -> int:
+        return self._cells.shape[0]
+
+    @property
+    def points(self) -> np.ndarray:
+        """Normalized coordinates of the materialized cells, of shape ``(n_cells, n_params)``."""
+
+        return self._coordinates(self._cells)
+
+    @property
+    def safe(self) -> np.ndarray:
+        return self._get_set("safe")
+
+    @property
+    def expanders(self) -> np.ndarray:
+        return self._get_set("expanders")
+
+    @property
+    def maximizers(self) -> np.ndarray:
+        return self._get_set("maximizers")
+
+    def update(
+        self,
+        model: Any,
+        train_x: Tensor,
+        train_y: Tensor,
+        lengthscale: Optional[np.ndarray] = None,
+        incremental: bool = False,
+    ) -> None:
+        """Bring the grid up to date with ``model``.
+
+        Args:
+            model:
+                A BoTorch model of the outputs ``[objective, constraint_1, ...]`` on the
+                normalized search space.
+            train_x:
+                Normalized parameter configurations of shape ``(n_trials, n_params)``.
+            train_y:
+                Observations of shape ``(n_trials, 1 + n_constraints)``.
+            lengthscale:
+                Lengthscales of the model of shape ``(n_params,)``, or per output of shape
+                ``(n_outputs, n_params)``, if available. The resolution of the grid follows
+                the shortest lengthscale of each axis and the reach of new observations the
+                longest. Without lengthscales, every incremental update re-evaluates all
+                cells.
+            incremental:
+                Whether ``model`` differs from the model of the previous call only by the
+                conditioning on the observations appended to ``train_x`` since then.
+        """
+
+        start = time.perf_counter()
+        if train_y.size(-1) < 2:
+            raise ValueError("SafeSetGrid requires at least one constraint.")
+        if lengthscale is not None:
+            lengthscale = np.atleast_2d(np.asarray(lengthscale, dtype=np.float64))
+        elif incremental:
+            warnings.warn(
+                "The model does not expose lengthscales, so every incremental update of the "
+                "safe set re-evaluates all cells."
+            )
+        x = train_x.detach().cpu().numpy()
+        y = train_y.detach().cpu().numpy()
+        self._tensor_kwargs = {"dtype": train_x.dtype, "device": train_x.device}
+        scale = np.nanstd(y, axis=0)
+        self._scale = np.where(scale > 0, scale, 1.0)
+
+        n_new: Optional[int] = None
+        if (
+            incremental
+            and self._n_observations is not None
+            and x.shape[0] >= self._n_observations
+        ):
+            n_new = x.shape[0] - self._n_observations
+        self._n_observations = x.shape[0]
+
+        points_per_dim = self._resolution(x.shape[1], lengthscale)
+        if (
+            self.points_per_dim is None
+            or self.points_per_dim.shape != points_per_dim.shape
+            or self._mean.shape[1] not in (0, y.shape[1])
+            or (
+                n_new is None
+                and (
+                    (points_per_dim > 2 * self.points_per_dim).any()
+                    or (2 * points_per_dim < self.points_per_dim).any()
+                )
+            )
+        ):
+            self.points_per_dim = points_per_dim
+            self._strides = np.cumprod(np.r_[1, points_per_dim[:0:-1]])[::-1].astype(np.int64)
+            if np.prod(points_per_dim.astype(np.float64)) >= 2.0**62:
+                raise ValueError("The grid is too fine to index. Lower max_points_per_dim.")
+            self._clear_cells()
+            n_new = None
+
+        # The cells of the feasible observations seed the safe set.
+        feasible = (y[:, 1:] <= self.threshold).all(axis=1)
+        seed_cells = np.rint(x[feasible] * (self.points_per_dim - 1)).astype(np.int64)
+        added = self._add_cells(seed_cells)
+        if n_new is None:
+            rows = np.arange(self.n_cells)
+        else:
+            rows = np.union1d(self._rows_near(x[x.shape[0] - n_new :], lengthscale), added)
+        self._evaluate(model, rows)
+        n_evaluated = rows.size
+
+        seed_rows = self._find_rows(seed_cells @ self._strides)
+        seed = np.zeros(self.n_cells, dtype=bool)
+        seed[seed_rows[seed_rows >= 0]] = True
+        safe = self.safe | seed
+
+        # Grow the materialized cells around the safe set until it stops expanding.
+        while True:
+            upper = self._mean + self._beta() * self._std
+            safe |= (upper[:, 1:] <= self.threshold).all(axis=1)
+            grow = safe & ~self._expanded
+            if not grow.any() or self.n_cells >= self.max_cells:
+                break
+            self._expanded |= grow
+            added = self._add_cells(self._neighbour_cells(self._cells[grow]))
+            safe = np.concatenate([safe, np.zeros(added.size, dtype=bool)])
+            self._evaluate(model, added)
+            n_evaluated += added.size
+
+        self._set_set("safe", safe)
+        self._update_expanders_and_maximizers(safe)
+        self.last_update = {
+            "n_cells": self.n_cells,
+            "n_evaluated": int(n_evaluated),
+            "n_safe": int(safe.sum()),
+            "duration": time.perf_counter() - start,
+        }
+
+    def next_point(self) -> Optional[np.ndarray]:
+        """Return the normalized coordinates of the next point to evaluate.
+
+        This is the maximizer or expander with the widest confidence interval, measured in
+        units of the standard deviation of the observations of each output. :obj:`None` if
+        the safe set is empty.
+        """
+
+        candidates = self.maximizers | self.expanders
+        if not candidates.any():
+            candidates = self.safe
+        if not candidates.any():
+            return None
+        width = (2 * self._beta() * self._std / self._scale).max(axis=1)
+        rows = np.flatnonzero(candidates)
+        return self._coordinates(self._cells[rows[width[rows].argmax()]])
+
+    def _clear_cells(self) -> None:
+        n_params = 0 if self.points_per_dim is None else self.points_per_dim.size
+        self._cells = np.empty((0, n_params), dtype=np.int64)
+        self._sorted_keys = np.empty(0, dtype=np.int64)
+        self._sorted_rows = np.empty(0, dtype=np.int64)
+        self._mean = np.empty((0, 0))
+        self._std = np.empty((0, 0))
+        self._expanded = np.empty(0, dtype=bool)
+        self._bits = {name: np.packbits(np.zeros(0, dtype=bool)) for name in _SETS}
+
+    def _get_set(self, name: str) -> np.ndarray:
+        return np.unpackbits(self._bits[name], count=self.n_cells).astype(bool)
+
+    def _set_set(self, name: str, values: np.ndarray) -> None:
+        self._bits[name] = np.packbits(values)
+
+    def _resolution(self, n_params: int, lengthscale: Optional[np.ndarray]) -> np.ndarray:
+        if lengthscale is None:
+            points_per_dim = np.full(n_params, self.max_points_per_dim, dtype=np.float64)
+        else:
+            points_per_dim = np.ceil(self.cells_per_lengthscale / lengthscale.min(axis=0)) + 1
+        return np.clip(points_per_dim, self.min_points_per_dim, self.max_points_per_dim).astype(
+            np.int64
+        )
+
+    def _coordinates(self, cells: np.ndarray) -> np.ndarray:
+        return cells / (self.points_per_dim - 1)
+
+    def _beta(self) -> np.ndarray:
+        beta = np.full(self._mean.shape[1], self.beta_con)
+        beta[0] = self.beta_obj
+        return beta
+
+    def _find_rows(self, keys: np.ndarray) -> np.ndarray:
+        # Row of each key, or -1 if the cell is not materialized.
+        if self._sorted_keys.size == 0:
+            return np.full(keys.shape, -1, dtype=np.int64)
+        pos = np.searchsorted(self._sorted_keys, keys).clip(max=self._sorted_keys.size - 1)
+        return np.where(self._sorted_keys[pos] == keys, self._sorted_rows[pos], -1)
+
+    def _add_cells(self, cells: np.ndarray) -> np.ndarray:
+        # Materialize the cells that are not yet on the grid and return their rows.
+        keys = np.unique(cells @ self._strides)
+        keys = keys[self._find_rows(keys) < 0][: max(self.max_cells - self.n_cells, 0)]
+        if keys.size == 0:
+            return np.empty(0, dtype=np.int64)
+        new_cells = np.stack(np.unravel_index(keys, tuple(self.points_per_dim)), axis=1)
+        rows = np.arange(self.n_cells, self.n_cells + keys.size)
+        n_outputs = self._mean.shape[1]
+
+        self._cells = np.concatenate([self._cells, new_cells.astype(np.int64)])
+        all_keys = np.concatenate([self._sorted_keys, keys])
+        all_rows = np.concatenate([self._sorted_rows, rows])
+        order = np.argsort(all_keys, kind="stable")
+        self._sorted_keys = all_keys[order]
+        self._sorted_rows = all_rows[order]
+        self._mean = np.concatenate([self._mean, np.full((keys.size, n_outputs), np.nan)])
+        self._std = np.concatenate([self._std, np.full((keys.size, n_outputs), np.nan)])
+        self._expanded = np.concatenate([self._expanded, np.zeros(keys.size, dtype=bool)])
+        for name in _SETS:
+            values = np.unpackbits(self._bits[name], count=rows[0])
+            self._set_set(name, np.concatenate([values, np.zeros(keys.size, dtype=np.uint8)]))
+        return rows
+
+    def _neighbour_cells(self, cells: np.ndarray) -> np.ndarray:
+        offsets = np.concatenate([np.eye(cells.shape[1]), -np.eye(cells.shape[1])]).astype(
+            np.int64
+        )
+        neighbours = (cells[:, None, :] + offsets).reshape(-1, cells.shape[1])
+        inside = ((neighbours >= 0) & (neighbours < self.points_per_dim)).all(axis=1)
+        return neighbours[inside]
+
+    def _neighbour_rows(self) -> np.ndarray:
+        # Rows of the 2 * n_params axis neighbours of every cell, -1 where not materialized.
+        n_params = self._cells.shape[1]
+        offsets = np.concatenate([np.eye(n_params), -np.eye(n_params)]).astype(np.int64)
+        neighbours = self._cells[:, None, :] + offsets
+        inside = ((neighbours >= 0) & (neighbours < self.points_per_dim)).all(axis=-1)
+        rows = self._find_rows(neighbours @ self._strides)
+        return np.where(inside, rows, -1)
+
+    def _rows_near(self, new_x: np.ndarray, lengthscale: Optional[np.ndarray]) -> np.ndarray:
+        if new_x.shape[0] == 0:
+            return np.empty(0, dtype=np.int64)
+        if lengthscale is None:
+            return np.arange(self.n_cells)
+        # For an RBF kernel the correlation exp(-r^2 / 2) drops below `update_tol` at r.
+        radius = np.sqrt(-2 * np.log(self.update_tol))
+        diff = (self.points[:, None, :] - new_x[None, :, :]) / lengthscale.max(axis=0)
+        near = ((diff**2).sum(axis=-1) <= radius**2).any(axis=1)
+        return np.flatnonzero(near)
+
+    def _evaluate(self, model: Any, rows: np.ndarray) -> None:
+        if rows.size == 0:
+            return
+        X = torch.from_numpy(self._coordinates(self._cells[rows])).to(**self._tensor_kwargs)
+        means = []
+        stds = []
+        with torch.no_grad():
+            for i in range(0, rows.size, self.chunk_size):
+                # One t-batch per cell, so that only the marginal variances are computed.
+                posterior = model.posterior(X[i : i + self.chunk_size].unsqueeze(-2))
+                means.append(posterior.mean.squeeze(-2).cpu().numpy())
+                stds.append(posterior.variance.clamp_min(0).sqrt().squeeze(-2).cpu().numpy())
+        mean = np.concatenate(means)
+        if self._mean.shape[1] != mean.shape[1]:
+            self._mean = np.full((self.n_cells, mean.shape[1]), np.nan)
+            self._std = np.full((self.n_cells, mean.shape[1]), np.nan)
+        self._mean[rows] = mean
+        self._std[rows] = np.concatenate(stds)
+
+    def _lipschitz_constants(self, neighbour_rows: np.ndarray) -> np.ndarray:
+        if self.lipschitz is not None:
+            return self.lipschitz
+        spacing = np.tile(1.0 / (self.points_per_dim - 1), 2)
+        valid = neighbour_rows >= 0
+        rows, directions = np.nonzero(valid)
+        if rows.size == 0:
+            return np.zeros(self._mean.shape[1] - 1)
+        slopes = np.abs(
+            self._mean[neighbour_rows[rows, directions], 1:] - self._mean[rows, 1:]
+        ) / spacing[directions, None]
+        return slopes.max(axis=0)
+
+    def _update_expanders_and_maximizers(self, safe: np.ndarray) -> None:
+        beta = self._beta()
+        lower = self._mean - beta * self._std
+        upper = self._mean + beta * self._std
+
+        maximizers = np.zeros(self.n_cells, dtype=bool)
+        if safe.any():
+            maximizers = safe & (upper[:, 0] >= lower[safe, 0].max())
+
+        neighbour_rows = self._neighbour_rows()
+        unsafe_neighbour = (neighbour_rows >= 0) & ~safe[neighbour_rows.clip(min=0)]
+        distance = np.tile(1.0 / (self.points_per_dim - 1), 2)
+        lipschitz = self._lipschitz_constants(neighbour_rows)
+        # Optimistic constraint values carried over to each neighbour, (n_cells, n_con, 2d).
+        optimistic = lower[:, 1:, None] + lipschitz[None, :, None] * distance[None, None, :]
+        reaches = (optimistic <= self.threshold).all(axis=1)
+        expanders = safe & (unsafe_neighbour & reaches).any(axis=1)
+
+        self._set_set("maximizers", maximizers)
+        self._set_set("expanders", expanders)